@@ -0,0 +1,236 @@
+"""Traffic accounting: lifetime totals, calendar buckets and billing cycles.
+
+Totals grow by the per-interface counter deltas seen on every sampler tick,
+so they never go backwards when the counters do. A counter lower than its
+previous value means the interface was re-created or the counters were
+reset, and everything it shows has been transferred since. A reboot resets
+every counter the same way. The last counters are saved with the totals, so
+a restart of the monitor loses nothing: the first tick after it counts
+everything transferred since the last save.
+
+Per-day, per-month and current-cycle aggregates are updated with the same
+deltas, which makes "usage this cycle" a lookup rather than a sum.
+
+Every byte is counted once, on the lowest device it crosses. Devices stacked
+on others (bonds, bridges, VLANs, macvlans: they have lower_* links in
+/sys/class/net) are left out, as their traffic is already in the counters of
+the devices below them.
+"""
+import calendar
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+DAYS_KEPT = 400
+MONTHS_KEPT = 36
+SYSFS_NET = '/sys/class/net'
+
+
+def _start_in(year, month, cycle_day):
+    return date(year, month, min(cycle_day, calendar.monthrange(year, month)[1]))
+
+
+def cycle_start(day, cycle_day):
+    """First day of the billing cycle containing `day`.
+
+    Cycles start on `cycle_day` of every month, or on the last day of
+    months that are too short for it.
+    """
+    start = _start_in(day.year, day.month, cycle_day)
+    if day < start:
+        previous = day.replace(day=1) - timedelta(days=1)
+        start = _start_in(previous.year, previous.month, cycle_day)
+    return start
+
+
+def next_cycle_start(start, cycle_day):
+    """First day of the cycle following the one that began on `start`."""
+    following = start.replace(day=1) + timedelta(days=32)
+    return _start_in(following.year, following.month, cycle_day)
+
+
+class TrafficAccount:
+    """Traffic totals kept up to date by the sampler and saved to `path`."""
+
+    def __init__(self, path, exclude, cycle_day=1, sysfs=SYSFS_NET):
+        self.path = path
+        self.exclude = exclude  # interfaces left out, e.g. loopback
+        self.sysfs = sysfs
+        self.stacked = {}  # interface -> whether it sits on other devices, checked when the set changes
+        self.cycle_day = cycle_day
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.total_sent = self.total_recv = 0
+        self.counters = {}  # interface -> [bytes_sent, bytes_recv] at the last update
+        self.boot_time = None
+        self.days = {}  # 'YYYY-MM-DD' -> [sent, recv]
+        self.months = {}  # 'YYYY-MM' -> [sent, recv]
+        self.cycle = {'start': None, 'sent': 0, 'recv': 0}
+        self.today = None
+        self.next_midnight = 0
+
+    def load(self):
+        """Read the saved state; False when there is none yet."""
+        with self.lock:
+            try:
+                stamp = os.stat(self.path).st_mtime_ns
+                with open(self.path, 'r') as f:
+                    state = json.load(f)
+            except FileNotFoundError:
+                return False
+            except (OSError, json.JSONDecodeError) as e:
+                logging.error(f"Could not load '{self.path}': {str(e)}")
+                return False
+            self.stamp = stamp
+            self.total_sent = state['total_sent']
+            self.total_recv = state['total_recv']
+            self.counters = state.get('counters', {})
+            self.boot_time = state.get('boot_time')
+            self.days = state.get('days', {})
+            self.months = state.get('months', {})
+            self.cycle = state.get('cycle', self.cycle)
+            if self.cycle.get('start') != cycle_start(date.today(), self.cycle_day).isoformat():
+                # A new cycle began while we were down, or cycle_day changed
+                self._recompute_cycle(date.today())
+            self.today = None
+            self.next_midnight = 0
+            return True
+
+    def refresh(self):
+        """Reload the state if another process saved a newer one."""
+        try:
+            stamp = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if stamp != self.stamp:
+            self.load()
+
+    def save(self):
+        with self.lock:
+            state = {
+                'total_sent': self.total_sent,
+                'total_recv': self.total_recv,
+                'counters': self.counters,
+                'boot_time': self.boot_time,
+                'days': self.days,
+                'months': self.months,
+                'cycle': self.cycle,
+            }
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_file, self.path)
+            self.stamp = os.stat(self.path).st_mtime_ns
+
+    def seed(self, total_sent, total_recv, days):
+        """Start from totals and daily usage recorded by older versions."""
+        with self.lock:
+            self.total_sent, self.total_recv = total_sent, total_recv
+            for day in days:
+                self.days[day['date']] = [day['sent'], day['recv']]
+                month = self.months.setdefault(day['date'][:7], [0, 0])
+                month[0] += day['sent']
+                month[1] += day['recv']
+            self._recompute_cycle(date.today())
+
+    def _is_stacked(self, name):
+        try:
+            return any(entry.startswith('lower_') for entry in os.listdir(os.path.join(self.sysfs, name)))
+        except OSError:
+            return False  # not a Linux host, or the interface is already gone
+
+    def _included(self, counters):
+        """The interfaces of `counters` that are accounted."""
+        if counters.keys() != self.stacked.keys():
+            # Interfaces came or went, e.g. a bond or VLAN was set up: check them all again
+            self.stacked = {name: self._is_stacked(name) for name in counters}
+        return [name for name in counters if not self.stacked[name] and not self.exclude.match(name)]
+
+    def baseline(self, counters, boot_time):
+        """Take the current counters as the starting point of a fresh account."""
+        with self.lock:
+            self.counters = {name: [counters[name].bytes_sent, counters[name].bytes_recv]
+                             for name in self._included(counters)}
+            self.boot_time = boot_time
+
+    def set_cycle_day(self, cycle_day):
+        with self.lock:
+            if cycle_day != self.cycle_day:
+                self.cycle_day = cycle_day
+                self._recompute_cycle(date.today())
+
+    def _recompute_cycle(self, today):
+        # Only when the cycle changes; every tick just adds to the aggregate
+        start = cycle_start(today, self.cycle_day).isoformat()
+        sent = recv = 0
+        for day, (day_sent, day_recv) in self.days.items():
+            if day >= start:
+                sent += day_sent
+                recv += day_recv
+        self.cycle = {'start': start, 'sent': sent, 'recv': recv}
+
+    def _roll_day(self, now):
+        today = datetime.fromtimestamp(now)
+        self.today = today.strftime('%Y-%m-%d')
+        self.next_midnight = (today.replace(hour=0, minute=0, second=0, microsecond=0)
+                              + timedelta(days=1)).timestamp()
+        if self.cycle['start'] != cycle_start(today.date(), self.cycle_day).isoformat():
+            self._recompute_cycle(today.date())
+        if len(self.days) > DAYS_KEPT:
+            for day in sorted(self.days)[:-DAYS_KEPT]:
+                del self.days[day]
+        if len(self.months) > MONTHS_KEPT:
+            for month in sorted(self.months)[:-MONTHS_KEPT]:
+                del self.months[month]
+
+    def update(self, counters, boot_time, now):
+        """Account the per-interface counters of one sampler tick."""
+        with self.lock:
+            rebooted = self.boot_time is not None and abs(boot_time - self.boot_time) > 1
+            self.boot_time = boot_time
+            sent = recv = 0
+            current = {}
+            for name in self._included(counters):
+                counter = counters[name]
+                current[name] = [counter.bytes_sent, counter.bytes_recv]
+                previous = None if rebooted else self.counters.get(name)
+                if previous is None:
+                    # New interface, or first tick after a reboot: all of it is new
+                    sent += counter.bytes_sent
+                    recv += counter.bytes_recv
+                    continue
+                sent += counter.bytes_sent - previous[0] if counter.bytes_sent >= previous[0] else counter.bytes_sent
+                recv += counter.bytes_recv - previous[1] if counter.bytes_recv >= previous[1] else counter.bytes_recv
+            self.counters = current
+
+            if now >= self.next_midnight:
+                self._roll_day(now)
+            self.total_sent += sent
+            self.total_recv += recv
+            for bucket in (self.days.setdefault(self.today, [0, 0]),
+                           self.months.setdefault(self.today[:7], [0, 0])):
+                bucket[0] += sent
+                bucket[1] += recv
+            self.cycle['sent'] += sent
+            self.cycle['recv'] += recv
+
+    def totals(self):
+        with self.lock:
+            return self.total_sent, self.total_recv
+
+    def cycle_usage(self):
+        """(first day of the cycle, bytes sent, bytes received) so far."""
+        with self.lock:
+            return self.cycle['start'], self.cycle['sent'], self.cycle['recv']
+
+    def per_day(self, count):
+        with self.lock:
+            days = sorted(self.days.items())[-count:]
+        return [{'date': day, 'sent': sent, 'recv': recv} for day, (sent, recv) in days]
+
+    def per_month(self, count):
+        with self.lock:
+            months = sorted(self.months.items())[-count:]
+        return [{'month': month, 'sent': sent, 'recv': recv} for month, (sent, recv) in months]
@@ -0,0 +1,345 @@
+"""Alert rules evaluated on every sampler tick, and their delivery.
+
+alerts.json:
+
+    {"rules": [{"name": "cpu-hot", "metric": "cpu_usage", "type": "threshold", "op": ">", "value": 90, "for": 300},
+               {"name": "memory-trend", "metric": "memory_usage", "type": "ewma", "window": 600, "op": ">", "value": 85}],
+     "sinks": [{"type": "log", "path": "alerts.log"},
+               {"type": "webhook", "url": "http://alerts.example/hook", "headers": {"Authorization": "..."}}],
+     "repeat": 3600}
+
+A rule watches one numeric field of the sample. What it compares with
+`value` depends on its `type`:
+
+- `threshold`: the latest value.
+- `rate`: the change per second over the last `window` seconds.
+- `ewma`: an exponentially weighted moving average with a time constant of
+  `window` seconds.
+- `percentile`: the `percentile`th percentile (default 95) over the last
+  `window` seconds, read from a histogram of `bins` buckets over `range`
+  (default [0, 100], the range of the percentages).
+
+With `for`, the condition has to hold for that many seconds before the
+rule fires. Every aggregate is updated in constant time per tick, amortised
+over the points leaving the window, so the cost does not grow with the
+window or the history.
+
+A rule notifies when it starts firing, when it resolves, and every `repeat`
+seconds while it keeps firing (0 never repeats). Every sink has its own
+bounded queue, flushed in batches by deliver(); a batch that fails stays
+at the head of its queue and is retried with exponential backoff, so a
+webhook that is down delays neither the sampler nor the other sinks.
+"""
+import json
+import logging
+import math
+import operator
+import threading
+import time
+import urllib.request
+from collections import deque
+
+DEFAULT_LOG = 'alerts.log'
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+
+class Threshold:
+    def __init__(self, config):
+        pass
+
+    def update(self, value, now):
+        return value
+
+
+class RateOfChange:
+    def __init__(self, config):
+        self.window = config['window']
+        self.points = deque()  # (time, value) inside the window
+
+    def update(self, value, now):
+        points = self.points
+        points.append((now, value))
+        while now - points[0][0] > self.window:
+            points.popleft()
+        start, first = points[0]
+        return (value - first) / (now - start) if now > start else None
+
+
+class EWMA:
+    def __init__(self, config):
+        self.window = config['window']
+        self.average = None
+        self.time = None
+
+    def update(self, value, now):
+        if self.average is None:
+            self.average = value
+        elif now > self.time:
+            # Weighted by the time since the previous point, so late ticks count fully
+            self.average += (1 - math.exp(-(now - self.time) / self.window)) * (value - self.average)
+        self.time = now
+        return self.average
+
+
+class WindowPercentile:
+    def __init__(self, config):
+        self.window = config['window']
+        self.fraction = config.get('percentile', 95) / 100
+        self.low, high = config.get('range', (0, 100))
+        self.bins = config.get('bins', 100)
+        self.width = (high - self.low) / self.bins
+        self.counts = [0] * self.bins
+        self.points = deque()  # (time, bin) inside the window
+
+    def update(self, value, now):
+        index = min(max(int((value - self.low) / self.width), 0), self.bins - 1)
+        self.counts[index] += 1
+        self.points.append((now, index))
+        while now - self.points[0][0] > self.window:
+            self.counts[self.points.popleft()[1]] -= 1
+        rank = self.fraction * len(self.points)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.low + (index + 1) * self.width  # upper bound of the bucket
+
+
+CONDITIONS = {'threshold': Threshold, 'rate': RateOfChange, 'ewma': EWMA, 'percentile': WindowPercentile}
+WINDOWED = ('rate', 'ewma', 'percentile')
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_rule(config):
+    """Raise ValueError if `config` is not a usable rule."""
+    if not isinstance(config, dict) or not isinstance(config.get('name'), str) or not config['name']:
+        raise ValueError(f"rule without a name: {config!r}")
+    name = config['name']
+    if not isinstance(config.get('metric'), str):
+        raise ValueError(f"rule '{name}' has no metric")
+    if config.get('type', 'threshold') not in CONDITIONS:
+        raise ValueError(f"rule '{name}' has an unknown type {config.get('type')!r}")
+    if config.get('op', '>') not in OPERATORS:
+        raise ValueError(f"rule '{name}' has an unknown op {config.get('op')!r}")
+    if not _number(config.get('value')):
+        raise ValueError(f"rule '{name}' has no numeric value")
+    if not _number(config.get('for', 0)) or config.get('for', 0) < 0:
+        raise ValueError(f"rule '{name}' has an invalid 'for'")
+    if config.get('type', 'threshold') in WINDOWED and (not _number(config.get('window')) or config['window'] <= 0):
+        raise ValueError(f"rule '{name}' needs a positive window")
+    if config.get('type') == 'percentile':
+        low, high = config.get('range', (0, 100))
+        if not (_number(low) and _number(high) and low < high):
+            raise ValueError(f"rule '{name}' has an invalid range")
+        if not isinstance(config.get('bins', 100), int) or config.get('bins', 100) < 1:
+            raise ValueError(f"rule '{name}' has an invalid bins")
+        if not 0 < config.get('percentile', 95) <= 100:
+            raise ValueError(f"rule '{name}' has an invalid percentile")
+
+
+class Rule:
+    def __init__(self, config):
+        validate_rule(config)
+        self.config = config
+        self.name = config['name']
+        self.metric = config['metric']
+        self.compare = OPERATORS[config.get('op', '>')]
+        self.threshold = config['value']
+        self.hold = config.get('for', 0)
+        self.condition = CONDITIONS[config.get('type', 'threshold')](config)
+        self.observed = None
+        self.matching_since = None  # when the condition last became true
+        self.firing = False
+        self.notified = None  # when the last notification about it was queued
+
+    def evaluate(self, value, now, repeat):
+        """The notification this value calls for, if any."""
+        observed = self.observed = self.condition.update(value, now)
+        if observed is None or not self.compare(observed, self.threshold):
+            self.matching_since = None
+            if self.firing:
+                self.firing = False
+                self.notified = now
+                return self._event('resolved', now)
+            return None
+        if self.matching_since is None:
+            self.matching_since = now
+        if not self.firing:
+            if now - self.matching_since >= self.hold:
+                self.firing = True
+                self.notified = now
+                return self._event('firing', now)
+        elif repeat and now - self.notified >= repeat:
+            self.notified = now
+            return self._event('firing', now, repeated=True)
+        return None
+
+    def _event(self, state, now, repeated=False):
+        return {
+            'rule': self.name,
+            'state': state,
+            'metric': self.metric,
+            'type': self.config.get('type', 'threshold'),
+            'observed': round(self.observed, 3) if self.observed is not None else None,
+            'op': self.config.get('op', '>'),
+            'value': self.threshold,
+            'since': self.matching_since,
+            'time': now,
+            'repeated': repeated,
+        }
+
+    def status(self):
+        return {'rule': self.name, 'metric': self.metric, 'firing': self.firing,
+                'observed': round(self.observed, 3) if self.observed is not None else None,
+                'since': self.matching_since}
+
+
+class LogSink:
+    """Appends one JSON line per notification."""
+
+    def __init__(self, config):
+        self.path = config.get('path', DEFAULT_LOG)
+
+    def send(self, batch):
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in batch))
+
+
+class WebhookSink:
+    """POSTs {"alerts": [...]} with every batch; any error or non-2xx status is retried."""
+
+    def __init__(self, config):
+        if not isinstance(config.get('url'), str):
+            raise ValueError("webhook sink without a url")
+        self.url = config['url']
+        self.timeout = config.get('timeout', 5)
+        self.headers = {'Content-Type': 'application/json', **config.get('headers', {})}
+
+    def send(self, batch):
+        body = json.dumps({'alerts': batch}).encode()
+        request = urllib.request.Request(self.url, body, self.headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+SINKS = {'log': LogSink, 'webhook': WebhookSink}
+
+
+class DeliveryQueue:
+    """Notifications waiting for one sink."""
+
+    def __init__(self, sink, batch_size=100, max_pending=1000, retries=8, backoff=5, max_backoff=300):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.failures = 0
+        self.retry_at = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def put(self, event):
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()  # the oldest matters least
+                self.dropped += 1
+            self.pending.append(event)
+
+    def flush(self, now):
+        """Send the pending notifications in batches until one fails."""
+        if now < self.retry_at:
+            return
+        while True:
+            with self.lock:
+                batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            if not batch:
+                return
+            try:
+                self.sink.send(batch)
+            except Exception as e:
+                self.failures += 1
+                if self.failures > self.retries:
+                    logging.error(f"Dropping {len(batch)} alert notifications after {self.retries} retries: {str(e)}")
+                    self.dropped += len(batch)
+                    self.failures = 0
+                    continue
+                with self.lock:
+                    self.pending.extendleft(reversed(batch))  # back at the head, order kept
+                self.retry_at = now + min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+                logging.warning(f"Alert delivery failed ({str(e)}), retrying in {self.retry_at - now:.0f} s")
+                return
+            self.failures = 0
+            self.delivered += len(batch)
+
+    def status(self):
+        with self.lock:
+            return {'pending': len(self.pending), 'delivered': self.delivered, 'dropped': self.dropped,
+                    'failures': self.failures}
+
+
+class AlertEngine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = []
+        self.queues = {}  # json of the sink config -> DeliveryQueue
+        self.repeat = 0
+
+    def configure(self, config):
+        """Apply alerts.json; rules and sinks whose config did not change keep their state."""
+        config = config if isinstance(config, dict) else {}
+        with self.lock:
+            previous = {json.dumps(rule.config, sort_keys=True): rule for rule in self.rules}
+            rules = []
+            for rule_config in config.get('rules', []):
+                key = json.dumps(rule_config, sort_keys=True)
+                try:
+                    rules.append(previous.get(key) or Rule(rule_config))
+                except (ValueError, TypeError, KeyError) as e:
+                    logging.error(f"Ignoring alert rule: {str(e)}")
+            queues = {}
+            for sink_config in config.get('sinks', [{'type': 'log'}] if rules else []):
+                key = json.dumps(sink_config, sort_keys=True)
+                try:
+                    queues[key] = self.queues.get(key) or DeliveryQueue(SINKS[sink_config['type']](sink_config))
+                except (ValueError, TypeError, KeyError) as e:
+                    logging.error(f"Ignoring alert sink {sink_config!r}: {str(e)}")
+            self.rules, self.queues = rules, queues
+            self.repeat = config.get('repeat', 3600)
+
+    def evaluate(self, sample):
+        """Feed one sample to every rule; returns the names of the firing rules."""
+        now = sample['timestamp']
+        events = []
+        with self.lock:
+            for rule in self.rules:
+                value = sample.get(rule.metric)
+                if not _number(value):
+                    continue
+                event = rule.evaluate(value, now, self.repeat)
+                if event is not None:
+                    events.append(event)
+            firing = [rule.name for rule in self.rules if rule.firing]
+            queues = list(self.queues.values())
+        for event in events:
+            for queue in queues:
+                queue.put(event)
+        return firing
+
+    def deliver(self, now=None):
+        with self.lock:
+            queues = list(self.queues.values())
+        now = time.time() if now is None else now
+        for queue in queues:
+            queue.flush(now)
+
+    def status(self):
+        with self.lock:
+            return {'rules': [rule.status() for rule in self.rules],
+                    'sinks': [{'type': type(queue.sink).__name__, **queue.status()} for queue in self.queues.values()]}
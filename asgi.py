@@ -0,0 +1,221 @@
+"""ASGI entry point: `python asgi.py`, or `uvicorn asgi:app` behind another server.
+
+/data and /stream are answered on the event loop, so an idle dashboard costs
+one socket and a small coroutine instead of a server thread. psutil is never
+called on the loop: the sampler keeps running on the scheduler threads and
+publishes into server_monitor as usual. Every other route, /history included,
+is the Flask view run on a bounded thread pool, so a slow query or scan waits
+for a pool thread instead of stalling the loop or spawning threads.
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import server_monitor as monitor
+
+EXECUTOR_WORKERS = 8
+MAX_STREAM_CLIENTS = 10000  # idle streams are cheap here, unlike one thread each under Flask
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix='asgi')
+stream_clients = 0
+
+
+class SampleBroadcast:
+    """Wakes every stream waiting on the event loop when a sample is published.
+
+    Registered as a server_monitor sample listener, so the sampler thread
+    does one call_soon_threadsafe() per sample however many streams are open.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.event = None
+
+    def bind(self, loop):
+        if self.loop is not loop:
+            self.loop = loop
+            self.event = asyncio.Event()
+
+    def _notify(self):
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+    def __call__(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._notify)
+
+
+broadcast = SampleBroadcast()
+monitor.sample_listeners.append(broadcast)
+
+
+async def respond(send, status, body, content_type='application/json', headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode()),
+                            (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def data(send):
+    started = time.perf_counter()
+    with monitor.sample_lock:
+        payload = monitor.latest_payload
+    await respond(send, 200, payload)
+    monitor.timings.observe('endpoint./data', time.perf_counter() - started)
+
+
+async def stream(receive, send, interval):
+    """The asyncio twin of server_monitor.stream_samples()."""
+    global stream_clients
+    if stream_clients >= MAX_STREAM_CLIENTS:
+        await respond(send, 503, b'{"error":"Too many streams","success":false}')
+        return
+    stream_clients += 1
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': f'retry: {int(interval * 1000)}\n\n'.encode(),
+                    'more_body': True})
+        last_seq = None
+        while not disconnected.done():
+            event = broadcast.event
+            with monitor.sample_lock:
+                seq, frame = monitor.sample_seq, monitor.latest_event
+            if seq == last_seq:
+                published = asyncio.ensure_future(event.wait())
+                done, _ = await asyncio.wait((disconnected, published), timeout=monitor.STREAM_KEEPALIVE,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                published.cancel()
+                if not done:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+            last_seq = seq
+            sent_at = time.monotonic()
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+            # Wake up half a tick before the deadline, then wait for a fresh sample
+            delay = sent_at + interval - monitor.SAMPLE_INTERVAL / 2 - time.monotonic()
+            if delay > 0:
+                await asyncio.wait((disconnected,), timeout=delay)
+                with monitor.sample_lock:
+                    last_seq = monitor.sample_seq
+    except OSError:
+        pass  # the client went away mid-write
+    finally:
+        stream_clients -= 1
+        disconnected.cancel()
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def run_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    result = monitor.app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+async def call_flask(scope, receive, send):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    loop = asyncio.get_running_loop()
+    status, headers, body = await loop.run_in_executor(executor, run_wsgi, wsgi_environ(scope, bytes(body)))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            broadcast.bind(asyncio.get_running_loop())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    broadcast.bind(asyncio.get_running_loop())
+    path, method = scope['path'], scope['method']
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    if path == '/data' and method == 'GET' and query.get('format', ['json']) == ['json']:
+        await data(send)
+    elif path == '/stream' and method == 'GET':
+        try:
+            interval = float(query.get('interval', [monitor.SAMPLE_INTERVAL])[0])
+        except ValueError:
+            interval = monitor.SAMPLE_INTERVAL
+        interval = min(max(interval, monitor.SAMPLE_INTERVAL), monitor.MAX_STREAM_INTERVAL)
+        await stream(receive, send, interval)
+    else:
+        await call_flask(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    monitor.prepare()
+    listener = monitor.listen('0.0.0.0', int(os.environ.get('PORT', 5000)), backlog=2048)
+    try:
+        uvicorn.run(app, fd=listener.fileno(), log_level='warning', access_log=False,
+                    timeout_keep_alive=30, backlog=2048)
+    finally:
+        executor.shutdown(wait=False)
+        monitor.save_traffic_data()
@@ -0,0 +1,550 @@
+"""Benchmarks of the monitor, run against a private instance.
+
+    python benchmark.py connections --streams 10,100,1000 [--json]
+    python benchmark.py load --dashboards 50 --duration 20 [--stub-psutil] [--output run.json] [--compare old.json]
+    python benchmark.py collectors --ticks 2000 [--json]
+
+`connections` compares the Flask and the ASGI serving modes: it holds N
+idle /stream connections open, the way N open dashboards would, and
+meanwhile measures /data latency and the server's threads and RSS.
+
+`load` first times the sampler tick, save_traffic_data(), /login, / and
+/data in-process, then starts a server and drives N simulated dashboards
+against it for `duration` seconds: each loads the page and its history once,
+then polls /data every second and /processes every five. It reports p50/p99
+latency and throughput per endpoint and the server's CPU use, and saves
+everything as JSON so runs of two versions on the same machine can be
+compared with --compare.
+
+Every server runs from a temporary directory with its own sec.json, so a
+monitor already running from this directory is never touched.
+`--stub-psutil` replaces the system counters with synthetic ones, so the
+numbers measure the monitor rather than the machine's /proc.
+
+`collectors` times one read of every system counter the sampler uses, as
+done each tick, with the /proc backend and with psutil.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from collections import namedtuple
+from contextlib import contextmanager
+
+from hub import AsyncHTTPClient
+
+MODES = {'flask': 'server_monitor.py', 'asgi': 'asgi.py'}
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_USERNAME = BENCH_PASSWORD = 'bench'
+
+Counters = namedtuple('Counters', 'bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout')
+DiskCounters = namedtuple('DiskCounters', 'read_count write_count read_bytes write_bytes read_time write_time')
+CPUStats = namedtuple('CPUStats', 'ctx_switches interrupts soft_interrupts syscalls')
+CPUTimes = namedtuple('CPUTimes', 'user nice system idle iowait irq softirq steal guest guest_nice')
+Memory = namedtuple('Memory', 'total available percent used free')
+Disk = namedtuple('Disk', 'total used free percent')
+
+
+class StubPsutil(types.ModuleType):
+    """psutil with synthetic system counters growing at fixed rates.
+
+    Only the calls made by the sampler are replaced; the process table is
+    reduced to the benchmark's own process and everything else is the real
+    psutil.
+    """
+
+    NICS = ('eth0', 'eth1', 'lo')
+    DISKS = ('sda', 'sdb', 'nvme0n1')
+    CORES = 8
+
+    def __init__(self, real):
+        super().__init__('psutil')
+        self.real = real
+        self.started = time.time() - 3600
+
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+    def _elapsed(self):
+        return time.time() - self.started
+
+    def net_io_counters(self, pernic=False, nowrap=True):
+        elapsed = self._elapsed()
+        nics = {name: Counters(int(elapsed * 1e6 * (index + 1)), int(elapsed * 4e6 * (index + 1)),
+                               int(elapsed * 900), int(elapsed * 3000), 0, 0, 0, 0)
+                for index, name in enumerate(self.NICS)}
+        if pernic:
+            return nics
+        return Counters(*(sum(values) for values in zip(*nics.values())))
+
+    def disk_io_counters(self, perdisk=False, nowrap=True):
+        elapsed = self._elapsed()
+        disks = {name: DiskCounters(int(elapsed * 50), int(elapsed * 80), int(elapsed * 2e6 * (index + 1)),
+                                    int(elapsed * 3e6 * (index + 1)), 0, 0)
+                 for index, name in enumerate(self.DISKS)}
+        if perdisk:
+            return disks
+        return DiskCounters(*(sum(values) for values in zip(*disks.values())))
+
+    def cpu_stats(self):
+        return CPUStats(int(self._elapsed() * 20000), 0, 0, 0)
+
+    def cpu_count(self, logical=True):
+        return self.CORES if logical else self.CORES // 2
+
+    def cpu_percent(self, interval=None, percpu=False):
+        return [12.5] * self.CORES if percpu else 12.5
+
+    def cpu_times_percent(self, interval=None, percpu=False):
+        return CPUTimes(8.0, 0.0, 3.0, 87.5, 1.0, 0.0, 0.5, 0.0, 0.0, 0.0)
+
+    def getloadavg(self):
+        return 0.5, 0.4, 0.3
+
+    def virtual_memory(self):
+        return Memory(16 * 1024 ** 3, 10 * 1024 ** 3, 37.5, 6 * 1024 ** 3, 10 * 1024 ** 3)
+
+    def disk_usage(self, path):
+        return Disk(500 * 1024 ** 3, 200 * 1024 ** 3, 300 * 1024 ** 3, 40.0)
+
+    def boot_time(self):
+        return self.started
+
+    def pids(self):
+        return [os.getpid()]
+
+
+def install_stub():
+    import psutil
+    sys.modules['psutil'] = StubPsutil(psutil)
+    os.environ['MONITOR_COLLECTOR'] = 'psutil'  # the /proc backend would bypass the stub
+
+
+@contextmanager
+def workdir():
+    """A throw-away install directory with benchmark credentials."""
+    path = tempfile.mkdtemp(prefix='aseman-bench-')
+    with open(os.path.join(path, 'sec.json'), 'w') as f:
+        json.dump({'username': BENCH_USERNAME, 'password': BENCH_PASSWORD}, f)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+        # Shared-memory segments are named after the install directory, and
+        # port claims hold it (the servers have exited by now)
+        digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+        owners = {os.path.abspath(path), os.path.realpath(path)}
+        for directory in {'/dev/shm', tempfile.gettempdir()}:
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    file_path = os.path.join(directory, name)
+                    if name.startswith('aseman-monitor-port-'):
+                        try:
+                            with open(file_path, 'r') as f:
+                                if f.read() in owners:
+                                    os.remove(file_path)
+                        except OSError:
+                            pass  # another user's claim, or removed meanwhile
+                    elif name.startswith('aseman-monitor') and name.endswith(digest):
+                        os.remove(file_path)
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def process_status(pid):
+    """Threads and RSS in MB of `pid`, from /proc."""
+    status = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            status[key] = value.split()
+    return {'threads': int(status['Threads'][0]), 'rss_mb': round(int(status['VmRSS'][0]) / 1024, 1)}
+
+
+def process_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+
+def summarize(samples):
+    return {'count': len(samples), 'p50_ms': percentile(samples, 0.5), 'p99_ms': percentile(samples, 0.99)}
+
+
+@contextmanager
+def running_server(mode, directory, stub):
+    port = free_port()
+    command = [sys.executable, os.path.join(HERE, 'benchmark.py'), '_serve', mode]
+    if stub:
+        command.append('--stub-psutil')
+    server = subprocess.Popen(command, cwd=directory, env={**os.environ, 'PORT': str(port)},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        yield server, port
+    finally:
+        server.terminate()
+        server.wait(10)
+
+
+async def wait_ready(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _, body = await client.request('GET', url + '/data', timeout=2)
+            if status == 200 and body:
+                return
+        except (OSError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+
+# ---- connections: idle streams held open while /data is measured ----
+
+async def open_stream(port, results):
+    """Open one SSE connection and keep reading it until cancelled."""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 10)
+    except (OSError, asyncio.TimeoutError):
+        results['failed'] += 1
+        return
+    try:
+        writer.write(b'GET /stream HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n')
+        status_line = await asyncio.wait_for(reader.readline(), 10)
+        if b' 200 ' not in status_line:
+            results['rejected'] += 1
+            return
+        results['accepted'] += 1
+        while await reader.read(65536):
+            pass
+    except (OSError, asyncio.TimeoutError):
+        results['failed'] += 1
+    finally:
+        writer.close()
+
+
+async def measure_data(client, url, count, concurrency):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                status, _, _ = await client.request('GET', url + '/data', timeout=10)
+                if status != 200:
+                    raise OSError(status)
+                latencies.append((time.perf_counter() - started) * 1000)
+            except (OSError, asyncio.TimeoutError):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - started
+    return {'p50_ms': percentile(latencies, 0.5), 'p99_ms': percentile(latencies, 0.99),
+            'requests_per_s': round(len(latencies) / elapsed, 1), 'errors': errors}
+
+
+async def bench_level(pid, port, streams, requests, concurrency):
+    url = f'http://127.0.0.1:{port}'
+    results = {'accepted': 0, 'rejected': 0, 'failed': 0}
+    tasks = [asyncio.ensure_future(open_stream(port, results)) for _ in range(streams)]
+    await asyncio.sleep(2 + streams / 500)  # let the connections settle
+    client = AsyncHTTPClient(max_idle_per_host=concurrency)
+    row = {'streams': streams, **results, **await measure_data(client, url, requests, concurrency),
+           **process_status(pid)}
+    client.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.sleep(1)
+    return row
+
+
+async def bench_mode(mode, levels, requests, concurrency, stub):
+    with workdir() as directory, running_server(mode, directory, stub) as (server, port):
+        client = AsyncHTTPClient()
+        await wait_ready(client, f'http://127.0.0.1:{port}')
+        client.close()
+        return [{'mode': mode, **await bench_level(server.pid, port, streams, requests, concurrency)}
+                for streams in levels]
+
+
+def print_table(rows, columns):
+    print(''.join(f'{column:>15}' for column in columns))
+    for row in rows:
+        print(''.join(f'{row[column]:>15.2f}' if isinstance(row[column], float) else f'{str(row[column]):>15}'
+                      for column in columns))
+
+
+def run_connections(args):
+    rows = []
+    for mode in args.modes.split(','):
+        rows += asyncio.run(bench_mode(mode, [int(level) for level in args.streams.split(',')],
+                                       args.requests, args.concurrency, args.stub_psutil))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print_table(rows, ('mode', 'streams', 'accepted', 'rejected', 'failed', 'p50_ms', 'p99_ms',
+                       'requests_per_s', 'errors', 'threads', 'rss_mb'))
+
+
+# ---- collectors: the per-tick cost of each system counter backend ----
+
+def run_collectors(args):
+    sys.path.insert(0, HERE)
+    import collectors
+
+    rows = []
+    for name in args.backends.split(','):
+        try:
+            collector = collectors.BACKENDS[name]()
+        except OSError as e:
+            print(f'{name}: unavailable ({e})', file=sys.stderr)
+            continue
+        for _ in range(args.ticks // 10):  # warm up
+            collector.read()
+        wall, cpu = [], []
+        for _ in range(args.ticks):
+            started, started_cpu = time.perf_counter(), time.thread_time()
+            collector.read()
+            cpu.append((time.thread_time() - started_cpu) * 1000)
+            wall.append((time.perf_counter() - started) * 1000)
+        rows.append({'backend': name, **summarize(wall), 'mean_ms': round(sum(wall) / len(wall), 4),
+                     'cpu_p50_ms': percentile(cpu, 0.5), 'cpu_p99_ms': percentile(cpu, 0.99)})
+    if len(rows) > 1:
+        baseline = rows[-1]['mean_ms']
+        for row in rows:
+            row['speedup'] = round(baseline / row['mean_ms'], 2)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print_table(rows, ('backend', 'count', 'mean_ms', 'p50_ms', 'p99_ms', 'cpu_p50_ms', 'cpu_p99_ms',
+                       *(('speedup',) if len(rows) > 1 else ())))
+
+
+# ---- load: in-process timings, then simulated dashboards ----
+
+def run_micro(args):
+    """Runs inside the temporary install directory; prints its results as JSON."""
+    if args.stub_psutil:
+        install_stub()
+    sys.path.insert(0, HERE)
+    import server_monitor as monitor
+    monitor.scheduler.pause()  # keep the background jobs out of the timings
+    monitor.limiter.enabled = False
+
+    def timed(function, count, pause=0.0):
+        wall, cpu = [], []
+        for _ in range(count):
+            started, started_cpu = time.perf_counter(), time.thread_time()
+            function()
+            cpu.append((time.thread_time() - started_cpu) * 1000)
+            wall.append((time.perf_counter() - started) * 1000)
+            time.sleep(pause)
+        return {**summarize(wall), 'cpu_p50_ms': percentile(cpu, 0.5), 'cpu_p99_ms': percentile(cpu, 0.99)}
+
+    client = monitor.app.test_client()
+    credentials = {'username': BENCH_USERNAME, 'password': BENCH_PASSWORD}
+    results = {
+        # Ticks closer than MIN_RATE_WINDOW would skip the rate computation
+        'sampler_tick': timed(monitor.collect_sample, args.ticks, pause=monitor.MIN_RATE_WINDOW),
+        'save_traffic_data': timed(monitor.save_traffic_data, 20),
+        'login': timed(lambda: client.post('/login', json=credentials), 10),
+        'index': timed(lambda: client.get('/', headers={'Accept-Encoding': 'gzip'}), 200),
+        'data': timed(lambda: client.get('/data'), 1000),
+    }
+    print(json.dumps(results))
+
+
+async def dashboard(url, client, deadline, poll_interval, latencies, errors):
+    async def get(endpoint, path, headers=None):
+        started = time.perf_counter()
+        try:
+            status, _, _ = await client.request('GET', url + path, headers=headers, timeout=10)
+            if status != 200:
+                raise OSError(status)
+            latencies[endpoint].append((time.perf_counter() - started) * 1000)
+        except (OSError, asyncio.TimeoutError):
+            errors[endpoint] = errors.get(endpoint, 0) + 1
+
+    await get('/', '/', {'Accept-Encoding': 'gzip, br'})
+    await get('/history', f'/history?since={time.time() - 60}&format=f32')
+    tick = 0
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        await get('/data', '/data')
+        if tick % 5 == 0:
+            await get('/processes', '/processes')
+        tick += 1
+        await asyncio.sleep(max(0.0, poll_interval - (time.monotonic() - started)))
+
+
+async def drive_dashboards(server, port, args):
+    url = f'http://127.0.0.1:{port}'
+    client = AsyncHTTPClient(max_idle_per_host=args.dashboards)
+    await wait_ready(client, url)
+    latencies = {endpoint: [] for endpoint in ('/', '/history', '/data', '/processes')}
+    errors = {}
+    cpu_before, started = process_cpu_seconds(server.pid), time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(dashboard(url, client, deadline, args.poll_interval, latencies, errors)
+                           for _ in range(args.dashboards)))
+    elapsed = time.monotonic() - started
+    cpu = process_cpu_seconds(server.pid) - cpu_before
+    client.close()
+    return {
+        'endpoints': {endpoint: {**summarize(values), 'errors': errors.get(endpoint, 0),
+                                 'requests_per_s': round(len(values) / elapsed, 1)}
+                      for endpoint, values in latencies.items()},
+        'requests_per_s': round(sum(map(len, latencies.values())) / elapsed, 1),
+        'server_cpu_percent': round(100 * cpu / elapsed, 1),
+        **process_status(server.pid),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=HERE, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(current, previous):
+    """Print the relative change of every latency between two result files."""
+    def flatten(results):
+        rows = {f'micro {name}': values for name, values in results['micro'].items()}
+        rows.update({f'load {name}': values for name, values in results['load']['endpoints'].items()})
+        return rows
+
+    old_rows = flatten(previous)
+    print(f"\nCompared with {previous.get('revision')} ({previous.get('timestamp')}):")
+    for name, values in flatten(current).items():
+        old = old_rows.get(name)
+        if old is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms'):
+            if values.get(key) and old.get(key):
+                changes.append(f'{key} {(values[key] - old[key]) / old[key] * 100:+.1f}%')
+        print(f'  {name:<24} {"  ".join(changes)}')
+
+
+def run_load(args):
+    with workdir() as directory:
+        command = [sys.executable, os.path.join(HERE, 'benchmark.py'), '_micro', '--ticks', str(args.ticks)]
+        if args.stub_psutil:
+            command.append('--stub-psutil')
+        micro = subprocess.run(command, cwd=directory, capture_output=True, text=True, check=True)
+        micro = json.loads(micro.stdout.strip().splitlines()[-1])
+
+    with workdir() as directory, running_server(args.mode, directory, args.stub_psutil) as (server, port):
+        load = asyncio.run(drive_dashboards(server, port, args))
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': f'{platform.machine()} {os.cpu_count()} CPUs',
+        'config': {'mode': args.mode, 'dashboards': args.dashboards, 'duration': args.duration,
+                   'poll_interval': args.poll_interval, 'stub_psutil': args.stub_psutil},
+        'micro': micro,
+        'load': load,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print_table([{'name': name, **values} for name, values in micro.items()],
+                ('name', 'count', 'p50_ms', 'p99_ms', 'cpu_p50_ms', 'cpu_p99_ms'))
+    print()
+    print_table([{'endpoint': name, **values} for name, values in load['endpoints'].items()],
+                ('endpoint', 'count', 'errors', 'p50_ms', 'p99_ms', 'requests_per_s'))
+    print(f"\n{load['requests_per_s']} requests/s, server CPU {load['server_cpu_percent']}%, "
+          f"{load['threads']} threads, {load['rss_mb']} MB RSS")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+def run_serve(args):
+    """Runs inside the temporary install directory as the server under test."""
+    import runpy
+    if args.stub_psutil:
+        install_stub()
+    sys.path.insert(0, HERE)
+    sys.argv = [os.path.join(HERE, MODES[args.mode])]
+    runpy.run_path(sys.argv[0], run_name='__main__')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    connections = commands.add_parser('connections', help='compare the Flask and ASGI modes under idle streams')
+    connections.add_argument('--modes', default='flask,asgi')
+    connections.add_argument('--streams', default='10,100,1000', help='idle /stream connections per level')
+    connections.add_argument('--requests', type=int, default=200, help='/data requests measured per level')
+    connections.add_argument('--concurrency', type=int, default=16, help='/data requests in flight at once')
+    connections.add_argument('--stub-psutil', action='store_true')
+    connections.add_argument('--json', action='store_true', help='print the results as JSON')
+    connections.set_defaults(run=run_connections)
+
+    load = commands.add_parser('load', help='time the hot paths and drive simulated dashboards')
+    load.add_argument('--mode', choices=sorted(MODES), default='flask')
+    load.add_argument('--dashboards', type=int, default=50)
+    load.add_argument('--duration', type=float, default=20, help='seconds of simulated load')
+    load.add_argument('--poll-interval', type=float, default=1.0, help='seconds between two /data polls')
+    load.add_argument('--ticks', type=int, default=40, help='sampler ticks timed in-process')
+    load.add_argument('--stub-psutil', action='store_true')
+    load.add_argument('--output', help='save the results to this JSON file')
+    load.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    load.set_defaults(run=run_load)
+
+    backends = commands.add_parser('collectors', help='compare the per-tick cost of the /proc and psutil collectors')
+    backends.add_argument('--backends', default='proc,psutil', help='the last one is the baseline of the speedup')
+    backends.add_argument('--ticks', type=int, default=2000)
+    backends.add_argument('--json', action='store_true', help='print the results as JSON')
+    backends.set_defaults(run=run_collectors)
+
+    micro = commands.add_parser('_micro')
+    micro.add_argument('--ticks', type=int, default=40)
+    micro.add_argument('--stub-psutil', action='store_true')
+    micro.set_defaults(run=run_micro)
+
+    serve = commands.add_parser('_serve')
+    serve.add_argument('mode', choices=sorted(MODES))
+    serve.add_argument('--stub-psutil', action='store_true')
+    serve.set_defaults(run=run_serve)
+
+    args = parser.parse_args()
+    if args.command is None:
+        args = parser.parse_args(['connections', *sys.argv[1:]])
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
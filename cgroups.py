@@ -0,0 +1,282 @@
+"""Per-cgroup CPU, memory and I/O from the cgroup v2 hierarchy.
+
+Systemd units (slices, services, scopes) and containers are cgroups under
+/sys/fs/cgroup. The list of those to read is an index built by walking the
+tree, and walked again only when inotify reports a directory created or
+removed below it; every tick then costs three pread() calls per cgroup on
+files kept open: cpu.stat (usage_usec), memory.current and io.stat (rbytes
+and wbytes summed over the devices). Without inotify the index is rebuilt
+every POLL_REBUILD_INTERVAL seconds instead.
+
+Counters are returned as they are; the caller diffs them into rates.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import resource
+import time
+from collections import namedtuple
+
+CgroupCounters = namedtuple('CgroupCounters', 'usage_usec read_bytes write_bytes')
+
+# Systemd units, and containers of the Docker cgroupfs driver (named by their id)
+DEFAULT_INCLUDE = re.compile(r'\.(slice|service|scope)$|^[0-9a-f]{64}$')
+MAX_DEPTH = 6
+MAX_CGROUPS = 2000
+POLL_REBUILD_INTERVAL = 30  # seconds, when inotify is unavailable
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR
+
+
+def find_cgroup2_root(mountpoint='/sys/fs/cgroup'):
+    """The cgroup v2 hierarchy: the mountpoint itself, or its 'unified' part on hybrid hosts."""
+    for path in (mountpoint, os.path.join(mountpoint, 'unified')):
+        if os.path.exists(os.path.join(path, 'cgroup.controllers')):
+            return path
+    return None
+
+
+class DirectoryWatch:
+    """inotify watches on directories, through libc since the standard library has no binding."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add(self, path):
+        if self._add_watch(self.fd, os.fsencode(path), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+    def changed(self):
+        """Whether any event arrived since the previous call; drains the queue."""
+        changed = False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    return changed
+            except BlockingIOError:
+                return changed
+            changed = True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CgroupCollector:
+    def __init__(self, root, include=DEFAULT_INCLUDE, max_depth=MAX_DEPTH, max_cgroups=MAX_CGROUPS):
+        self.root = root
+        self.include = include
+        self.max_depth = max_depth
+        self.max_cgroups = max_cgroups
+        self.read_size = 4096
+        self.files = {}  # cgroup -> [cpu.stat, memory.current, io.stat]: fd, path, or None if absent
+        self.watch = None
+        self.use_inotify = True
+        self.stale = True
+        self.built = 0
+
+    def _open(self, path):
+        try:
+            return os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError as e:
+            if e.errno in (errno.EMFILE, errno.ENFILE):
+                return path  # out of descriptors: opened on every read instead
+            return None  # no such controller in this cgroup
+
+    def _close(self, handles):
+        for handle in handles:
+            if isinstance(handle, int):
+                os.close(handle)
+
+    def _walk(self):
+        if self.watch is not None:
+            self.watch.close()
+            self.watch = None
+        if self.use_inotify:
+            try:
+                self.watch = DirectoryWatch()
+            except (OSError, AttributeError) as e:
+                logging.warning(f"No inotify for the cgroup index ({str(e)}), rebuilding it periodically")
+                self.use_inotify = False
+
+        cgroups = []
+        directories = [(self.root, '', 0)]
+        while directories:
+            path, name, depth = directories.pop()
+            if self.watch is not None:
+                try:
+                    self.watch.add(path)  # before listing it, so no child created meanwhile is missed
+                except OSError as e:
+                    logging.warning(f"Could not watch {path} ({str(e)}), rebuilding the cgroup index periodically")
+                    self.watch.close()
+                    self.watch = None
+                    self.use_inotify = False
+            try:
+                entries = os.scandir(path)
+            except OSError:
+                continue  # removed meanwhile
+            with entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    child = f'{name}/{entry.name}' if name else entry.name
+                    if self.include.search(entry.name):
+                        cgroups.append(child)
+                    if depth + 1 < self.max_depth:
+                        directories.append((entry.path, child, depth + 1))
+        if len(cgroups) > self.max_cgroups:
+            logging.warning(f"{len(cgroups)} cgroups, only the first {self.max_cgroups} are collected")
+            cgroups = sorted(cgroups, key=lambda cgroup: cgroup.count('/'))[:self.max_cgroups]
+        return sorted(cgroups)
+
+    def rebuild(self):
+        cgroups = self._walk()
+        # Three descriptors per cgroup may exceed the default soft limit of 1024
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = 3 * len(cgroups) + 1024
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            try:
+                limit = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+            except (ValueError, OSError):
+                pass
+
+        kept = set(cgroups)
+        for cgroup in [cgroup for cgroup in self.files if cgroup not in kept]:
+            self._close(self.files.pop(cgroup))
+        for cgroup in cgroups:
+            if cgroup not in self.files:
+                path = os.path.join(self.root, cgroup)
+                self.files[cgroup] = [self._open(os.path.join(path, name))
+                                      for name in ('cpu.stat', 'memory.current', 'io.stat')]
+        self.stale = False
+        self.built = time.monotonic()
+
+    def _read(self, handle):
+        """Content of one file, or None if it is gone."""
+        if handle is None:
+            return None
+        if isinstance(handle, str):
+            try:
+                with open(handle, 'rb') as f:
+                    return f.read()
+            except OSError:
+                return None
+        size = self.read_size
+        while True:
+            try:
+                data = os.pread(handle, size, 0)
+            except OSError:
+                return None  # ENODEV once the cgroup is removed
+            if len(data) < size:
+                return data
+            size = self.read_size = size * 2  # io.stat of a host with many devices
+
+    def read(self):
+        """({cgroup: CgroupCounters}, {cgroup: memory bytes}) of every indexed cgroup."""
+        if self.stale or (self.watch.changed() if self.watch is not None
+                          else time.monotonic() - self.built >= POLL_REBUILD_INTERVAL):
+            self.rebuild()
+
+        read = self._read
+        counters = {}
+        memory = {}
+        for cgroup, (cpu_stat, memory_current, io_stat) in self.files.items():
+            data = read(cpu_stat)
+            if data is None and cpu_stat is not None:
+                self.stale = True  # removed since the last rebuild
+                continue
+            usage = int(data.split(None, 2)[1]) if data else 0  # usage_usec comes first
+
+            data = read(memory_current)
+            memory[cgroup] = int(data) if data else 0
+
+            read_bytes = write_bytes = 0
+            data = read(io_stat)
+            if data:
+                # 'major:minor rbytes=N wbytes=N rios=N wios=N dbytes=N dios=N' per device
+                for line in data.splitlines():
+                    fields = line.split(None, 3)
+                    if len(fields) >= 3 and fields[1].startswith(b'rbytes='):
+                        read_bytes += int(fields[1][7:])
+                        write_bytes += int(fields[2][7:])
+            counters[cgroup] = CgroupCounters(usage, read_bytes, write_bytes)
+        return counters, memory
+
+    def close(self):
+        for handles in self.files.values():
+            self._close(handles)
+        self.files = {}
+        if self.watch is not None:
+            self.watch.close()
+            self.watch = None
+
+
+class CgroupHistories:
+    """History rings for up to `slots` cgroups, in the extra region of a shared segment.
+
+    There are more cgroups than rings, so rings go to the cgroups in the
+    ranking passed to record() (the busiest ones) and stay with a cgroup as
+    long as it exists. When a ranked cgroup finds no free ring, it takes the
+    one of the cgroup that has been out of the ranking longest.
+    """
+
+    def __init__(self, segment, make_history, history_size, slots):
+        self.segment = segment
+        self.histories = [make_history(segment.extra[position * history_size:(position + 1) * history_size])
+                          for position in range(slots)]
+        self.slots = {}  # cgroup -> ring index
+        self.last_ranked = {}  # cgroup -> timestamp it was last in the ranking
+
+    def assign(self, timestamp, present, ranked):
+        """Update the ring of every cgroup; must be called inside segment.writing()."""
+        for cgroup in ranked:
+            self.last_ranked[cgroup] = timestamp
+        for cgroup in [cgroup for cgroup in self.slots if cgroup not in present]:
+            del self.slots[cgroup]
+        if len(self.last_ranked) > 4 * len(self.histories):
+            self.last_ranked = {cgroup: seen for cgroup, seen in self.last_ranked.items() if cgroup in present}
+
+        free = sorted(set(range(len(self.histories))) - set(self.slots.values()))
+        ranked_set = set(ranked)
+        for cgroup in ranked:
+            if cgroup in self.slots:
+                continue
+            if not free:
+                evicted = min((other for other in self.slots if other not in ranked_set),
+                              key=lambda other: self.last_ranked.get(other, 0), default=None)
+                if evicted is None:
+                    break
+                free.append(self.slots.pop(evicted))
+            slot = free.pop(0)
+            self.histories[slot].clear()
+            self.slots[cgroup] = slot
+
+    def record(self, timestamp, table):
+        """Append the row of every cgroup with a ring; `table` is columnar with 'names'."""
+        positions = {cgroup: position for position, cgroup in enumerate(table['names'])}
+        for cgroup, slot in self.slots.items():
+            history = self.histories[slot]
+            position = positions[cgroup]
+            history.append(timestamp, {metric: table[metric][position] for metric in history.metrics})
+
+    def query(self, slot, metrics, since=None):
+        history = self.histories[slot]
+        if not self.segment.valid:
+            return {'timestamps': [], **{metric: [] for metric in metrics}}
+        return self.segment.read(lambda: history.query(metrics, since))
@@ -0,0 +1,235 @@
+"""System counter backends of the sampler.
+
+Every tick the sampler calls `read()` once and gets a Reading with all the
+system-wide numbers it needs. Two backends produce it:
+
+- `psutil`: the portable one, one psutil call per number.
+- `proc`: Linux only. /proc/stat, /proc/meminfo, /proc/net/dev and
+  /proc/diskstats stay open and are re-read with one preadv() each into
+  buffers allocated once. Only the fields the sampler uses are parsed, and
+  /proc/stat is read once for the CPU percentages, the context switches and
+  the boot time instead of once for each.
+
+Both compute the percentages the way psutil does, so the numbers do not
+change with the backend. The backend is picked with MONITOR_COLLECTOR=
+auto|proc|psutil; `auto` uses /proc when it can and psutil otherwise.
+"""
+import logging
+import os
+from collections import namedtuple
+
+import psutil
+
+NetCounters = namedtuple('NetCounters', 'bytes_sent bytes_recv')
+DiskCounters = namedtuple('DiskCounters', 'read_bytes write_bytes')
+
+SECTOR_SIZE = 512  # /proc/diskstats counts 512-byte sectors whatever the device
+
+
+class Reading:
+    """The system-wide counters and gauges of one sampler tick."""
+
+    __slots__ = ('net_io', 'nic_counters', 'disk_io', 'disk_counters', 'ctx_switches', 'boot_time',
+                 'cpu_percent', 'cpu_per_core', 'cpu_iowait', 'cpu_steal', 'cpu_softirq',
+                 'memory_percent', 'disk_percent', 'load')
+
+
+def usage_percent(used, total):
+    return round(used / total * 100, 1) if total else 0.0
+
+
+class PsutilCollector:
+    name = 'psutil'
+
+    def __init__(self, disk_path='/'):
+        self.disk_path = disk_path
+        # The interval=None variants measure since their previous call, prime them once
+        psutil.cpu_percent(interval=None)
+        psutil.cpu_percent(interval=None, percpu=True)
+        psutil.cpu_times_percent(interval=None)
+
+    def read(self):
+        reading = Reading()
+        reading.net_io = psutil.net_io_counters()
+        reading.nic_counters = psutil.net_io_counters(pernic=True)
+        # disk_io_counters() returns None on hosts without block devices
+        reading.disk_io = psutil.disk_io_counters()
+        reading.disk_counters = psutil.disk_io_counters(perdisk=True) or {}
+        reading.ctx_switches = psutil.cpu_stats().ctx_switches
+        reading.boot_time = psutil.boot_time()
+        reading.cpu_percent = psutil.cpu_percent(interval=None)
+        reading.cpu_per_core = psutil.cpu_percent(interval=None, percpu=True)
+        cpu_times = psutil.cpu_times_percent(interval=None)
+        reading.cpu_iowait = getattr(cpu_times, 'iowait', 0.0)
+        reading.cpu_steal = getattr(cpu_times, 'steal', 0.0)
+        reading.cpu_softirq = getattr(cpu_times, 'softirq', 0.0)
+        reading.memory_percent = psutil.virtual_memory().percent
+        reading.disk_percent = psutil.disk_usage(self.disk_path).percent
+        reading.load = psutil.getloadavg()
+        return reading
+
+
+class ProcFile:
+    """A /proc file kept open and re-read from offset 0 into the same buffer."""
+
+    def __init__(self, path, size=16384):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.buffer = bytearray(size)
+
+    def read(self):
+        """Length of the fresh content now at the start of `buffer`."""
+        while True:
+            length = os.preadv(self.fd, [self.buffer], 0)
+            if length < len(self.buffer):
+                return length
+            self.buffer = bytearray(len(self.buffer) * 2)  # truncated, the file grew
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _field(buffer, key, end):
+    """The integer after `key` (a line start such as b'\\nctxt ') in buffer[:end]."""
+    start = buffer.find(key, 0, end)
+    if start < 0:
+        raise ValueError(f"{key.strip().decode()} not found")
+    start += len(key)
+    return int(buffer[start:buffer.find(b'\n', start, end)].split()[0])
+
+
+def _cpu_busy(fields):
+    """(busy, total) jiffies of a /proc/stat cpu line, as psutil counts them.
+
+    guest and guest_nice are already part of user and nice, and iowait is
+    idle time.
+    """
+    total = sum(fields[:8])
+    return total - fields[3] - fields[4], total
+
+
+class ProcCollector:
+    name = 'proc'
+
+    def __init__(self, disk_path='/'):
+        self.disk_path = disk_path
+        self.stat = ProcFile('/proc/stat')
+        self.meminfo = ProcFile('/proc/meminfo', 8192)
+        self.net_dev = ProcFile('/proc/net/dev')
+        self.diskstats = ProcFile('/proc/diskstats')
+        self.storage_devices = {}  # diskstats name -> whether it is a whole disk, not a partition
+        self.cpu = self.cores = None
+        self.read()  # the first tick has something to diff against
+
+    def close(self):
+        for proc_file in (self.stat, self.meminfo, self.net_dev, self.diskstats):
+            proc_file.close()
+
+    def _read_stat(self, reading):
+        end = self.stat.read()
+        buffer = self.stat.buffer
+        cpu_end = buffer.find(b'\nintr', 0, end)  # the cpu lines come first, intr can be huge
+        lines = buffer[:cpu_end if cpu_end >= 0 else end].split(b'\n')
+        cpu = [int(value) for value in lines[0].split()[1:9]]
+        cores = [[int(value) for value in line.split()[1:9]] for line in lines[1:] if line.startswith(b'cpu')]
+        reading.ctx_switches = _field(buffer, b'\nctxt ', end)
+        reading.boot_time = float(_field(buffer, b'\nbtime ', end))
+
+        previous, self.cpu = self.cpu, cpu
+        if previous is None:
+            reading.cpu_percent = reading.cpu_iowait = reading.cpu_steal = reading.cpu_softirq = 0.0
+        else:
+            deltas = [current - before for current, before in zip(cpu, previous)]
+            busy, total = _cpu_busy(deltas)
+            total = max(total, 0)
+            reading.cpu_percent = min(max(usage_percent(busy, total), 0.0), 100.0)
+            reading.cpu_iowait = usage_percent(deltas[4], total)
+            reading.cpu_softirq = usage_percent(deltas[6], total)
+            reading.cpu_steal = usage_percent(deltas[7], total)
+
+        previous, self.cores = self.cores, cores
+        if previous is None or len(previous) != len(cores):
+            reading.cpu_per_core = [0.0] * len(cores)  # cores came or went, start over
+        else:
+            reading.cpu_per_core = []
+            for current, before in zip(cores, previous):
+                busy, total = _cpu_busy([now - then for now, then in zip(current, before)])
+                reading.cpu_per_core.append(min(max(usage_percent(busy, total), 0.0), 100.0))
+
+    def _read_meminfo(self, reading):
+        end = self.meminfo.read()
+        buffer = self.meminfo.buffer
+        total = int(buffer[:buffer.find(b'\n', 0, end)].split()[1])  # MemTotal is the first line
+        available = _field(buffer, b'\nMemAvailable:', end)
+        reading.memory_percent = usage_percent(total - available, total)
+
+    def _read_net_dev(self, reading):
+        end = self.net_dev.read()
+        nics = {}
+        sent = recv = 0
+        # Two header lines, then 'name: rx_bytes 7 more rx fields tx_bytes ...'
+        for line in self.net_dev.buffer[:end].split(b'\n')[2:]:
+            name, _, values = line.partition(b':')
+            if not values:
+                continue
+            values = values.split()
+            counters = NetCounters(int(values[8]), int(values[0]))
+            nics[name.strip().decode()] = counters
+            sent += counters.bytes_sent
+            recv += counters.bytes_recv
+        reading.nic_counters = nics
+        reading.net_io = NetCounters(sent, recv)
+
+    def _is_storage_device(self, name):
+        # Like psutil, the totals count whole disks only: their partitions are already in them
+        known = self.storage_devices.get(name)
+        if known is None:
+            known = self.storage_devices[name] = os.path.exists(f"/sys/block/{name.replace('/', '!')}")
+        return known
+
+    def _read_diskstats(self, reading):
+        end = self.diskstats.read()
+        disks = {}
+        read_bytes = write_bytes = 0
+        # 'major minor name reads merged sectors_read ms writes merged sectors_written ...'
+        for line in self.diskstats.buffer[:end].split(b'\n'):
+            values = line.split()
+            if len(values) < 10:
+                continue
+            name = values[2].decode()
+            counters = DiskCounters(int(values[5]) * SECTOR_SIZE, int(values[9]) * SECTOR_SIZE)
+            disks[name] = counters
+            if self._is_storage_device(name):
+                read_bytes += counters.read_bytes
+                write_bytes += counters.write_bytes
+        reading.disk_counters = disks
+        reading.disk_io = DiskCounters(read_bytes, write_bytes) if disks else None
+
+    def read(self):
+        reading = Reading()
+        self._read_stat(reading)
+        self._read_meminfo(reading)
+        self._read_net_dev(reading)
+        self._read_diskstats(reading)
+        disk = os.statvfs(self.disk_path)
+        used = (disk.f_blocks - disk.f_bfree) * disk.f_frsize
+        reading.disk_percent = usage_percent(used, used + disk.f_bavail * disk.f_frsize)
+        reading.load = os.getloadavg()
+        return reading
+
+
+BACKENDS = {'proc': ProcCollector, 'psutil': PsutilCollector}
+
+
+def make_collector(name='auto', disk_path='/'):
+    """The collector called `name`, falling back to psutil when /proc cannot be used."""
+    if name not in ('auto', *BACKENDS):
+        logging.error(f"Unknown collector '{name}', using psutil")
+        name = 'psutil'
+    if name in ('auto', 'proc'):
+        try:
+            return ProcCollector(disk_path)
+        except (OSError, ValueError, IndexError) as e:
+            if name == 'proc':
+                logging.warning(f"The /proc collector is unavailable ({str(e)}), using psutil")
+    return PsutilCollector(disk_path)
@@ -0,0 +1,119 @@
+"""Forecast of the traffic left in the billing cycle.
+
+Hourly traffic is modelled as a linear trend times an hour-of-day profile:
+
+    bytes in hour t = (a + b * t) * profile[local hour of t]
+
+The profile is the decayed mean traffic of each hour of the day divided by
+the mean over all hours. The trend is a weighted least-squares fit of the
+deseasonalised hourly traffic against time. Both are kept as running sums
+that decay with a half-life of `half_life` hours, so recent weeks count
+most. Adding an hour is constant work, and the sampler is never involved:
+the hours are read from the 1h rollup store, only the ones closed since
+the previous sync.
+"""
+import threading
+from datetime import datetime
+
+HOUR = 3600
+MIN_PROFILE = 0.05  # floor of a profile factor, so a quiet hour cannot blow up the trend
+
+
+class TrafficForecaster:
+    def __init__(self, half_life=14 * 24):
+        self.decay = 0.5 ** (1 / half_life)
+        self.lock = threading.Lock()
+        self.last = None  # timestamp of the newest hour added
+        self.origin = None  # t = 0, in hours, keeps t * t small
+        self.hours = 0
+        self.hour_weight = [0.0] * 24
+        self.hour_bytes = [0.0] * 24
+        # Decayed sums of w, w*t, w*t*t, w*y and w*t*y of the trend fit
+        self.sw = self.st = self.stt = self.sy = self.sty = 0.0
+
+    def _profile(self, hour):
+        means = [total / weight for total, weight in zip(self.hour_bytes, self.hour_weight) if weight]
+        if not self.hour_weight[hour] or not means or not sum(means):
+            return 1.0
+        overall = sum(means) / len(means)
+        return max(self.hour_bytes[hour] / self.hour_weight[hour] / overall, MIN_PROFILE)
+
+    def add(self, timestamp, used_bytes):
+        """Account the traffic of the hour starting at `timestamp`; older hours are ignored."""
+        with self.lock:
+            if self.last is not None and timestamp <= self.last:
+                return
+            if self.origin is None:
+                self.origin = timestamp
+            factor = self.decay ** ((timestamp - self.last) / HOUR) if self.last is not None else 1.0
+            self.last = timestamp
+            self.hours += 1
+
+            hour = datetime.fromtimestamp(timestamp).hour
+            for index in range(24):
+                self.hour_weight[index] *= factor
+                self.hour_bytes[index] *= factor
+            self.hour_weight[hour] += 1
+            self.hour_bytes[hour] += used_bytes
+
+            t = (timestamp - self.origin) / HOUR
+            y = used_bytes / self._profile(hour)
+            self.sw = self.sw * factor + 1
+            self.st = self.st * factor + t
+            self.stt = self.stt * factor + t * t
+            self.sy = self.sy * factor + y
+            self.sty = self.sty * factor + t * y
+
+    def sync(self, store):
+        """Add the hours `store` closed since the last sync."""
+        rows = store.query(['sent_bytes', 'recv_bytes'], self.last)
+        for timestamp, sent, recv in zip(rows['timestamps'], rows['sent_bytes'], rows['recv_bytes']):
+            self.add(timestamp, sent + recv)
+
+    def _trend(self):
+        denominator = self.sw * self.stt - self.st * self.st
+        if self.sw < 2 or denominator <= 1e-9 * self.sw * self.stt:
+            return (self.sy / self.sw if self.sw else 0.0), 0.0
+        slope = (self.sw * self.sty - self.st * self.sy) / denominator
+        return (self.sy - slope * self.st) / self.sw, slope
+
+    def forecast(self, now, used, cycle_end, limit=None, fallback_rate=0.0):
+        """Projected usage at `cycle_end` and when `limit` bytes will be reached.
+
+        `used` is the traffic of the cycle so far. Without any hour to learn
+        from, `fallback_rate` bytes per hour is assumed.
+        """
+        with self.lock:
+            hours = self.hours
+            intercept, slope = self._trend()
+            profile = [self._profile(hour) for hour in range(24)]
+            origin = self.origin if self.origin is not None else now
+
+        def expected(hour_start):
+            if not hours:
+                return fallback_rate
+            level = intercept + slope * (hour_start - origin) / HOUR
+            return max(level, 0.0) * profile[datetime.fromtimestamp(hour_start).hour]
+
+        projected = used
+        exhaustion = now if limit and used >= limit else None
+        hour_start = now - now % HOUR
+        position = now
+        while position < cycle_end:
+            hour_end = min(hour_start + HOUR, cycle_end)
+            rate = expected(hour_start) / HOUR  # bytes per second during this hour
+            increment = rate * (hour_end - position)
+            if exhaustion is None and limit and rate > 0 and projected + increment >= limit:
+                exhaustion = position + (limit - projected) / rate
+            projected += increment
+            hour_start += HOUR
+            position = hour_end
+
+        return {
+            'projected_cycle_bytes': round(projected),
+            'exhaustion_time': exhaustion,
+            'rate_bytes_per_hour': round(expected(now - now % HOUR)),
+            'trend_bytes_per_hour_per_day': round(slope * 24) if hours else 0,
+            'hourly_profile': [round(factor, 3) for factor in profile] if hours else None,
+            'hours_observed': hours,
+        }
@@ -0,0 +1,275 @@
+"""Hub mode: one dashboard for a fleet of monitor agents.
+
+The hub polls every agent's /data, or agents push their samples to the hub,
+over a small keep-alive HTTP/1.1 client running on a single asyncio event
+loop, so hundreds of agents cost a few sockets and one thread rather than a
+thread per host. The latest status of every agent and a ring buffer of its
+history live in a shared-memory segment, so any pm2 worker can serve the
+fleet pages and accept pushes.
+"""
+import asyncio
+import json
+import logging
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+MAX_RESPONSE_SIZE = 4 * 1024 * 1024
+MAX_IDLE_PER_HOST = 2
+
+
+class HTTPError(Exception):
+    pass
+
+
+class AsyncHTTPClient:
+    """HTTP/1.1 client keeping idle connections open for the next request.
+
+    Every request is bounded by its own timeout, which covers connecting,
+    sending and reading the whole response.
+    """
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}  # (scheme, host, port) -> [(reader, writer), ...]
+        self.ssl_context = None
+
+    async def request(self, method, url, body=None, headers=None, timeout=5.0):
+        """Return (status, headers, body) with lower-cased header names."""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise HTTPError(f"Unsupported URL: {url}")
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        return await asyncio.wait_for(self._request(key, method, target, body, headers or {}), timeout)
+
+    async def _request(self, key, method, target, body, headers):
+        pooled = self.idle.get(key)
+        if pooled:
+            connection = pooled.pop()
+            try:
+                return await self._exchange(key, connection, method, target, body, headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The server closed the idle connection; retry on a fresh one
+                pass
+        connection = await self._connect(key)
+        return await self._exchange(key, connection, method, target, body, headers)
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            context = self.ssl_context
+        return await asyncio.open_connection(host, port, ssl=context)
+
+    async def _exchange(self, key, connection, method, target, body, headers):
+        reader, writer = connection
+        try:
+            host = key[1] if key[2] in (80, 443) else f'{key[1]}:{key[2]}'
+            lines = [f'{method} {target} HTTP/1.1', f'Host: {host}', 'Connection: keep-alive']
+            lines += [f'{name}: {value}' for name, value in headers.items()]
+            if body is not None:
+                lines.append(f'Content-Length: {len(body)}')
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Connection closed by peer")
+            try:
+                version, status = status_line.decode('latin-1').split(None, 2)[:2]
+                status = int(status)
+            except ValueError:
+                raise HTTPError(f"Malformed status line: {status_line[:80]!r}")
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+
+            keep_alive = version == 'HTTP/1.1' and response_headers.get('connection', '').lower() != 'close'
+            if 'content-length' in response_headers:
+                length = int(response_headers['content-length'])
+                if length > MAX_RESPONSE_SIZE:
+                    raise HTTPError(f"Response of {length} bytes is too large")
+                data = await reader.readexactly(length)
+            elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+                data = await self._read_chunked(reader)
+            else:
+                data = await reader.read(MAX_RESPONSE_SIZE)
+                keep_alive = False
+        except BaseException:
+            writer.close()
+            raise
+
+        pool = self.idle.setdefault(key, [])
+        if keep_alive and len(pool) < self.max_idle_per_host:
+            pool.append(connection)
+        else:
+            writer.close()
+        return status, response_headers, data
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        size = 0
+        while True:
+            length = int((await reader.readline()).split(b';')[0], 16)
+            if length == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass  # trailers
+                return b''.join(chunks)
+            size += length
+            if size > MAX_RESPONSE_SIZE:
+                raise HTTPError("Response is too large")
+            chunks.append(await reader.readexactly(length))
+            await reader.readexactly(2)
+
+    def close(self):
+        for pool in self.idle.values():
+            for _, writer in pool:
+                writer.close()
+        self.idle.clear()
+
+
+# Fields of an agent's sample shown on the fleet overview
+FLEET_SUMMARY_KEYS = ('timestamp', 'cpu_usage', 'cpu_cores', 'memory_usage', 'total_ram', 'disk_usage',
+                      'sent_speed', 'recv_speed', 'read_speed', 'write_speed', 'load_1',
+                      'bytes_sent', 'bytes_recv', 'network_limit', 'limit_exceeded', 'uptime')
+
+
+class Fleet:
+    """Latest status and history of every configured agent.
+
+    `agents` is the list of {'name', 'url', 'timeout'} entries from the hub
+    config; agents without a url can only push. `make_history(name, buffer)`
+    returns the ring buffer kept for one agent inside `segment.extra`, each
+    agent getting `history_size` bytes of it.
+    """
+
+    def __init__(self, agents, segment, make_history, history_size, stale_after):
+        self.agents = agents
+        self.segment = segment
+        self.stale_after = stale_after
+        self.histories = {agent['name']: make_history(segment.extra[position * history_size:
+                                                                     (position + 1) * history_size])
+                          for position, agent in enumerate(agents)}
+
+    def _statuses(self):
+        payload = self.segment.read_payload()
+        return json.loads(payload) if payload else {}
+
+    def record(self, results):
+        """Store (name, sample, latency in ms, error) tuples from one poll or push."""
+        with self.segment.exclusive():
+            # Any worker may write (pushes land on whichever one accepted them)
+            self.segment.claim()
+            statuses = self._statuses()
+            with self.segment.writing():
+                for name, sample, latency, error in results:
+                    status = statuses.setdefault(name, {})
+                    if error is not None:
+                        status['error'] = error
+                        continue
+                    status.update(error=None, latency_ms=latency, last_seen=time.time(),
+                                  sample={key: sample.get(key) for key in FLEET_SUMMARY_KEYS})
+                    history = self.histories[name]
+                    timestamp = sample.get('timestamp')
+                    newest = history.newest()
+                    if isinstance(timestamp, (int, float)) and (newest is None or timestamp > newest):
+                        history.append(timestamp, {metric: float(sample.get(metric) or 0.0)
+                                                   for metric in history.metrics})
+                self.segment.publish(json.dumps(statuses).encode())
+
+    def overview(self):
+        statuses = self.segment.read(self._statuses) if self.segment.valid else {}
+        now = time.time()
+        rows = []
+        for agent in self.agents:
+            status = statuses.get(agent['name'], {})
+            last_seen = status.get('last_seen')
+            rows.append({
+                'name': agent['name'],
+                'url': agent.get('url'),
+                'online': last_seen is not None and now - last_seen <= self.stale_after,
+                'last_seen': last_seen,
+                'latency_ms': status.get('latency_ms'),
+                'error': status.get('error'),
+                'sample': status.get('sample'),
+            })
+        return rows
+
+    def query(self, name, metrics, since=None):
+        history = self.histories[name]
+        if not self.segment.valid:
+            return {'timestamps': [], **{metric: [] for metric in metrics}}
+        return self.segment.read(lambda: history.query(metrics, since))
+
+    async def poll(self, client, timeout, concurrency):
+        """Fetch /data from every agent with a url, at most `concurrency` at a time."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(agent):
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    status, _, body = await client.request('GET', agent['url'].rstrip('/') + '/data',
+                                                           timeout=agent.get('timeout', timeout))
+                    if status != 200:
+                        raise HTTPError(f"HTTP {status}")
+                    sample = json.loads(body)
+                    if not isinstance(sample, dict):
+                        raise HTTPError("Not a sample")
+                    return agent['name'], sample, round((time.monotonic() - started) * 1000, 1), None
+                except asyncio.TimeoutError:
+                    return agent['name'], None, None, 'Timed out'
+                except (OSError, HTTPError, asyncio.IncompleteReadError, ValueError) as e:
+                    return agent['name'], None, None, str(e) or type(e).__name__
+
+        results = await asyncio.gather(*(fetch(agent) for agent in self.agents if agent.get('url')))
+        if results:
+            self.record(results)
+
+
+async def every(interval, job):
+    """Run the coroutine function `job` every `interval` seconds until cancelled."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logging.error(f"Hub job {job.__name__} failed: {str(e)}")
+        deadline = max(deadline + interval, loop.time())
+        await asyncio.sleep(deadline - loop.time())
+
+
+def run_in_background(jobs, name='hub'):
+    """Run `jobs`, a list of (interval, coroutine function), on one event loop thread."""
+    async def main():
+        await asyncio.gather(*(every(interval, job) for interval, job in jobs))
+
+    thread = threading.Thread(target=asyncio.run, args=(main(),), name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def push_job(client, push, get_payload, timeout):
+    """Coroutine function sending the latest sample to the hub at push['url']."""
+    name = json.dumps(push['name']).encode()
+    headers = {'Content-Type': 'application/json', 'X-Push-Token': push.get('token', '')}
+
+    async def push_sample():
+        payload = get_payload()
+        if not payload:
+            return
+        body = b'{"name":' + name + b',"sample":' + payload + b'}'
+        status, _, response = await client.request('POST', push['url'], body, headers, timeout)
+        if status != 200:
+            raise HTTPError(f"Hub answered HTTP {status}: {response[:200]!r}")
+    return push_sample
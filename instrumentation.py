@@ -0,0 +1,215 @@
+"""The monitor measuring itself: timing histograms and a sampling profiler.
+
+Timings go into fixed log-spaced buckets, so recording one costs a bisect
+and an increment and the memory use does not grow with the number of
+observations. The profiler samples the stacks of every thread from a
+background thread, which, unlike cProfile, also sees the scheduler jobs
+and request threads, and costs nothing while it is stopped.
+"""
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds of the histogram buckets in milliseconds; the last one is open
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, milliseconds):
+        self.counts[bisect.bisect_left(BUCKETS_MS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        if milliseconds > self.max:
+            self.max = milliseconds
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the quantile, capped at the maximum."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 3) if self.count else None,
+            'p50_ms': round(self.quantile(0.5), 3) if self.count else None,
+            'p99_ms': round(self.quantile(0.99), 3) if self.count else None,
+            'max_ms': round(self.max, 3),
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS_MS, self.counts) if count},
+        }
+
+
+class Timings:
+    """Named histograms of how long the monitor's own work takes."""
+
+    def __init__(self):
+        self.histograms = collections.defaultdict(Histogram)
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms[name].observe(seconds * 1000)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        """Decorator recording every call of the function under `name`."""
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started)
+            return wrapper
+        return decorate
+
+    def summary(self):
+        with self.lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+
+class ProcessUsage:
+    """RSS, threads and CPU share of this process, read from /proc and os.times()."""
+
+    def __init__(self):
+        self.started = self.last_time = time.monotonic()
+        self.started_cpu = self.last_cpu = self._cpu()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _cpu():
+        times = os.times()
+        return times.user + times.system
+
+    def summary(self):
+        with self.lock:
+            now, cpu = time.monotonic(), self._cpu()
+            recent = None
+            if now - self.last_time >= 1:
+                recent = 100 * (cpu - self.last_cpu) / (now - self.last_time)
+                self.last_time, self.last_cpu = now, cpu
+        usage = {
+            'cpu_percent': round(recent, 2) if recent is not None else None,  # since the previous call
+            'cpu_percent_average': round(100 * (cpu - self.started_cpu) / max(now - self.started, 1e-9), 3),
+            'threads': threading.active_count(),
+            'uptime': round(now - self.started, 1),
+        }
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        usage['rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+                    elif line.startswith('Threads:'):
+                        usage['threads'] = int(line.split()[1])  # native threads too
+            usage['open_fds'] = len(os.listdir('/proc/self/fd'))
+        except OSError:
+            pass
+        return usage
+
+
+# Innermost frames of a thread that is blocked rather than working
+IDLE_FUNCTIONS = frozenset(('wait', 'select', 'poll', 'accept', 'sleep', '_worker', 'readline'))
+
+
+class StackSampler:
+    """Statistical profiler: counts the stacks of all threads every `interval`.
+
+    Threads blocked in one of IDLE_FUNCTIONS are only counted as idle.
+    """
+
+    def __init__(self, interval=0.01, max_duration=300, depth=12):
+        self.interval = interval
+        self.max_duration = max_duration  # a forgotten profiler stops by itself
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.idle = 0
+        self.functions = collections.Counter()  # innermost frame -> samples
+        self.stacks = collections.Counter()  # 'inner < caller < ...' -> samples
+        self.started = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+            self._reset()
+            self.started = time.monotonic()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self, top=30):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.report(top)
+
+    @staticmethod
+    def _label(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+    def _run(self):
+        own = threading.get_ident()
+        deadline = self.started + self.max_duration
+        while not self.stopping.wait(self.interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    if frame.f_code.co_name in IDLE_FUNCTIONS:
+                        self.idle += 1
+                        continue
+                    self.functions[self._label(frame)] += 1
+                    stack = []
+                    while frame is not None and len(stack) < self.depth:
+                        stack.append(frame.f_code.co_name)
+                        frame = frame.f_back
+                    self.stacks[' < '.join(stack)] += 1
+
+    def report(self, top=30):
+        with self.lock:
+            return {
+                'running': self.running,
+                'samples': self.samples,
+                'idle_thread_samples': self.idle,
+                'interval_ms': self.interval * 1000,
+                'seconds': round(time.monotonic() - self.started, 1) if self.started else 0,
+                'functions': [{'function': name, 'samples': count} for name, count in self.functions.most_common(top)],
+                'stacks': [{'stack': stack, 'samples': count} for stack, count in self.stacks.most_common(top)],
+            }
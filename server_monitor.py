@@ -1,4 +1,4 @@
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -8,26 +8,134 @@ import os
 import logging
 import json
 import atexit
+import threading
+import math
+import gzip
+import hashlib
+import subprocess
+import socket
+import errno
+import re
+import heapq
+import hmac
+from array import array
+from datetime import date, datetime, timezone
+from functools import wraps
 from apscheduler.schedulers.background import BackgroundScheduler
+from werkzeug.serving import make_server
+from tsstore import TimeSeriesStore
+from shared_state import LeaderLock, PortClaim, SharedSegment, default_segment_path, port_claim_path
+from accounting import TrafficAccount, next_cycle_start
+from forecasting import TrafficForecaster
+from collectors import make_collector
+from cgroups import CgroupCollector, CgroupHistories, find_cgroup2_root
+from sessions import Sessions, signing_key
+from alerting import AlertEngine, DEFAULT_LOG as ALERTS_LOG_FILE
+from instrumentation import Timings, ProcessUsage, StackSampler
+import hub
+import wire
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'supersecretkey')
 
+# What the monitor's own jobs and endpoints cost, served on /internal/stats
+timings = Timings()
+
+CONFIG_REFRESH_INTERVAL = 5  # seconds between two checks of the config files
+
+class CachedJSONFile:
+    """In-process copy of a small JSON file.
+
+    get() never touches the disk. refresh(), run by a scheduler job, stats the
+    file and parses it again only when its mtime, size or inode changed; set()
+    writes through with an atomic rename. on_change is called with the new
+    contents in both cases, and with None when the file is missing or, on the
+    first load only, unreadable.
+    """
+
+    def __init__(self, path, on_change=None):
+        self.path = path
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.stamp = False  # unlike any stamp, even None: the first refresh() always calls on_change
+        self.data = None
+        self.refresh()
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def get(self):
+        return self.data
+
+    def refresh(self):
+        with self.lock:
+            stamp = self._stamp()
+            if stamp == self.stamp:
+                return
+            first_load = self.stamp is False
+            self.stamp = stamp
+            data = None
+            if stamp is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    logging.error(f"Could not load '{self.path}': {str(e)}")
+                    if not first_load:
+                        return  # keep the previous contents, e.g. while an editor is saving
+            self.data = data
+        if self.on_change:
+            self.on_change(data)
+
+    def set(self, data):
+        with self.lock:
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_file, self.path)
+            self.stamp = self._stamp()
+            self.data = data
+        if self.on_change:
+            self.on_change(data)
+
 # ========================= rskhi-permiuim Start =========================
 INSTALL_TIME_FILE = 'install_time.json'
 LIMIT_FILE = 'network_limit.json'
 SECURITY_FILE = 'sec.json'
 TRAFFIC_FILE = 'traffic_data.json'
+TRAFFIC_STORE_FILE = 'traffic.bin'
+TRAFFIC_ACCOUNT_FILE = 'traffic_account.json'
+LIMIT_STATE_FILE = 'limit_state.json'
+HISTORY_1M_FILE = 'history_1m.bin'
+HISTORY_1H_FILE = 'history_1h.bin'
+LEADER_LOCK_FILE = 'monitor.lock'
+HUB_FILE = 'hub.json'
+REVOKED_SESSIONS_FILE = 'revoked_sessions.log'
+ALERTS_FILE = 'alerts.json'
+
+install_time_file = CachedJSONFile(INSTALL_TIME_FILE)
 
 def get_install_time():
-    try:
-        with open(INSTALL_TIME_FILE, 'r') as f:
-            return json.load(f).get('install_time')
-    except (FileNotFoundError, json.JSONDecodeError):
-        install_time = time.time()
-        with open(INSTALL_TIME_FILE, 'w') as f:
-            json.dump({'install_time': install_time}, f)
-        return install_time
+    data = install_time_file.get()
+    if isinstance(data, dict) and data.get('install_time') is not None:
+        return data['install_time']
+    install_time = time.time()
+    install_time_file.set({'install_time': install_time})
+    return install_time
 
 def check_self_destruct():
     install_time = get_install_time()
@@ -36,7 +144,9 @@ def check_self_destruct():
 
 def self_destruct():
     try:
-        files_to_delete = [__file__, LIMIT_FILE, SECURITY_FILE, TRAFFIC_FILE, INSTALL_TIME_FILE]
+        files_to_delete = [__file__, LIMIT_FILE, SECURITY_FILE, TRAFFIC_FILE, INSTALL_TIME_FILE,
+                           TRAFFIC_STORE_FILE, TRAFFIC_ACCOUNT_FILE, LIMIT_STATE_FILE, HISTORY_1M_FILE, HISTORY_1H_FILE,
+                           HUB_FILE, REVOKED_SESSIONS_FILE, ALERTS_FILE, ALERTS_LOG_FILE]
         for f in files_to_delete:
             if os.path.exists(f):
                 os.remove(f)
@@ -54,7 +164,21 @@ def check_self_destruct_job():
         self_destruct()
 # ========================= rskhi-permiuim End =========================
 
+# `pm2 start server_monitor.py -i max` runs one process per core. Only the one
+# holding this lock samples psutil and writes the data files; the others read
+# its samples from shared memory and take over if it dies.
+leader_lock = LeaderLock(LEADER_LOCK_FILE)
+leader_lock.acquire()
+
+# Running traffic totals, one fixed-width record per save (about a year of them)
+traffic_store = TimeSeriesStore(TRAFFIC_STORE_FILE, ('total_sent', 'total_recv'), 366 * 24 * 12,
+                                readonly=not leader_lock.held)
+
 def load_traffic_data():
+    last = traffic_store.last()
+    if last is not None:
+        return last['total_sent'], last['total_recv']
+    # Totals saved by older versions
     try:
         with open(TRAFFIC_FILE, 'r') as f:
             data = json.load(f)
@@ -62,117 +186,1157 @@ def load_traffic_data():
     except (FileNotFoundError, json.JSONDecodeError):
         return 0, 0
 
+def save_traffic_account():
+    if leader_lock.held:
+        traffic_account.save()
+
+@timings.timed('job.save_traffic_data')
 def save_traffic_data():
-    current_net_io = psutil.net_io_counters()
-    delta_sent = current_net_io.bytes_sent - initial_sent
-    delta_recv = current_net_io.bytes_recv - initial_recv
-    total_sent, total_recv = load_traffic_data()
-    with open(TRAFFIC_FILE, 'w') as f:
-        json.dump({
-            'total_sent': total_sent + delta_sent,
-            'total_recv': total_recv + delta_recv
-        }, f)
+    if not leader_lock.held:
+        return
+    traffic_account.save()
+    total_sent, total_recv = traffic_account.totals()
+    traffic_store.append(time.time(), {'total_sent': total_sent, 'total_recv': total_recv})
+    traffic_store.sync()
+
+# veth pairs, NAT bridges and ifb (ingress shaping) devices carry traffic that
+# also crosses a physical NIC; bonds, VLANs and bridges over NICs are found as
+# stacked devices by TrafficAccount
+ACCOUNTING_EXCLUDE = re.compile(r'^(lo|veth.*|docker\d+|br-.*|virbr\d+|ifb\d+)$')
+ACCOUNT_SAVE_INTERVAL = 60  # seconds, followers and a new leader read the saved state
 
-total_sent, total_recv = load_traffic_data()
-initial_net_io = psutil.net_io_counters()
-initial_sent = initial_net_io.bytes_sent - (total_sent % (1024 ** 4))
-initial_recv = initial_net_io.bytes_recv - (total_recv % (1024 ** 4))
+traffic_account = TrafficAccount(TRAFFIC_ACCOUNT_FILE, ACCOUNTING_EXCLUDE)
 
 scheduler = BackgroundScheduler()
 scheduler.add_job(func=save_traffic_data, trigger="interval", minutes=5)
+scheduler.add_job(func=save_traffic_account, trigger="interval", seconds=ACCOUNT_SAVE_INTERVAL)
 scheduler.add_job(func=check_self_destruct_job, trigger="interval", hours=1)
 scheduler.start()
 
 atexit.register(lambda: [save_traffic_data(), scheduler.shutdown()])
 
-def load_security_config():
+def load_security_config(config):
+    if not isinstance(config, dict) or not all(key in config for key in ['username', 'password']):
+        raise ValueError("Invalid security config file")
+
+    config = dict(config)
+    config['password_hash'] = generate_password_hash(config['password'])
+    # The same in every worker, unlike the salted hash
+    config['session_key'] = signing_key(app.secret_key, config['username'], config['password'])
+    del config['password']
+    return config
+
+ADMIN_USERNAME = None
+ADMIN_PASSWORD_HASH = None
+
+# Admin endpoints take the token issued by /login rather than the password
+sessions = Sessions(REVOKED_SESSIONS_FILE)
+
+def apply_security_config(config):
+    global ADMIN_USERNAME, ADMIN_PASSWORD_HASH
     try:
-        with open(SECURITY_FILE, 'r') as f:
-            config = json.load(f)
-            if not all(key in config for key in ['username', 'password']):
-                raise ValueError("Invalid security config file")
-            
-            config['password_hash'] = generate_password_hash(config['password'])
-            del config['password']
-            return config
-            
-    except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+        security_config = load_security_config(config)
+    except ValueError as e:
         logging.error(f"خطای پیکربندی امنیتی: {str(e)}")
-        exit(1)
+        if ADMIN_PASSWORD_HASH is None:
+            exit(1)
+        return
+    ADMIN_USERNAME = security_config['username']
+    ADMIN_PASSWORD_HASH = security_config['password_hash']
+    sessions.set_key(security_config['session_key'])
 
-def load_limit():
-    try:
-        with open(LIMIT_FILE, 'r') as f:
-            return json.load(f).get('limit')
-    except (FileNotFoundError, json.JSONDecodeError):
-        return None
+def session_token():
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else None
+
+def admin_required(view):
+    """Reject requests without a valid session token from /login."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if sessions.verify(session_token()) is None:
+            return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+LIMIT_ACTIONS = ('alert', 'throttle', 'shutdown')
+LIMIT_DEFAULTS = {
+    'limit': None,          # TB per billing cycle, None or 0 disables it
+    'cycle_day': 1,         # day of the month on which a billing cycle starts
+    'action': 'shutdown',   # one of LIMIT_ACTIONS
+    'hysteresis': 0.02,     # fraction under the limit before the action is released
+    'throttle_rate': '1mbit',
+    'interface': None       # interface to throttle, defaults to the default route
+}
+
+def valid_limit(limit):
+    """Whether `limit` is usable as a limit in TB: None or a finite non-negative number."""
+    if limit is None:
+        return True
+    return (isinstance(limit, (int, float)) and not isinstance(limit, bool)
+            and math.isfinite(limit) and limit >= 0)
+
+def apply_limit_config(config):
+    global limit_config, network_limit
+    limit_config = {**LIMIT_DEFAULTS, **(config if isinstance(config, dict) else {})}
+    if not valid_limit(limit_config['limit']):
+        logging.error(f"Invalid limit {limit_config['limit']!r}, the traffic limit is off")
+        limit_config['limit'] = None
+    hysteresis = limit_config['hysteresis']
+    if not valid_limit(hysteresis) or hysteresis is None or hysteresis >= 1:
+        logging.error(f"Invalid hysteresis {hysteresis!r}, using {LIMIT_DEFAULTS['hysteresis']}")
+        limit_config['hysteresis'] = LIMIT_DEFAULTS['hysteresis']
+    network_limit = limit_config['limit'] or None
+    cycle_day = limit_config['cycle_day']
+    if not isinstance(cycle_day, int) or not 1 <= cycle_day <= 31:
+        logging.error(f"Invalid cycle_day {cycle_day!r}, cycles start on the 1st")
+        limit_config['cycle_day'] = cycle_day = 1
+    traffic_account.set_cycle_day(cycle_day)
+
+def load_limit_config():
+    return limit_config
+
+def save_limit(limit, action=None):
+    config = dict(load_limit_config())
+    config['limit'] = limit
+    if action is not None:
+        config['action'] = action
+    limit_file.set(config)
+    return config
+
+security_file = CachedJSONFile(SECURITY_FILE, on_change=apply_security_config)
+# The defaults hold until network_limit.json is loaded
+limit_config = dict(LIMIT_DEFAULTS)
+network_limit = None
+limit_file = CachedJSONFile(LIMIT_FILE, on_change=apply_limit_config)
 
-def save_limit(limit):
-    with open(LIMIT_FILE, 'w') as f:
-        json.dump({'limit': limit}, f)
+# Rules are evaluated by the sampling leader only, on every tick
+alerts = AlertEngine()
+alerts_file = CachedJSONFile(ALERTS_FILE, on_change=alerts.configure)
+ALERT_DELIVERY_INTERVAL = 5  # seconds between two flushes of the notification queues
 
-security_config = load_security_config()
-ADMIN_USERNAME = security_config['username']
-ADMIN_PASSWORD_HASH = security_config['password_hash']
+@timings.timed('job.refresh_config_files')
+def refresh_config_files():
+    for config_file in (install_time_file, security_file, limit_file, alerts_file):
+        config_file.refresh()
 
-network_limit = load_limit() or None
+scheduler.add_job(func=refresh_config_files, trigger="interval", seconds=CONFIG_REFRESH_INTERVAL)
 
 limiter = Limiter(app=app, key_func=get_remote_address)
 
-prev_net_io = psutil.net_io_counters()
-prev_disk_io = psutil.disk_io_counters()
-last_update = time.time()
+SAMPLE_INTERVAL = 1  # seconds between two sampler ticks
+
+MIN_RATE_WINDOW = 0.2  # seconds, shorter windows would only amplify jitter
 
 CPU_CORES = psutil.cpu_count(logical=False)
+LOGICAL_CORES = psutil.cpu_count() or 1
 TOTAL_RAM = round(psutil.virtual_memory().total / (1024 ** 3), 2)
 
-def get_system_info():
-    global prev_net_io, prev_disk_io, last_update
+# Where the sampler reads the system counters: 'proc' keeps /proc open and
+# parses it directly, 'psutil' works everywhere, 'auto' prefers /proc
+collector = make_collector(os.environ.get('MONITOR_COLLECTOR', 'auto'))
+
+HISTORY_METRICS = ('cpu_usage', 'memory_usage', 'sent_speed', 'recv_speed',
+                   'total_speed', 'read_speed', 'write_speed', 'cpu_iowait',
+                   'cpu_steal', 'cpu_softirq', 'load_1', 'ctx_switches')
+# Per-core utilisation is only kept at full resolution, in its own ring buffer
+CORE_METRICS = tuple(f'cpu{index}' for index in range(LOGICAL_CORES))
+HISTORY_SIZE = 3600  # samples kept in memory, one hour at SAMPLE_INTERVAL = 1
+
+class MetricHistory:
+    """Fixed-size ring buffer of samples with one float64 column per metric.
+
+    Memory is allocated once: two counters followed by (len(metrics) + 1) *
+    capacity doubles. Passing `buffer` places the ring in shared memory so
+    every worker reads the history written by the leader.
+    """
+
+    def __init__(self, metrics, capacity, buffer=None):
+        self.metrics = tuple(metrics)
+        self.capacity = capacity
+        size = self.buffer_size(len(self.metrics), capacity)
+        view = memoryview(bytearray(size) if buffer is None else buffer)
+        self.state = view[:16].cast('q')  # head (physical index of the next write), count
+        columns = view[16:size].cast('d')
+        self.timestamps = columns[:capacity]
+        self.values = {metric: columns[(position + 1) * capacity:(position + 2) * capacity]
+                       for position, metric in enumerate(self.metrics)}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def buffer_size(metric_count, capacity):
+        return 16 + 8 * capacity * (metric_count + 1)
+
+    @property
+    def head(self):
+        return self.state[0]
+
+    @head.setter
+    def head(self, value):
+        self.state[0] = value
+
+    @property
+    def count(self):
+        return self.state[1]
+
+    @count.setter
+    def count(self, value):
+        self.state[1] = value
+
+    def append(self, timestamp, sample):
+        with self.lock:
+            self.timestamps[self.head] = timestamp
+            for metric in self.metrics:
+                self.values[metric][self.head] = sample[metric]
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        with self.lock:
+            self.head = self.count = 0
+
+    def oldest(self):
+        with self.lock:
+            return self.timestamps[self._physical(0)] if self.count else None
+
+    def newest(self):
+        with self.lock:
+            return self.timestamps[self._physical(self.count - 1)] if self.count else None
+
+    def _physical(self, index):
+        return (self.head - self.count + index) % self.capacity
+
+    def _bisect(self, since):
+        # Logical index of the first sample newer than `since`
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[self._physical(middle)] <= since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _slice(self, column, start, stop):
+        first, last = self._physical(start), self._physical(stop - 1) + 1
+        if first < last:
+            return column[first:last].tolist()
+        return column[first:].tolist() + column[:last].tolist()
+
+    def query(self, metrics, since=None):
+        """Copy out only the samples newer than `since` for the given metrics."""
+        with self.lock:
+            start = self._bisect(since) if since is not None else 0
+            result = {'timestamps': [], **{metric: [] for metric in metrics}}
+            if start >= self.count:
+                return result
+            result['timestamps'] = self._slice(self.timestamps, start, self.count)
+            for metric in metrics:
+                result[metric] = self._slice(self.values[metric], start, self.count)
+            return result
+
+SHARED_PAYLOAD_SIZE = 1024 * 1024  # upper bound for one JSON-encoded sample
+
+HISTORY_BUFFER_SIZE = MetricHistory.buffer_size(len(HISTORY_METRICS), HISTORY_SIZE)
+shared = SharedSegment(default_segment_path('aseman-monitor'), SHARED_PAYLOAD_SIZE,
+                       HISTORY_BUFFER_SIZE + MetricHistory.buffer_size(len(CORE_METRICS), HISTORY_SIZE),
+                       layout=repr((HISTORY_METRICS, CORE_METRICS, HISTORY_SIZE)))
+if leader_lock.held:
+    shared.claim()
+history = MetricHistory(HISTORY_METRICS, HISTORY_SIZE, shared.extra[:HISTORY_BUFFER_SIZE])
+core_history = MetricHistory(CORE_METRICS, HISTORY_SIZE, shared.extra[HISTORY_BUFFER_SIZE:])
+
+def query_history(metrics, since=None):
+    """Read the shared ring buffers without catching the leader mid-append."""
+    if not shared.valid:
+        return {'timestamps': [], **{metric: [] for metric in metrics}}
+    cores = [metric for metric in metrics if metric in CORE_METRICS]
+    others = [metric for metric in metrics if metric not in CORE_METRICS]
+
+    def read():
+        # Both rings are appended in the same tick, so their timestamps match
+        result = history.query(others, since)
+        if cores:
+            result.update(core_history.query(cores, since))
+        return result
+    return shared.read(read)
+
+# (name, bucket width in seconds, buckets kept). The raw ring buffer above is
+# the 1s tier; the coarser tiers keep min/max/avg per bucket for weeks.
+ROLLUP_TIERS = (('1m', 60, 7 * 24 * 60, HISTORY_1M_FILE), ('1h', 3600, 366 * 24, HISTORY_1H_FILE))
+
+def rollup_columns(metrics):
+    columns = []
+    for metric in metrics:
+        columns += [metric, f'{metric}_min', f'{metric}_max']
+    return columns + ['sent_bytes', 'recv_bytes']
+
+class Rollup:
+    """Aggregates samples into fixed-width buckets.
+
+    Only the open bucket lives in Python objects; closed buckets are appended
+    to an on-disk TimeSeriesStore whose columns are avg (named after the
+    metric), min, max and the bytes transferred during the bucket.
+    """
+
+    def __init__(self, name, resolution, capacity, metrics, path, readonly=False):
+        self.name = name
+        self.resolution = resolution
+        self.metrics = tuple(metrics)
+        self.store = TimeSeriesStore(path, rollup_columns(self.metrics), capacity, readonly=readonly)
+        self.bucket_start = None
+        self.last_totals = None
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.sums = dict.fromkeys(self.metrics, 0.0)
+        self.mins = dict.fromkeys(self.metrics, math.inf)
+        self.maxs = dict.fromkeys(self.metrics, -math.inf)
+        self.sent_bytes = self.recv_bytes = 0
+
+    def _row(self):
+        row = {'sent_bytes': self.sent_bytes, 'recv_bytes': self.recv_bytes}
+        for metric in self.metrics:
+            row[metric] = self.sums[metric] / self.count
+            row[f'{metric}_min'] = self.mins[metric]
+            row[f'{metric}_max'] = self.maxs[metric]
+        return row
+
+    def add(self, sample):
+        timestamp = sample['timestamp']
+        bucket_start = timestamp - timestamp % self.resolution
+        with self.lock:
+            if bucket_start != self.bucket_start:
+                if self.count:
+                    self.store.append(self.bucket_start, self._row())
+                self._reset()
+                self.bucket_start = bucket_start
+
+            self.count += 1
+            for metric in self.metrics:
+                value = sample[metric]
+                self.sums[metric] += value
+                if value < self.mins[metric]:
+                    self.mins[metric] = value
+                if value > self.maxs[metric]:
+                    self.maxs[metric] = value
+
+            totals = (sample['bytes_sent'], sample['bytes_recv'])
+            if self.last_totals is not None:
+                self.sent_bytes += max(0, totals[0] - self.last_totals[0])
+                self.recv_bytes += max(0, totals[1] - self.last_totals[1])
+            self.last_totals = totals
+
+    def oldest(self):
+        """Start of the oldest bucket, closed or open; None before the first sample."""
+        first = self.store.first()
+        if first is not None:
+            return first
+        with self.lock:
+            return self.bucket_start if self.count else None
+
+    def query(self, columns, since=None):
+        """Closed buckets newer than `since`, followed by the open bucket."""
+        result = self.store.query(columns, since)
+        with self.lock:
+            if self.count and (since is None or self.bucket_start > since):
+                row = self._row()
+                result['timestamps'].append(self.bucket_start)
+                for column in columns:
+                    result[column].append(row[column])
+        return result
+
+rollups = [Rollup(name, resolution, capacity, HISTORY_METRICS, path, readonly=not leader_lock.held)
+           for name, resolution, capacity, path in ROLLUP_TIERS]
+
+def pick_history_tier(since):
+    """Finest tier whose data reaches back to `since`, so long ranges read coarse buckets.
+
+    Tiers are compared by the oldest point they actually hold: after a boot
+    the 1s ring only has minutes, while the persisted rollups go back weeks.
+    When no tier reaches back far enough, the one reaching back furthest wins.
+    """
+    if since is None:
+        return history
+    furthest, furthest_oldest = history, None
+    for tier in (history, *rollups):
+        oldest = tier.oldest()
+        if oldest is None:
+            continue
+        if oldest <= since:
+            return tier
+        if furthest_oldest is None or oldest < furthest_oldest:
+            furthest, furthest_oldest = tier, oldest
+    return furthest
+
+def traffic_per_day(days):
+    """Bytes sent and received per local calendar day, read from the 1h tier."""
+    now = datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    since = midnight - (days - 1) * 86400
+    hourly = rollups[-1].query(['sent_bytes', 'recv_bytes'], since - 1)
+
+    totals = {}
+    for timestamp, sent, recv in zip(hourly['timestamps'], hourly['sent_bytes'], hourly['recv_bytes']):
+        day = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+        day_sent, day_recv = totals.get(day, (0, 0))
+        totals[day] = (day_sent + sent, day_recv + recv)
+    return [{'date': day, 'sent': sent, 'recv': recv} for day, (sent, recv) in sorted(totals.items())]
+
+@timings.timed('job.sync_stores')
+def sync_stores():
+    for rollup in rollups:
+        rollup.store.sync()
+
+def open_traffic_account():
+    """Load the saved account, or start one from what older versions recorded."""
+    if traffic_account.load() or not leader_lock.held:
+        return
+    total_sent, total_recv = load_traffic_data()
+    traffic_account.seed(total_sent, total_recv, traffic_per_day(366))
+    reading = collector.read()
+    traffic_account.baseline(reading.nic_counters, reading.boot_time)
+    traffic_account.save()
+
+open_traffic_account()
+
+# The sampler owns every collector call; request handlers only read the latest
+# snapshot, so /data costs the same whatever the number of open dashboards.
+# latest_payload is the JSON encoding of latest_sample and latest_event the same
+# bytes framed for Server-Sent Events; both are built once per tick and shared.
+sample_lock = threading.Lock()
+sample_ready = threading.Condition(sample_lock)
+sample_listeners = []  # called without the lock after every publish_sample()
+latest_sample = {}
+latest_payload = b'{}'
+latest_event = b''
+sample_seq = 0
+
+STREAM_KEEPALIVE = 15  # seconds between SSE comments on an idle stream
+MAX_STREAM_INTERVAL = 60
+MAX_STREAM_CLIENTS = 64
+stream_clients = 0
+
+# Counters of the previous tick. Only collect_sample() reads or writes them, and
+# the scheduler never runs two ticks at once (max_instances=1).
+initial_reading = collector.read()
+sampler_state = {
+    'net_io': initial_reading.net_io,
+    'disk_io': initial_reading.disk_io,
+    'ctx_switches': initial_reading.ctx_switches,
+    'time': time.monotonic(),
+    'rates': (0.0, 0.0, 0.0, 0.0, 0.0)
+}
+
+def counter_delta(current, previous):
+    # Counters go backwards when a NIC is re-created or the kernel resets them
+    return current - previous if current >= previous else 0
+
+def compute_rates(current_net_io, current_disk_io, ctx_switches, now):
+    """Turn the counter deltas since the previous tick into per-second rates."""
+    prev_net_io = sampler_state['net_io']
+    prev_disk_io = sampler_state['disk_io']
+    time_diff = now - sampler_state['time']
+
+    if time_diff < MIN_RATE_WINDOW:
+        return sampler_state['rates']
+
+    delta_sent = counter_delta(current_net_io.bytes_sent, prev_net_io.bytes_sent)
+    delta_recv = counter_delta(current_net_io.bytes_recv, prev_net_io.bytes_recv)
 
-    current_net_io = psutil.net_io_counters()
-    time_diff = time.time() - last_update
-    
-    delta_sent = current_net_io.bytes_sent - prev_net_io.bytes_sent
-    delta_recv = current_net_io.bytes_recv - prev_net_io.bytes_recv
-    
     sent_speed = (delta_sent * 8) / (time_diff * 1e6)
     recv_speed = (delta_recv * 8) / (time_diff * 1e6)
-    total_speed = sent_speed + recv_speed
 
-    current_disk_io = psutil.disk_io_counters()
-    read_speed = (current_disk_io.read_bytes - prev_disk_io.read_bytes) / (time_diff * 1024**2)
-    write_speed = (current_disk_io.write_bytes - prev_disk_io.write_bytes) / (time_diff * 1024**2)
+    # disk_io_counters() returns None on hosts without block devices
+    if current_disk_io is not None and prev_disk_io is not None:
+        read_speed = counter_delta(current_disk_io.read_bytes, prev_disk_io.read_bytes) / (time_diff * 1024**2)
+        write_speed = counter_delta(current_disk_io.write_bytes, prev_disk_io.write_bytes) / (time_diff * 1024**2)
+    else:
+        read_speed = write_speed = 0.0
+
+    context_switches = counter_delta(ctx_switches, sampler_state['ctx_switches']) / time_diff
+
+    rates = (sent_speed, recv_speed, read_speed, write_speed, context_switches)
+    sampler_state.update(net_io=current_net_io, disk_io=current_disk_io, ctx_switches=ctx_switches,
+                         time=now, rates=rates)
+    return rates
+
+# Devices left out of the per-device breakdown; the aggregate totals keep them
+NET_EXCLUDE = re.compile(r'^(lo|veth.*)$')
+DISK_EXCLUDE = re.compile(r'^(loop|ram|zram)\d+$')
+
+class DeviceRates:
+    """Per-second rates of per-device counters, one vectorised diff per tick.
+
+    Counters are kept in a flat float64 vector laid out device by device, so
+    the cost of a tick is one subtraction over the vector whatever the number
+    of NICs or disks. NumPy is used when installed, array('d') otherwise.
+    """
+
+    def __init__(self, fields, exclude, scale):
+        self.fields = tuple(fields)
+        self.exclude = exclude
+        self.scale = scale  # multiplier from bytes per second to the reported unit
+        self.names = ()
+        self.previous = None
+        self.time = None
+        self.rates = {'names': [], **{field: [] for field in self.fields}}
+
+    def _vector(self, values):
+        if numpy is not None:
+            return numpy.fromiter(values, dtype=numpy.float64)
+        return array('d', values)
+
+    def _realign(self, names, current):
+        # Keep the previous counters of devices that are still there; new
+        # devices start from their current value, i.e. a rate of zero.
+        width = len(self.fields)
+        old_index = {name: position for position, name in enumerate(self.names)}
+        previous = array('d', current)
+        for position, name in enumerate(names):
+            if name in old_index:
+                start = old_index[name] * width
+                previous[position * width:(position + 1) * width] = array('d', self.previous[start:start + width])
+        return self._vector(previous)
+
+    def update(self, counters, now):
+        names = tuple(name for name in counters if not self.exclude.match(name))
+        current = self._vector(getattr(counters[name], field) for name in names for field in self.fields)
+        if self.previous is None:
+            self.names, self.previous, self.time = names, current, now
+            return self.rates
+        if names != self.names:
+            self.previous = self._realign(names, current)
+            self.names = names
+
+        time_diff = now - self.time
+        if time_diff < MIN_RATE_WINDOW:
+            return self.rates
+
+        factor = self.scale / time_diff
+        width = len(self.fields)
+        if numpy is not None:
+            rates = numpy.round(numpy.maximum(current - self.previous, 0) * factor, 3).tolist()
+        else:
+            rates = [round(max(0.0, value - previous) * factor, 3)
+                     for value, previous in zip(current, self.previous)]
+        self.rates = {'names': list(names),
+                      **{field: rates[position::width] for position, field in enumerate(self.fields)}}
+        self.previous, self.time = current, now
+        return self.rates
+
+nic_rates = DeviceRates(('bytes_sent', 'bytes_recv'), NET_EXCLUDE, 8 / 1e6)
+disk_rates = DeviceRates(('read_bytes', 'write_bytes'), DISK_EXCLUDE, 1 / 1024 ** 2)
+
+def collect_device_rates(now, nic_counters, disk_counters):
+    """Per-NIC Mbps and per-disk MB/s, in the units of the aggregate rates."""
+    nics = nic_rates.update(nic_counters, now)
+    disks = disk_rates.update(disk_counters, now)
+    return {
+        'names': nics['names'],
+        'sent_speed': nics['bytes_sent'],
+        'recv_speed': nics['bytes_recv']
+    }, {
+        'names': disks['names'],
+        'read_speed': disks['read_bytes'],
+        'write_speed': disks['write_bytes']
+    }
+
+# Per-cgroup usage of systemd units and containers, on hosts with cgroup v2
+CGROUP_TOP_N = 10  # cgroups in every sample, the busiest by CPU and by memory
+CGROUP_METRICS = ('cpu_percent', 'memory_mb', 'read_speed', 'write_speed')
+CGROUP_HISTORY_SLOTS = 32  # cgroups with a history ring, given to the busiest
+CGROUP_HISTORY_SIZE = 600  # ten minutes at SAMPLE_INTERVAL = 1
+NO_EXCLUDE = re.compile(r'(?!)')
+
+cgroup_root = os.environ.get('MONITOR_CGROUP_ROOT') or find_cgroup2_root()
+cgroup_collector = CgroupCollector(cgroup_root) if cgroup_root else None
+cgroup_cpu_rates = DeviceRates(('usage_usec',), NO_EXCLUDE, 100 / 1e6)  # percent of one CPU
+cgroup_io_rates = DeviceRates(('read_bytes', 'write_bytes'), NO_EXCLUDE, 1 / 1024 ** 2)
+cgroups_shared = None
+if cgroup_collector is not None:
+    cgroup_history_size = MetricHistory.buffer_size(len(CGROUP_METRICS), CGROUP_HISTORY_SIZE)
+    # The full table goes to its own segment; samples only carry the busiest cgroups
+    cgroups_shared = SharedSegment(default_segment_path('aseman-monitor-cgroups'), SHARED_PAYLOAD_SIZE,
+                                   cgroup_history_size * CGROUP_HISTORY_SLOTS,
+                                   layout=repr((CGROUP_METRICS, CGROUP_HISTORY_SIZE, CGROUP_HISTORY_SLOTS)))
+    cgroup_histories = CgroupHistories(cgroups_shared,
+                                       lambda buffer: MetricHistory(CGROUP_METRICS, CGROUP_HISTORY_SIZE, buffer),
+                                       cgroup_history_size, CGROUP_HISTORY_SLOTS)
+
+@timings.timed('collector.cgroups')
+def collect_cgroups(now, timestamp):
+    """Rates of every cgroup since the previous tick, and the busiest of them for the sample."""
+    counters, memory = cgroup_collector.read()
+    cpu = cgroup_cpu_rates.update(counters, now)
+    io = cgroup_io_rates.update(counters, now)
+    names = cpu['names']
+    table = {
+        'names': names,
+        'cpu_percent': cpu['usage_usec'],
+        'memory_mb': [round(memory.get(name, 0) / 1024 ** 2, 1) for name in names],
+        'read_speed': io['read_bytes'],
+        'write_speed': io['write_bytes']
+    }
+    positions = range(len(names))
+    busiest = set(heapq.nlargest(CGROUP_TOP_N, positions, key=table['cpu_percent'].__getitem__))
+    busiest.update(heapq.nlargest(CGROUP_TOP_N, positions, key=table['memory_mb'].__getitem__))
+    busiest = sorted(busiest, key=lambda position: -table['cpu_percent'][position])
+    summary = {column: [values[position] for position in busiest] for column, values in table.items()}
+
+    payload = json.dumps({'timestamp': timestamp, 'slots': cgroup_histories.slots, **table}).encode()
+    with cgroups_shared.writing():
+        cgroup_histories.assign(timestamp, set(names), summary['names'])
+        cgroup_histories.record(timestamp, table)
+        cgroups_shared.publish(payload)
+    return summary
 
-    prev_net_io = current_net_io
-    prev_disk_io = current_disk_io
-    last_update = time.time()
+def default_interface():
+    try:
+        with open('/proc/net/route', 'r') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[1] == '00000000':
+                    return fields[0]
+    except (OSError, IndexError):
+        pass
+    return None
+
+def run_tc(*args):
+    result = subprocess.run(['tc', *args], capture_output=True, text=True)
+    if result.returncode != 0:
+        logging.error(f"tc {' '.join(args)} failed: {result.stderr.strip()}")
+
+def shutdown_server():
+    save_traffic_data()
+    os.system('shutdown now')
+
+# The billing cycle in which the limit last shut the host down. A host still
+# over its limit after booting again is left running for the rest of that cycle,
+# so an admin can raise the limit.
+limit_state_file = CachedJSONFile(LIMIT_STATE_FILE)
+
+def apply_limit_action(action, used_tb, cycle_start):
+    logging.warning(f"Traffic limit reached: {used_tb:.4f} TB used of {network_limit} TB, action: {action}")
+    if action == 'throttle':
+        interface = limit_config['interface'] or default_interface()
+        if interface is None:
+            logging.error("Not throttling: no default route, set 'interface' in network_limit.json")
+            return
+        run_tc('qdisc', 'replace', 'dev', interface, 'root', 'tbf',
+               'rate', limit_config['throttle_rate'], 'burst', '32kbit', 'latency', '400ms')
+    elif action == 'shutdown':
+        limit_state_file.refresh()  # another worker may have led when it last fired
+        state = limit_state_file.get()
+        if isinstance(state, dict) and state.get('shutdown_cycle') == cycle_start:
+            logging.warning(f"Already shut down in the cycle started {cycle_start}, not shutting down again")
+            return
+        limit_state_file.set({'shutdown_cycle': cycle_start})
+        shutdown_server()
+
+def release_limit_action(action, used_tb):
+    logging.info(f"Traffic back under the limit: {used_tb:.4f} TB used, releasing {action}")
+    if action == 'throttle':
+        interface = limit_config['interface'] or default_interface()
+        if interface is not None:  # else nothing was throttled, as apply_limit_action() logged
+            run_tc('qdisc', 'del', 'dev', interface, 'root')
+
+# Which action is currently applied, None while under the limit
+limit_state = {'action': None}
+
+def enforce_limit(used_bytes, cycle_start):
+    """Compare the traffic of the billing cycle with the limit on every sampler tick.
+
+    Only a crossing does any work: the action runs once when the limit is
+    reached and is released once usage drops `hysteresis` below it, e.g.
+    after the limit is raised or when a new cycle starts. Actions run on a scheduler worker so a slow
+    `tc` never delays the next sample. A shutdown runs at most once per cycle.
+    """
+    used_tb = used_bytes / 1024 ** 4
+    applied = limit_state['action']
+    if applied is None:
+        if network_limit and used_tb >= network_limit:
+            limit_state['action'] = limit_config['action']
+            scheduler.add_job(func=apply_limit_action, args=(limit_state['action'], used_tb, cycle_start))
+    elif not network_limit or used_tb < network_limit * (1 - limit_config['hysteresis']):
+        limit_state['action'] = None
+        scheduler.add_job(func=release_limit_action, args=(applied, used_tb))
 
-    current_total_sent = total_sent + (current_net_io.bytes_sent - initial_sent)
-    current_total_recv = total_recv + (current_net_io.bytes_recv - initial_recv)
+def publish_sample(sample, payload):
+    """Make `sample` the one every /data, /stream and /history reader sees."""
+    global latest_sample, latest_payload, latest_event, sample_seq
+    with sample_ready:
+        latest_sample = sample
+        latest_payload = payload
+        latest_event = b'data: ' + payload + b'\n\n'
+        sample_seq += 1
+        sample_ready.notify_all()
+    for listener in sample_listeners:
+        listener()
+
+# Key order of a sample, and of the values in the compact /data encodings
+SAMPLE_FIELDS = ('timestamp', 'cpu_usage', 'cpu_cores', 'cpu_per_core', 'cpu_iowait', 'cpu_steal',
+                 'cpu_softirq', 'load_1', 'load_5', 'load_15', 'ctx_switches', 'memory_usage',
+                 'total_ram', 'bytes_sent', 'bytes_recv', 'sent_speed', 'recv_speed', 'total_speed',
+                 'read_speed', 'write_speed', 'disk_usage', 'uptime', 'time_remaining',
+                 'network_limit', 'limit_exceeded', 'interfaces', 'disks',
+                 'cycle_start', 'cycle_sent', 'cycle_recv', 'alerts', 'cgroups')
+
+@timings.timed('collector.sample')
+def collect_sample():
+    with timings.timer('collector.read'):
+        reading = collector.read()
+    now = time.monotonic()
+    sent_speed, recv_speed, read_speed, write_speed, ctx_switches = compute_rates(
+        reading.net_io, reading.disk_io, reading.ctx_switches, now)
+    interfaces, disks = collect_device_rates(now, reading.nic_counters, reading.disk_counters)
+    boot_time = reading.boot_time
+    traffic_account.update(reading.nic_counters, boot_time, time.time())
+    total_sent, total_recv = traffic_account.totals()
+    cycle_start, cycle_sent, cycle_recv = traffic_account.cycle_usage()
+
+    # Padded so a hot-unplugged core does not shift the packed array
+    per_core = [round(value, 1) for value in reading.cpu_per_core]
+    per_core = (per_core + [0.0] * LOGICAL_CORES)[:LOGICAL_CORES]
+    load_1, load_5, load_15 = reading.load
 
     install_time = get_install_time()
     time_remaining = 432000 - (time.time() - install_time)
 
-    return {
-        'cpu_usage': psutil.cpu_percent(interval=1),
+    sample = {
+        'timestamp': time.time(),
+        'cpu_usage': reading.cpu_percent,
         'cpu_cores': CPU_CORES,
-        'memory_usage': psutil.virtual_memory().percent,
+        'cpu_per_core': per_core,
+        'cpu_iowait': reading.cpu_iowait,
+        'cpu_steal': reading.cpu_steal,
+        'cpu_softirq': reading.cpu_softirq,
+        'load_1': load_1,
+        'load_5': load_5,
+        'load_15': load_15,
+        'ctx_switches': ctx_switches,
+        'memory_usage': reading.memory_percent,
         'total_ram': TOTAL_RAM,
-        'bytes_sent': current_total_sent,
-        'bytes_recv': current_total_recv,
+        'bytes_sent': total_sent,
+        'bytes_recv': total_recv,
         'sent_speed': sent_speed,
         'recv_speed': recv_speed,
-        'total_speed': total_speed,
+        'total_speed': sent_speed + recv_speed,
         'read_speed': read_speed,
         'write_speed': write_speed,
-        'disk_usage': psutil.disk_usage('/').percent,
-        'uptime': time.time() - psutil.boot_time(),
-        'time_remaining': max(0, time_remaining)
+        'disk_usage': reading.disk_percent,
+        'uptime': time.time() - boot_time,
+        'time_remaining': max(0, time_remaining),
+        'network_limit': network_limit,
+        'limit_exceeded': limit_state['action'] is not None,
+        'interfaces': interfaces,
+        'disks': disks,
+        'cycle_start': cycle_start,
+        'cycle_sent': cycle_sent,
+        'cycle_recv': cycle_recv
     }
+    sample['cgroups'] = None
+    if cgroup_collector is not None:
+        try:
+            sample['cgroups'] = collect_cgroups(now, sample['timestamp'])
+        except Exception as e:
+            logging.error(f"cgroup collection failed: {str(e)}")
+    with timings.timer('collector.alerts'):
+        sample['alerts'] = alerts.evaluate(sample)  # names of the firing rules
 
-@app.route('/')
-def index():
-    return render_template_string('''
+    with timings.timer('collector.json_encode'):
+        payload = json.dumps(sample).encode()
+    with shared.writing():
+        shared.publish(payload)
+        history.append(sample['timestamp'], sample)
+        core_history.append(sample['timestamp'], dict(zip(CORE_METRICS, per_core)))
+    publish_sample(sample, payload)
+    enforce_limit(cycle_sent + cycle_recv, cycle_start)
+    for rollup in rollups:
+        rollup.add(sample)
+
+@timings.timed('job.deliver_alerts')
+def deliver_alerts_job():
+    alerts.deliver()
+
+def collect_sample_job():
+    try:
+        collect_sample()
+    except Exception as e:
+        logging.error(f"Sampler tick failed: {str(e)}")
+
+def get_system_info():
+    """Return the latest snapshot taken by the sampler (never blocks on psutil)."""
+    with sample_lock:
+        return latest_sample
+
+def stream_samples(interval):
+    """Yield SSE frames, at most one per `interval` seconds.
+
+    Every client gets the same pre-encoded frame. A slow client blocks only its
+    own generator on the socket write and then skips straight to the newest
+    sample, so nothing queues up on the server.
+    """
+    global stream_clients
+    last_seq = None
+    try:
+        yield f'retry: {int(interval * 1000)}\n\n'.encode()
+        while True:
+            with sample_ready:
+                sample_ready.wait_for(lambda: sample_seq != last_seq, timeout=STREAM_KEEPALIVE)
+                seq, event = sample_seq, latest_event
+            if seq == last_seq:
+                yield b': keepalive\n\n'
+                continue
+            last_seq = seq
+            sent_at = time.monotonic()
+            yield event
+            # Wake up half a tick before the deadline, then wait for a fresh sample
+            delay = sent_at + interval - SAMPLE_INTERVAL / 2 - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+                with sample_lock:
+                    last_seq = sample_seq
+    finally:
+        with sample_lock:
+            stream_clients -= 1
+
+# (sample key, metric name, type, help) of the scalar metrics on /metrics
+PROMETHEUS_METRICS = (
+    ('cpu_usage', 'cpu_usage_percent', 'gauge', 'CPU utilisation in percent'),
+    ('cpu_iowait', 'cpu_iowait_percent', 'gauge', 'CPU time waiting for I/O in percent'),
+    ('cpu_steal', 'cpu_steal_percent', 'gauge', 'CPU time stolen by the hypervisor in percent'),
+    ('cpu_softirq', 'cpu_softirq_percent', 'gauge', 'CPU time serving soft interrupts in percent'),
+    ('load_1', 'load1', 'gauge', '1 minute load average'),
+    ('load_5', 'load5', 'gauge', '5 minute load average'),
+    ('load_15', 'load15', 'gauge', '15 minute load average'),
+    ('ctx_switches', 'context_switches_per_second', 'gauge', 'Context switches per second'),
+    ('memory_usage', 'memory_usage_percent', 'gauge', 'Memory utilisation in percent'),
+    ('disk_usage', 'disk_usage_percent', 'gauge', 'Usage of the root filesystem in percent'),
+    ('sent_speed', 'network_transmit_mbps', 'gauge', 'Transmit rate over all interfaces in Mbps'),
+    ('recv_speed', 'network_receive_mbps', 'gauge', 'Receive rate over all interfaces in Mbps'),
+    ('read_speed', 'disk_read_mbytes_per_second', 'gauge', 'Read rate over all disks in MB/s'),
+    ('write_speed', 'disk_write_mbytes_per_second', 'gauge', 'Write rate over all disks in MB/s'),
+    ('bytes_sent', 'network_transmit_bytes_total', 'counter', 'Bytes transmitted since installation'),
+    ('bytes_recv', 'network_receive_bytes_total', 'counter', 'Bytes received since installation'),
+    ('cycle_sent', 'network_cycle_transmit_bytes', 'gauge', 'Bytes transmitted in the current billing cycle'),
+    ('cycle_recv', 'network_cycle_receive_bytes', 'gauge', 'Bytes received in the current billing cycle'),
+    ('uptime', 'uptime_seconds', 'gauge', 'Seconds since boot'),
+)
+PROMETHEUS_PREFIX = 'aseman_'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Everything but the values is built once: headers and label strings
+PROMETHEUS_HEADERS = {
+    name: f'# HELP {PROMETHEUS_PREFIX}{name} {description}\n# TYPE {PROMETHEUS_PREFIX}{name} {kind}\n'
+    for _, name, kind, description in PROMETHEUS_METRICS
+}
+CORE_LABELS = [f'{PROMETHEUS_PREFIX}cpu_core_usage_percent{{core="{index}"}} ' for index in range(LOGICAL_CORES)]
+device_labels = {}
+
+def device_label(metric, name):
+    label = device_labels.get((metric, name))
+    if label is None:
+        if len(device_labels) > 4096:
+            device_labels.clear()  # veth churn on container hosts
+        escaped = name.replace('\\', '\\\\').replace('"', '\\"')
+        label = device_labels[(metric, name)] = f'{PROMETHEUS_PREFIX}{metric}{{device="{escaped}"}} '
+    return label
+
+@timings.timed('render.prometheus')
+def render_prometheus(sample):
+    """Text exposition of one sample; called at most once per tick."""
+    parts = []
+    for key, name, _, _ in PROMETHEUS_METRICS:
+        if key in sample:
+            parts.append(f'{PROMETHEUS_HEADERS[name]}{PROMETHEUS_PREFIX}{name} {sample[key]}\n')
+    if network_limit:
+        parts.append(f'# TYPE {PROMETHEUS_PREFIX}network_limit_bytes gauge\n'
+                     f'{PROMETHEUS_PREFIX}network_limit_bytes {network_limit * 1024 ** 4}\n')
+
+    parts.append(f'# TYPE {PROMETHEUS_PREFIX}cpu_core_usage_percent gauge\n')
+    for label, value in zip(CORE_LABELS, sample.get('cpu_per_core', ())):
+        parts.append(f'{label}{value}\n')
+
+    for group, fields in (('interfaces', (('sent_speed', 'interface_transmit_mbps'),
+                                          ('recv_speed', 'interface_receive_mbps'))),
+                          ('disks', (('read_speed', 'device_read_mbytes_per_second'),
+                                     ('write_speed', 'device_write_mbytes_per_second')))):
+        devices = sample.get(group)
+        if not devices:
+            continue
+        for key, metric in fields:
+            parts.append(f'# TYPE {PROMETHEUS_PREFIX}{metric} gauge\n')
+            for name, value in zip(devices['names'], devices[key]):
+                parts.append(f'{device_label(metric, name)}{value}\n')
+    return ''.join(parts).encode()
+
+# Rendered exposition of the sample with sequence number 'seq'
+metrics_cache = {'seq': None, 'identity': b'', 'gzip': None}
+metrics_lock = threading.Lock()
+
+def get_prometheus_metrics(encoding):
+    with sample_lock:
+        seq, sample = sample_seq, latest_sample
+    with metrics_lock:
+        if metrics_cache['seq'] != seq:
+            metrics_cache.update(seq=seq, identity=render_prometheus(sample), gzip=None)
+        if encoding == 'gzip' and metrics_cache['gzip'] is None:
+            metrics_cache['gzip'] = gzip.compress(metrics_cache['identity'], 6)
+        return metrics_cache[encoding]
+
+encoded_samples = {'seq': None}
+encoded_samples_lock = threading.Lock()
+
+def get_encoded_sample(format):
+    """The latest sample in a compact wire format, encoded once per sample."""
+    with sample_lock:
+        seq, sample = sample_seq, latest_sample
+    with encoded_samples_lock:
+        if encoded_samples['seq'] != seq:
+            encoded_samples.clear()
+            encoded_samples['seq'] = seq
+        if format not in encoded_samples:
+            values = wire.compact_sample(sample or {}, SAMPLE_FIELDS)
+            encoded_samples[format] = wire.pack(values) if format == 'msgpack' else json.dumps(values).encode()
+        return encoded_samples[format]
+
+PROCESS_SCAN_INTERVAL = 5  # seconds, process scans are much dearer than a sample
+PROCESS_TOP_N = 10
+PROCESS_SORT_KEYS = ('cpu_percent', 'memory_rss', 'io_speed')
+
+class ProcessCollector:
+    """Top processes by CPU, memory and I/O, scanned incrementally.
+
+    psutil.Process objects are kept between scans, so names and command lines
+    are resolved once per process and CPU and I/O rates come from the difference
+    with the previous scan. Each scan reads a process once through oneshot()
+    and ranks with a bounded heap per metric.
+    """
+
+    def __init__(self, top_n):
+        self.top_n = top_n
+        self.processes = {}  # pid -> entry
+        self.last_scan = None
+
+    def _track(self, pid):
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                try:
+                    name = process.name()
+                except psutil.ZombieProcess:
+                    name = ''
+                try:
+                    cmdline = ' '.join(process.cmdline())[:200]
+                except (psutil.AccessDenied, psutil.ZombieProcess):
+                    cmdline = ''
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return None
+        return {'process': process, 'name': name, 'cmdline': cmdline, 'cpu_time': None, 'io_bytes': None}
+
+    def _read(self, entry):
+        process = entry['process']
+        with process.oneshot():
+            cpu_times = process.cpu_times()
+            rss = process.memory_info().rss
+            try:
+                io = process.io_counters()
+                io_bytes = io.read_bytes + io.write_bytes
+            except (psutil.AccessDenied, AttributeError):
+                io_bytes = None
+        return cpu_times.user + cpu_times.system, rss, io_bytes
+
+    def scan(self):
+        now = time.monotonic()
+        time_diff = now - self.last_scan if self.last_scan is not None else None
+        self.last_scan = now
+
+        pids = set(psutil.pids())
+        for pid in self.processes.keys() - pids:
+            del self.processes[pid]
+        for pid in pids - self.processes.keys():
+            entry = self._track(pid)
+            if entry is not None:
+                self.processes[pid] = entry
+
+        rows = []
+        for pid, entry in list(self.processes.items()):
+            if not entry['process'].is_running():
+                # The PID was reused since the last scan (is_running() compares
+                # create times): resolve the name and command line again
+                entry = self._track(pid)
+                if entry is None:
+                    del self.processes[pid]
+                    continue
+                self.processes[pid] = entry
+            try:
+                cpu_time, rss, io_bytes = self._read(entry)
+            except psutil.ZombieProcess:
+                continue  # exited but not reaped: kept, so it is not resolved again every scan
+            except psutil.NoSuchProcess:
+                del self.processes[pid]
+                continue
+            except psutil.AccessDenied:
+                continue
+
+            cpu_percent = io_speed = 0.0
+            if time_diff and entry['cpu_time'] is not None:
+                cpu_percent = counter_delta(cpu_time, entry['cpu_time']) / time_diff * 100
+            if time_diff and io_bytes is not None and entry['io_bytes'] is not None:
+                io_speed = counter_delta(io_bytes, entry['io_bytes']) / (time_diff * 1024**2)
+            entry['cpu_time'], entry['io_bytes'] = cpu_time, io_bytes
+            rows.append({'pid': pid, 'name': entry['name'], 'cmdline': entry['cmdline'],
+                         'cpu_percent': round(cpu_percent, 1), 'memory_rss': rss,
+                         'io_speed': round(io_speed, 3)})
+
+        return {
+            'timestamp': time.time(),
+            'process_count': len(rows),
+            **{key: heapq.nlargest(self.top_n, rows, key=lambda row: row[key]) for key in PROCESS_SORT_KEYS}
+        }
+
+process_collector = ProcessCollector(PROCESS_TOP_N)
+# Scans are published for every worker like the samples are
+processes_shared = SharedSegment(default_segment_path('aseman-monitor-processes'), 256 * 1024, 0,
+                                 layout=repr(PROCESS_SORT_KEYS))
+
+@timings.timed('collector.processes')
+def scan_processes_job():
+    try:
+        payload = json.dumps(process_collector.scan()).encode()
+        with processes_shared.writing():
+            processes_shared.publish(payload)
+    except Exception as e:
+        logging.error(f"Process scan failed: {str(e)}")
+
+HUB_DEFAULTS = {
+    'agents': [],        # [{'name': ..., 'url': 'http://host:5000', 'timeout': seconds}], no url: push only
+    'interval': 5,       # seconds between two polls of every agent
+    'timeout': 3,        # default per-agent request timeout in seconds
+    'concurrency': 64,   # requests in flight at once
+    'push_token': None,  # token agents must send to POST /hub/push
+    'push': None         # on an agent: {'url': 'http://hub:5000/hub/push', 'name': ..., 'token': ...}
+}
+FLEET_HISTORY_SIZE = 720  # samples kept per agent, one hour at the default interval
+
+def load_hub_config():
+    """Read hub.json once; the agent list sizes a shared segment, so edits need a restart."""
+    try:
+        with open(HUB_FILE, 'r') as f:
+            config = {**HUB_DEFAULTS, **json.load(f)}
+    except FileNotFoundError:
+        return dict(HUB_DEFAULTS)
+    except (OSError, json.JSONDecodeError, TypeError) as e:
+        logging.error(f"Could not load '{HUB_FILE}', hub mode is off: {str(e)}")
+        return dict(HUB_DEFAULTS)
+
+    agents = []
+    for agent in config['agents']:
+        if not isinstance(agent, dict) or not agent.get('name') or agent['name'] in {a['name'] for a in agents}:
+            logging.error(f"Ignoring hub agent without a unique name: {agent!r}")
+            continue
+        agents.append(agent)
+    config['agents'] = agents
+    if config['push_token'] is not None and not isinstance(config['push_token'], str):
+        logging.error("Ignoring hub push_token, it must be a string: POST /hub/push is off")
+        config['push_token'] = None
+    return config
+
+hub_config = load_hub_config()
+fleet_history_size = MetricHistory.buffer_size(len(HISTORY_METRICS), FLEET_HISTORY_SIZE)
+fleet = None
+if hub_config['agents']:
+    fleet_shared = SharedSegment(default_segment_path('aseman-monitor-fleet'), SHARED_PAYLOAD_SIZE,
+                                 fleet_history_size * len(hub_config['agents']),
+                                 layout=repr((HISTORY_METRICS, FLEET_HISTORY_SIZE,
+                                              [agent['name'] for agent in hub_config['agents']])))
+    fleet = hub.Fleet(hub_config['agents'], fleet_shared,
+                      lambda buffer: MetricHistory(HISTORY_METRICS, FLEET_HISTORY_SIZE, buffer),
+                      fleet_history_size, stale_after=3 * hub_config['interval'])
+
+def start_hub_jobs():
+    """Leader only: poll the agents and/or push our samples, all on one event loop thread."""
+    client = hub.AsyncHTTPClient()
+    jobs = []
+    if fleet is not None and any(agent.get('url') for agent in hub_config['agents']):
+        async def poll_agents():
+            with timings.timer('hub.poll'):
+                await fleet.poll(client, hub_config['timeout'], hub_config['concurrency'])
+        jobs.append((hub_config['interval'], poll_agents))
+    push = hub_config['push']
+    if isinstance(push, dict) and push.get('url') and push.get('name'):
+        def get_payload():
+            with sample_lock:
+                return latest_payload
+        jobs.append((push.get('interval', hub_config['interval']),
+                     hub.push_job(client, push, get_payload, hub_config['timeout'])))
+    if jobs:
+        hub.run_in_background(jobs)
+
+FOLLOW_INTERVAL = SAMPLE_INTERVAL / 4  # how often followers look for a new sample
+ELECTION_INTERVAL = 2  # seconds between two attempts of a follower to take the lock
+
+followed_seq = None
+
+@timings.timed('job.follow_leader')
+def follow_leader():
+    """Follower job: republish the leader's latest sample to local readers."""
+    global followed_seq
+    if shared.seq == followed_seq or not shared.valid:
+        return
+    followed_seq = shared.seq
+    payload = shared.read_payload()
+    if payload:
+        publish_sample(json.loads(payload), payload)
+
+def become_leader():
+    """Start sampling and writing, continuing from the previous leader's state."""
+    shared.claim()
+    traffic_store.reopen(readonly=False)
+    for rollup in rollups:
+        rollup.store.reopen(readonly=False)
+
+    # The saved account holds the counters it was saved with, so the first
+    # tick counts exactly what the previous leader had not saved yet.
+    open_traffic_account()
+    reading = collector.read()
+    sampler_state.update(net_io=reading.net_io, disk_io=reading.disk_io,
+                         ctx_switches=reading.ctx_switches, time=time.monotonic())
+
+    collect_sample()
+    scheduler.add_job(func=collect_sample_job, trigger="interval", seconds=SAMPLE_INTERVAL,
+                      max_instances=1, coalesce=True, id='sampler', replace_existing=True)
+    if cgroups_shared is not None:
+        cgroups_shared.claim()
+    processes_shared.claim()
+    scheduler.add_job(func=scan_processes_job, trigger="interval", seconds=PROCESS_SCAN_INTERVAL,
+                      max_instances=1, coalesce=True, id='processes', replace_existing=True,
+                      next_run_time=datetime.now())
+    scheduler.add_job(func=deliver_alerts_job, trigger="interval", seconds=ALERT_DELIVERY_INTERVAL,
+                      max_instances=1, coalesce=True, id='alerts', replace_existing=True)
+    start_hub_jobs()
+    logging.info(f"Process {os.getpid()} is now the sampling leader")
+
+def elect_leader():
+    if leader_lock.acquire():
+        scheduler.remove_job('follower')
+        scheduler.remove_job('election')
+        become_leader()
+
+if leader_lock.held:
+    become_leader()
+else:
+    follow_leader()
+    scheduler.add_job(func=follow_leader, trigger="interval", seconds=FOLLOW_INTERVAL,
+                      max_instances=1, coalesce=True, id='follower')
+    scheduler.add_job(func=elect_leader, trigger="interval", seconds=ELECTION_INTERVAL,
+                      max_instances=1, coalesce=True, id='election')
+scheduler.add_job(func=sync_stores, trigger="interval", minutes=5)
+atexit.register(sync_stores)
+
+DASHBOARD_TEMPLATE = '''
         <!DOCTYPE html>
         <html>
         <head>
@@ -244,9 +1408,53 @@ def index():
                     border-radius: 8px;
                     display: none;
                 }
+                .core-bars {
+                    display: flex;
+                    align-items: flex-end;
+                    gap: 1px;
+                    height: 30px;
+                    margin-top: 8px;
+                }
+                .core-bars span {
+                    flex: 1;
+                    min-width: 2px;
+                }
+                .process-box {
+                    margin-bottom: 30px;
+                }
+                .process-table {
+                    width: 100%;
+                    border-collapse: collapse;
+                    font-family: monospace;
+                    font-size: 0.85rem;
+                    margin-top: 10px;
+                }
+                .process-table td, .process-table th {
+                    padding: 4px 8px;
+                    text-align: right;
+                }
+                .process-table td:nth-child(2), .process-table th:nth-child(2) {
+                    text-align: left;
+                }
+                .device-stats {
+                    font-family: monospace;
+                    font-size: 0.85rem;
+                    text-align: left;
+                }
                 .admin-panel {
                     display: none;
                 }
+                #alerts-banner {
+                    display: none;
+                    position: fixed;
+                    top: 20px;
+                    right: 20px;
+                    background: #ff4444;
+                    color: white;
+                    padding: 10px 15px;
+                    border-radius: 8px;
+                    z-index: 3000;
+                }
                 #countdown {
                     position: fixed;
                     bottom: 20px;
@@ -318,6 +1526,7 @@ def index():
 
             <div id="errorMessage">شما به صفحه کلاینت وارد شدید</div>
 
+            <div id="alerts-banner"></div>
             <div id="countdown">Until the end of the free subscription :
 		</br></br>
 		 5d 00:00:00</div>
@@ -332,6 +1541,8 @@ def index():
                         <div class="stat-details">
                             Cores: {{ cpu_cores }}
                         </div>
+                        <div id="core-bars" class="core-bars"></div>
+                        <div id="load-average" class="stat-details"></div>
                     </div>
                     
                     <div class="stat-box">
@@ -362,16 +1573,50 @@ def index():
                     <div class="stat-box">
                         <h3>Traffic</h3>
                         <span id="network-usage">0 TB</span>
+                        <div id="traffic-details" class="stat-details"></div>
+                        <div id="traffic-forecast" class="stat-details"></div>
                         <div id="network-limit-display"></div>
                     </div>
                     
+                    <div class="stat-box">
+                        <h3>Interfaces</h3>
+                        <div id="interface-stats" class="device-stats"></div>
+                    </div>
+
+                    <div class="stat-box">
+                        <h3>Disks</h3>
+                        <div id="disk-stats" class="device-stats"></div>
+                    </div>
+                    
                     <div class="stat-box admin-panel" id="adminPanel">
                         <h3>Limit</h3>
                         <input type="number" id="networkLimit" placeholder="Limit (TB)" style="margin: 10px 0; padding: 8px;">
                         <button onclick="setLimit()" style="background: #00cc88;">تنظیم محدودیت</button>
+                        <button onclick="logout()" style="background: #ff4444;">Logout</button>
                     </div>
                 </div>
 
+                <div class="stat-box process-box">
+                    <h3>Top processes</h3>
+                    <select id="processSort" onchange="loadProcesses()">
+                        <option value="cpu_percent">CPU</option>
+                        <option value="memory_rss">Memory</option>
+                        <option value="io_speed">I/O</option>
+                    </select>
+                    <table class="process-table">
+                        <thead><tr><th>PID</th><th>Name</th><th>CPU %</th><th>RAM MB</th><th>I/O MB/s</th></tr></thead>
+                        <tbody id="process-rows"></tbody>
+                    </table>
+                </div>
+
+                <div class="stat-box process-box" id="cgroup-box" style="display: none;">
+                    <h3>Services &amp; containers</h3>
+                    <table class="process-table">
+                        <thead><tr><th>CPU %</th><th>Name</th><th>RAM MB</th><th>Read MB/s</th><th>Write MB/s</th></tr></thead>
+                        <tbody id="cgroup-rows"></tbody>
+                    </table>
+                </div>
+
                 <div class="chart-container">
                     <canvas id="cpuChart"></canvas>
                 </div>
@@ -417,8 +1662,8 @@ def index():
             <script>
                 let cpuChart, memoryChart, networkChart, ioChart;
                 let cpuPopupChart, memoryPopupChart, networkPopupChart, ioPopupChart;
-                let currentLimit = {{ network_limit|tojson|safe }};
-                let currentCredentials = null;
+                let currentLimit = null;
+                let sessionToken = null;
 
                 window.onload = () => {
                     document.getElementById('loginModal').style.display = 'block';
@@ -439,7 +1684,8 @@ def index():
                     if(data.success) {
                         document.getElementById('loginModal').style.display = 'none';
                         document.getElementById('adminPanel').style.display = 'block';
-                        currentCredentials = {username, password};
+                        sessionToken = data.token;
+                        document.getElementById('password').value = '';
                     } else {
                         document.getElementById('loginModal').style.display = 'none';
                         document.getElementById('errorMessage').style.display = 'block';
@@ -511,6 +1757,71 @@ def index():
                         case 'network': networkPopupChart = newChart; break;
                         case 'io': ioPopupChart = newChart; break;
                     }
+
+                    fetchHistory(chartMetrics[type]).then(history => {
+                        fillChart(newChart, history, chartMetrics[type], history.timestamps.length);
+                    });
+                }
+
+                const chartMetrics = {
+                    cpu: ['cpu_usage'],
+                    memory: ['memory_usage'],
+                    network: ['recv_speed', 'sent_speed', 'total_speed'],
+                    io: ['read_speed', 'write_speed']
+                };
+
+                async function fetchHistory(metrics, since) {
+                    const params = new URLSearchParams({metric: metrics.join(','), format: 'f32'});
+                    if(since !== undefined) params.set('since', since);
+                    const response = await fetch(`/history?${params}`);
+                    return decodeHistory(await response.arrayBuffer(), response.headers.get('X-Columns').split(','));
+                }
+
+                // Binary history: header, varint millisecond deltas, then one float32 array per column
+                function decodeHistory(buffer, columns) {
+                    const view = new DataView(buffer);
+                    const count = view.getUint32(4, true);
+                    const timestamps = new Array(count);
+                    let offset = 20;
+                    let time = Math.round(view.getFloat64(12, true) * 1000);
+                    for(let i = 0; i < count; i++) {
+                        if(i > 0) {
+                            let delta = 0, shift = 0, byte;
+                            do {
+                                byte = view.getUint8(offset++);
+                                delta += (byte & 0x7f) * 2 ** shift;
+                                shift += 7;
+                            } while(byte & 0x80);
+                            time += delta;
+                        }
+                        timestamps[i] = time / 1000;
+                    }
+                    offset += (4 - offset % 4) % 4;
+                    const history = {timestamps: timestamps};
+                    columns.forEach(column => {
+                        history[column] = Array.from(new Float32Array(buffer, offset, count), value => Math.round(value * 1000) / 1000);
+                        offset += count * 4;
+                    });
+                    return history;
+                }
+
+                function fillChart(chart, history, metrics, maxPoints) {
+                    const start = Math.max(0, history.timestamps.length - maxPoints);
+                    chart.data.labels = history.timestamps.slice(start)
+                        .map(ts => new Date(ts * 1000).toLocaleTimeString());
+                    metrics.forEach((metric, index) => {
+                        chart.data.datasets[index].data = history[metric].slice(start);
+                    });
+                    chart.update();
+                }
+
+                async function loadRecentHistory() {
+                    const since = Date.now() / 1000 - 60;
+                    const history = await fetchHistory(Object.values(chartMetrics).flat(), since);
+                    fillChart(cpuChart, history, chartMetrics.cpu, 16);
+                    fillChart(memoryChart, history, chartMetrics.memory, 16);
+                    fillChart(networkChart, history, chartMetrics.network, 16);
+                    fillChart(ioChart, history, chartMetrics.io, 16);
                 }
 
                 function updateChart(chart, values, label) {
@@ -549,20 +1860,29 @@ def index():
                     
                     const response = await fetch('/set_limit', {
                         method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({
-                            limit: limit,
-                            username: currentCredentials.username,
-                            password: currentCredentials.password
-                        })
+                        headers: {'Content-Type': 'application/json', 'Authorization': `Bearer ${sessionToken}`},
+                        body: JSON.stringify({limit: limit})
                     });
                     
                     if(response.ok) {
                         currentLimit = limit;
                         updateLimitDisplay();
+                    } else if(response.status === 401) {
+                        endSession();
                     }
                 }
 
+                function endSession() {
+                    sessionToken = null;
+                    document.getElementById('adminPanel').style.display = 'none';
+                    document.getElementById('loginModal').style.display = 'block';
+                }
+
+                async function logout() {
+                    await fetch('/logout', {method: 'POST', headers: {'Authorization': `Bearer ${sessionToken}`}});
+                    endSession();
+                }
+
                 function updateLimitDisplay() {
                     const limitDisplay = currentLimit !== null ? 
                         `${currentLimit} TB (${((currentNetworkUsage / currentLimit) * 100).toFixed(1)}%)` : 
@@ -572,6 +1892,69 @@ def index():
 
                 let currentNetworkUsage = 0;
                 
+                async function loadProcesses() {
+                    const headers = sessionToken ? {'Authorization': `Bearer ${sessionToken}`} : {};
+                    const processes = await fetch('/processes', {headers}).then(res => res.json());
+                    const sortKey = document.getElementById('processSort').value;
+                    const rows = (processes[sortKey] || []).map(process => {
+                        const row = document.createElement('tr');
+                        [
+                            process.pid,
+                            process.name,
+                            process.cpu_percent.toFixed(1),
+                            (process.memory_rss / 1024 ** 2).toFixed(1),
+                            process.io_speed.toFixed(2)
+                        ].forEach(value => {
+                            const cell = document.createElement('td');
+                            cell.textContent = value;
+                            row.appendChild(cell);
+                        });
+                        row.title = process.cmdline || '';
+                        return row;
+                    });
+                    document.getElementById('process-rows').replaceChildren(...rows);
+                }
+
+                async function loadForecast() {
+                    const response = await fetch('/forecast');
+                    if(!response.ok) return;
+                    const forecast = await response.json();
+                    let text = `Projected by ${forecast.cycle_end}: ${(forecast.projected_cycle_bytes / 1024 ** 4).toFixed(3)} TB`;
+                    if(forecast.exhaustion_time !== null) {
+                        text += ` · limit reached ${new Date(forecast.exhaustion_time * 1000).toLocaleString()}`;
+                    }
+                    document.getElementById('traffic-forecast').textContent = text;
+                }
+
+                function renderCores(perCore) {
+                    const element = document.getElementById('core-bars');
+                    if(element.children.length !== perCore.length) {
+                        element.replaceChildren(...perCore.map(() => document.createElement('span')));
+                    }
+                    perCore.forEach((value, index) => {
+                        const bar = element.children[index];
+                        bar.style.height = `${Math.max(2, value * 0.3)}px`;
+                        bar.style.background = value > 90 ? '#ff4444' : value > 60 ? '#ff922b' : '#00cc88';
+                        bar.title = `CPU ${index}: ${value.toFixed(1)}%`;
+                    });
+                }
+
+                function renderDevices(elementId, devices, first, second, unit, firstMark, secondMark) {
+                    const rows = devices.names.map((name, index) => ({
+                        name: name,
+                        first: devices[first][index],
+                        second: devices[second][index]
+                    }));
+                    // Busiest devices first, so a saturated link or disk stands out
+                    rows.sort((a, b) => (b.first + b.second) - (a.first + a.second));
+                    const element = document.getElementById(elementId);
+                    element.replaceChildren(...rows.slice(0, 8).map(row => {
+                        const line = document.createElement('div');
+                        line.textContent = `${row.name}: ${row.first.toFixed(2)} ${firstMark} ${row.second.toFixed(2)} ${secondMark} ${unit}`;
+                        return line;
+                    }));
+                }
+
                 function formatTime(seconds) {
                     const days = Math.floor(seconds / 86400);
                     seconds %= 86400;
@@ -684,57 +2067,99 @@ def index():
                         }
                     });
 
-                    setInterval(async () => {
-                        const data = await fetch('/data').then(res => res.json());
-                        
-                        document.getElementById('cpu-usage').textContent = `${data.cpu_usage.toFixed(1)}%`;
-                        document.getElementById('memory-usage').textContent = `${data.memory_usage.toFixed(1)}%`;
-                        
-                        currentNetworkUsage = (data.bytes_sent + data.bytes_recv) / 1024 ** 4;
-                        document.getElementById('network-usage').textContent = `${currentNetworkUsage.toFixed(4)} TB`;
-
-                        document.getElementById('download-speed').textContent = `${data.recv_speed.toFixed(2)} Mbps ↓`;
-                        document.getElementById('upload-speed').textContent = `${data.sent_speed.toFixed(2)} Mbps ↑`;
-                        document.getElementById('total-speed').textContent = `${data.total_speed.toFixed(2)} Mbps ↔`;
-
-                        document.getElementById('read-speed').textContent = `${data.read_speed.toFixed(2)} MB/s Read`;
-                        document.getElementById('write-speed').textContent = `${data.write_speed.toFixed(2)} MB/s Write`;
-
-                        document.getElementById('countdown').textContent = `Until the end of the free subscription: ${formatTime(data.time_remaining)}`;
-                        
-                        if(data.time_remaining <= 0) {
-                            document.getElementById('countdown').textContent = "Self-destructing...";
-                            setTimeout(() => {
-                                window.location.reload();
-                            }, 1000);
-                        }
+                    loadRecentHistory();
+                    loadProcesses();
+                    setInterval(loadProcesses, 5000);
+                    loadForecast();
+                    setInterval(loadForecast, 60000);
 
-                        const timeLabel = new Date().toLocaleTimeString();
-                        
-                        updateChart(cpuChart, data.cpu_usage, timeLabel);
-                        updateChart(memoryChart, data.memory_usage, timeLabel);
-                        updateChart(networkChart, [
-                            data.recv_speed,
-                            data.sent_speed,
-                            data.total_speed
-                        ], timeLabel);
-                        updateChart(ioChart, [
-                            data.read_speed,
-                            data.write_speed
-                        ], timeLabel);
-                        
-                        if(currentLimit && currentNetworkUsage >= currentLimit) {
-                            if(currentCredentials) {
-                                fetch('/shutdown', {
-                                    method: 'POST',
-                                    headers: {'Content-Type': 'application/json'},
-                                    body: JSON.stringify(currentCredentials)
-                                });
-                            }
-                        }
-                        
-                        updateLimitDisplay();
-                    }, 1000);
+                    if(window.EventSource) {
+                        const events = new EventSource('/stream');
+                        events.onmessage = event => handleSample(JSON.parse(event.data));
+                    } else {
+                        setInterval(async () => {
+                            handleSample(await fetch('/data').then(res => res.json()));
+                        }, 1000);
+                    }
+                }
+
+                function renderCgroups(cgroups) {
+                    document.getElementById('cgroup-box').style.display = cgroups ? 'block' : 'none';
+                    if (!cgroups) return;
+                    const rows = cgroups.names.map((name, index) => {
+                        const row = document.createElement('tr');
+                        [
+                            cgroups.cpu_percent[index].toFixed(1),
+                            name.split('/').pop(),
+                            cgroups.memory_mb[index].toFixed(1),
+                            cgroups.read_speed[index].toFixed(2),
+                            cgroups.write_speed[index].toFixed(2)
+                        ].forEach(value => {
+                            const cell = document.createElement('td');
+                            cell.textContent = value;
+                            row.appendChild(cell);
+                        });
+                        row.title = name;
+                        return row;
+                    });
+                    document.getElementById('cgroup-rows').replaceChildren(...rows);
+                }
+                function handleSample(data) {
+                    document.getElementById('cpu-usage').textContent = `${data.cpu_usage.toFixed(1)}%`;
+                    document.getElementById('memory-usage').textContent = `${data.memory_usage.toFixed(1)}%`;
+                    
+                    currentNetworkUsage = (data.cycle_sent + data.cycle_recv) / 1024 ** 4;
+                    document.getElementById('network-usage').textContent = `${currentNetworkUsage.toFixed(4)} TB`;
+                    document.getElementById('traffic-details').textContent =
+                        `Since ${data.cycle_start}, ${((data.bytes_sent + data.bytes_recv) / 1024 ** 4).toFixed(3)} TB in total`;
+
+                    document.getElementById('download-speed').textContent = `${data.recv_speed.toFixed(2)} Mbps ↓`;
+                    document.getElementById('upload-speed').textContent = `${data.sent_speed.toFixed(2)} Mbps ↑`;
+                    document.getElementById('total-speed').textContent = `${data.total_speed.toFixed(2)} Mbps ↔`;
+
+                    document.getElementById('read-speed').textContent = `${data.read_speed.toFixed(2)} MB/s Read`;
+                    document.getElementById('write-speed').textContent = `${data.write_speed.toFixed(2)} MB/s Write`;
+
+                    const banner = document.getElementById('alerts-banner');
+                    const firing = data.alerts || [];
+                    banner.style.display = firing.length ? 'block' : 'none';
+                    banner.textContent = `Alerts: ${firing.join(', ')}`;
+
+                    renderCgroups(data.cgroups);
+
+                    renderCores(data.cpu_per_core);
+                    document.getElementById('load-average').textContent =
+                        `Load: ${data.load_1.toFixed(2)} ${data.load_5.toFixed(2)} ${data.load_15.toFixed(2)} · ` +
+                        `iowait ${data.cpu_iowait.toFixed(1)}% · steal ${data.cpu_steal.toFixed(1)}%`;
+
+                    renderDevices('interface-stats', data.interfaces, 'recv_speed', 'sent_speed', 'Mbps', '↓', '↑');
+                    renderDevices('disk-stats', data.disks, 'read_speed', 'write_speed', 'MB/s', 'R', 'W');
+
+                    document.getElementById('countdown').textContent = `Until the end of the free subscription: ${formatTime(data.time_remaining)}`;
+                    
+                    if(data.time_remaining <= 0) {
+                        document.getElementById('countdown').textContent = "Self-destructing...";
+                        setTimeout(() => {
+                            window.location.reload();
+                        }, 1000);
+                    }
+
+                    const timeLabel = new Date().toLocaleTimeString();
+                    
+                    updateChart(cpuChart, data.cpu_usage, timeLabel);
+                    updateChart(memoryChart, data.memory_usage, timeLabel);
+                    updateChart(networkChart, [
+                        data.recv_speed,
+                        data.sent_speed,
+                        data.total_speed
+                    ], timeLabel);
+                    updateChart(ioChart, [
+                        data.read_speed,
+                        data.write_speed
+                    ], timeLabel);
+                    
+                    currentLimit = data.network_limit;
+                    updateLimitDisplay();
                 }
 
                 initCharts();
@@ -742,47 +2167,456 @@ def index():
             <center><div class="Sabc-copyright">Powered by <a href="https://t.me/unknown_eng" data-wpel-link="internal" rel="follow noopener noreferrer">Rskhi</a></center></div>
         </body>
         </html>
-    ''', network_limit=network_limit, cpu_cores=CPU_CORES, total_ram=TOTAL_RAM)
+    '''
+
+def build_dashboard():
+    """Render the dashboard once and keep it pre-compressed.
+
+    Only the hardware constants are baked in; the traffic limit and all the
+    metrics reach the page through /data and /stream.
+    """
+    html = app.jinja_env.from_string(DASHBOARD_TEMPLATE).render(
+        cpu_cores=CPU_CORES, total_ram=TOTAL_RAM).encode()
+    variants = {'identity': html, 'gzip': gzip.compress(html, 9)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(html)
+    return variants, hashlib.sha1(html).hexdigest()[:20]
+
+dashboard_variants, dashboard_etag = build_dashboard()
+
+FLEET_PAGE = '''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Aseman Fleet</title>
+            <meta name="viewport" content="width=device-width, initial-scale=1">
+            <style>
+                body { font-family: Arial, sans-serif; background: #1e1e1e; color: #fff; margin: 0; padding: 20px; }
+                h1 { text-align: center; }
+                table { width: 100%; border-collapse: collapse; background: #2d2d2d; border-radius: 8px; }
+                th, td { padding: 8px 10px; text-align: right; border-bottom: 1px solid #3d3d3d; }
+                th:first-child, td:first-child { text-align: left; }
+                tr.offline td { color: #888; }
+                .status { display: inline-block; width: 10px; height: 10px; border-radius: 50%; margin-right: 6px; }
+                .online .status { background: #4CAF50; }
+                .offline .status { background: #f44336; }
+                .error { color: #f44336; font-size: 0.85em; }
+                a { color: #64b5f6; }
+            </style>
+        </head>
+        <body>
+            <h1>Aseman Fleet</h1>
+            <div id="summary" style="text-align: center; margin-bottom: 15px;"></div>
+            <table>
+                <thead><tr><th>Server</th><th>CPU</th><th>RAM</th><th>Disk</th><th>Download</th>
+                <th>Upload</th><th>Traffic</th><th>Latency</th><th>Last seen</th></tr></thead>
+                <tbody id="agents"></tbody>
+            </table>
+            <script>
+                function escapeHtml(text) {
+                    return String(text).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+                }
+                function percent(value) {
+                    return value == null ? '-' : value.toFixed(1) + '%';
+                }
+                function renderAgent(agent) {
+                    const s = agent.sample || {};
+                    const name = agent.url ? `<a href="${escapeHtml(agent.url)}" target="_blank">${escapeHtml(agent.name)}</a>` : escapeHtml(agent.name);
+                    const traffic = s.bytes_sent == null ? '-' : ((s.bytes_sent + s.bytes_recv) / 1024 ** 4).toFixed(3) + ' TB';
+                    const seen = agent.last_seen ? Math.round(Date.now() / 1000 - agent.last_seen) + ' s ago' : 'never';
+                    const error = agent.error ? `<div class="error">${escapeHtml(agent.error)}</div>` : '';
+                    return `<tr class="${agent.online ? 'online' : 'offline'}">
+                        <td><span class="status"></span>${name}${error}</td>
+                        <td>${percent(s.cpu_usage)}</td><td>${percent(s.memory_usage)}</td><td>${percent(s.disk_usage)}</td>
+                        <td>${s.recv_speed == null ? '-' : s.recv_speed.toFixed(2) + ' Mbps'}</td>
+                        <td>${s.sent_speed == null ? '-' : s.sent_speed.toFixed(2) + ' Mbps'}</td>
+                        <td>${traffic}</td>
+                        <td>${agent.latency_ms == null ? '-' : agent.latency_ms + ' ms'}</td><td>${seen}</td></tr>`;
+                }
+                function refresh() {
+                    fetch('/fleet/data')
+                        .then(response => response.json())
+                        .then(data => {
+                            const online = data.agents.filter(agent => agent.online).length;
+                            document.getElementById('summary').textContent = `${online} of ${data.agents.length} servers online`;
+                            document.getElementById('agents').innerHTML = data.agents.map(renderAgent).join('');
+                        })
+                        .catch(error => console.error('Error fetching fleet:', error));
+                }
+                refresh();
+                setInterval(refresh, 5000);
+            </script>
+        </body>
+        </html>
+    '''
+dashboard_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.get('request_started')
+    if started is not None:
+        rule = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        timings.observe(f'endpoint.{rule}', time.perf_counter() - started)
+    return response
+
+@app.route('/')
+def index():
+    encoding = request.accept_encodings.best_match(['br', 'gzip', 'identity'], default='identity')
+    if encoding not in dashboard_variants:
+        encoding = 'gzip' if request.accept_encodings['gzip'] else 'identity'
+
+    response = Response(dashboard_variants[encoding], mimetype='text/html')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f'{dashboard_etag}-{encoding}')
+    response.last_modified = dashboard_modified
+    return response.make_conditional(request)
 
 @app.route('/login', methods=['POST'])
 @limiter.limit("5 per minute")
 def login():
     data = request.json
     if data.get('username') == ADMIN_USERNAME and check_password_hash(ADMIN_PASSWORD_HASH, data.get('password')):
-        return jsonify({'success': True})
+        token, expires = sessions.issue()
+        return jsonify({'success': True, 'token': token, 'expires': expires})
     logging.warning(f"Failed login attempt from IP: {request.remote_addr}")
     return jsonify({'success': False})
 
+@app.route('/logout', methods=['POST'])
+@admin_required
+def logout():
+    """Revoke this session, or with {"all": true} every session issued so far."""
+    if (request.get_json(silent=True) or {}).get('all'):
+        sessions.revoke_all()
+    else:
+        sessions.revoke(session_token())
+    return jsonify({'success': True})
+
 @app.route('/set_limit', methods=['POST'])
+@admin_required
 def set_limit():
-    data = request.json
-    if data.get('username') != ADMIN_USERNAME or not check_password_hash(ADMIN_PASSWORD_HASH, data.get('password')):
-        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
-    
-    global network_limit
-    network_limit = data.get('limit')
-    save_limit(network_limit)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Expected a JSON object'}), 400
+    action = data.get('action')
+    if action is not None and action not in LIMIT_ACTIONS:
+        return jsonify({'success': False, 'error': f"Unknown action: {action}"}), 400
+    if not valid_limit(data.get('limit')):
+        return jsonify({'success': False, 'error': 'limit must be a non-negative number of TB or null'}), 400
+
+    save_limit(data.get('limit'), action)
     return jsonify({'success': True})
 
 @app.route('/shutdown', methods=['POST'])
+@admin_required
 def shutdown():
-    data = request.json
-    if data.get('username') != ADMIN_USERNAME or not check_password_hash(ADMIN_PASSWORD_HASH, data.get('password')):
-        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
-    
-    save_traffic_data()
-    os.system('shutdown now')
+    shutdown_server()
     return jsonify({'success': True})
 
+WIRE_MIMETYPES = {'json': 'application/json', 'compact': 'application/json',
+                  'msgpack': 'application/msgpack', 'f32': 'application/octet-stream'}
+
+def wire_format():
+    format = request.args.get('format', 'json')
+    if format not in wire.FORMATS:
+        raise ValueError(f"Unknown format: {format}")
+    if format == 'msgpack' and wire.msgpack is None:
+        raise ValueError("msgpack is not installed on the server")
+    return format
+
 @app.route('/data')
 def data():
-    return jsonify(get_system_info())
+    if request.args.get('format') == 'fields':
+        return jsonify(SAMPLE_FIELDS)
+    try:
+        format = wire_format()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if format == 'json':
+        with sample_lock:
+            payload = latest_payload
+    elif format == 'f32':
+        return jsonify({'success': False, 'error': "f32 is only available for /history"}), 400
+    else:
+        payload = get_encoded_sample(format)
+    return Response(payload, mimetype=WIRE_MIMETYPES[format])
 
-if __name__ == '__main__':
+@app.route('/stream')
+def stream():
+    global stream_clients
+    interval = request.args.get('interval', SAMPLE_INTERVAL, type=float)
+    interval = min(max(interval, SAMPLE_INTERVAL), MAX_STREAM_INTERVAL)
+    with sample_lock:
+        if stream_clients >= MAX_STREAM_CLIENTS:
+            return jsonify({'success': False, 'error': 'Too many streams'}), 503
+        stream_clients += 1
+    return Response(stream_samples(interval), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/history')
+def get_history():
+    metrics = request.args.get('metric')
+    metrics = metrics.split(',') if metrics else list(HISTORY_METRICS)
+    if 'cpu_per_core' in metrics:
+        metrics.remove('cpu_per_core')
+        metrics += CORE_METRICS
+    unknown = [metric for metric in metrics if metric not in HISTORY_METRICS and metric not in CORE_METRICS]
+    if unknown:
+        return jsonify({'success': False, 'error': f"Unknown metric: {', '.join(unknown)}"}), 400
+
+    try:
+        format = wire_format()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    since = request.args.get('since', type=float)
+    resolution = request.args.get('resolution')
+    tiers = {'1s': history, **{rollup.name: rollup for rollup in rollups}}
+    if resolution is None:
+        # Per-core metrics are only kept in the 1s ring
+        tier = history if any(metric in CORE_METRICS for metric in metrics) else pick_history_tier(since)
+    elif resolution in tiers:
+        tier = tiers[resolution]
+    else:
+        return jsonify({'success': False, 'error': f"Unknown resolution: {resolution}"}), 400
+
+    if tier is history:
+        columns = metrics
+        result = query_history(columns, since)
+        result['resolution'] = '1s'
+    elif any(metric in CORE_METRICS for metric in metrics):
+        return jsonify({'success': False, 'error': "Per-core history is only kept at 1s resolution"}), 400
+    else:
+        columns = [column for metric in metrics for column in (metric, f'{metric}_min', f'{metric}_max')]
+        result = tier.query(columns, since)
+        result['resolution'] = tier.name
+
+    if format == 'json':
+        return jsonify(result)
+    if format == 'f32':
+        response = Response(wire.binary_history(result, columns), mimetype=WIRE_MIMETYPES[format])
+        response.headers['X-Columns'] = ','.join(columns)
+        response.headers['X-Resolution'] = result['resolution']
+        return response
+    encoded = wire.compact_history(result, columns)
+    encoded['resolution'] = result['resolution']
+    if format == 'msgpack':
+        return Response(wire.pack(encoded), mimetype=WIRE_MIMETYPES[format])
+    return jsonify(encoded)
+
+@app.route('/metrics')
+def metrics():
+    encoding = 'gzip' if request.accept_encodings['gzip'] else 'identity'
+    response = Response(get_prometheus_metrics(encoding), content_type=PROMETHEUS_CONTENT_TYPE)
+    if encoding == 'gzip':
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/processes')
+def get_processes():
+    payload = processes_shared.read_payload() or b'{}'
+    if sessions.verify(session_token()) is not None:
+        return Response(payload, mimetype='application/json')
+    # Command lines often carry passwords and tokens: admins only
+    processes = json.loads(payload)
+    for key in PROCESS_SORT_KEYS:
+        for row in processes.get(key, []):
+            row.pop('cmdline', None)
+    return jsonify(processes)
+
+@app.route('/cgroups')
+def get_cgroups():
+    """Every collected cgroup of the latest tick, busiest first."""
+    if cgroups_shared is None:
+        return jsonify({'success': False, 'error': 'No cgroup v2 hierarchy'}), 404
+    sort = request.args.get('sort', 'cpu_percent')
+    if sort not in CGROUP_METRICS:
+        return jsonify({'success': False, 'error': f"Unknown sort key: {sort}"}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 10000)
+    payload = cgroups_shared.read_payload()
+    table = json.loads(payload) if payload else {'names': [], **{metric: [] for metric in CGROUP_METRICS}}
+    rows = [{'name': name, 'history': name in table.get('slots', {}),
+             **{metric: table[metric][position] for metric in CGROUP_METRICS}}
+            for position, name in enumerate(table['names'])]
+    return jsonify({'timestamp': table.get('timestamp'), 'count': len(rows),
+                    'cgroups': heapq.nlargest(limit, rows, key=lambda row: row[sort])})
+
+@app.route('/cgroups/history')
+def get_cgroup_history():
+    if cgroups_shared is None:
+        return jsonify({'success': False, 'error': 'No cgroup v2 hierarchy'}), 404
+    metrics = request.args.get('metric')
+    metrics = metrics.split(',') if metrics else list(CGROUP_METRICS)
+    unknown = [metric for metric in metrics if metric not in CGROUP_METRICS]
+    if unknown:
+        return jsonify({'success': False, 'error': f"Unknown metric: {', '.join(unknown)}"}), 400
+    payload = cgroups_shared.read_payload()
+    slot = (json.loads(payload) if payload else {}).get('slots', {}).get(request.args.get('name'))
+    if slot is None:
+        return jsonify({'success': False, 'error': 'No history kept for this cgroup'}), 404
+    return jsonify(cgroup_histories.query(slot, metrics, request.args.get('since', type=float)))
+
+@app.route('/traffic')
+def get_traffic():
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    months = min(max(request.args.get('months', 12, type=int), 1), 36)
+    if not leader_lock.held:
+        traffic_account.refresh()
+    start, sent, recv = traffic_account.cycle_usage()
+    return jsonify({
+        'cycle': {'start': start, 'sent': sent, 'recv': recv, 'limit': network_limit},
+        'days': traffic_account.per_day(days),
+        'months': traffic_account.per_month(months)
+    })
+
+# Fed from the 1h rollup store when /forecast is asked, never by the sampler
+traffic_forecaster = TrafficForecaster()
+
+@app.route('/forecast')
+def get_forecast():
+    """Projected usage at the end of the billing cycle and when the limit will be reached."""
+    sample = get_system_info()
+    if not sample:
+        return jsonify({'success': False, 'error': 'No sample yet'}), 503
+    traffic_forecaster.sync(rollups[-1].store)
+
+    start = date.fromisoformat(sample['cycle_start'])
+    end = next_cycle_start(start, limit_config['cycle_day'])
+    start_time = datetime(start.year, start.month, start.day).timestamp()
+    end_time = datetime(end.year, end.month, end.day).timestamp()
+    now = time.time()
+    used = sample['cycle_sent'] + sample['cycle_recv']
+    limit = network_limit * 1024 ** 4 if network_limit else None
+    # Until a first hour is stored, assume the cycle goes on as it went so far
+    cycle_rate = used / ((now - start_time) / 3600) if now > start_time else 0.0
+
+    forecast = traffic_forecaster.forecast(now, used, end_time, limit, cycle_rate)
+    return jsonify({
+        'cycle_start': start.isoformat(),
+        'cycle_end': end.isoformat(),
+        'used_bytes': used,
+        'limit_bytes': limit,
+        'projected_percent': round(100 * forecast['projected_cycle_bytes'] / limit, 1) if limit else None,
+        **forecast
+    })
+
+@app.route('/fleet')
+def fleet_page():
+    if fleet is None:
+        return jsonify({'success': False, 'error': 'Hub mode is off'}), 404
+    response = Response(FLEET_PAGE, mimetype='text/html')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/fleet/data')
+def fleet_data():
+    if fleet is None:
+        return jsonify({'success': False, 'error': 'Hub mode is off'}), 404
+    return jsonify({'agents': fleet.overview()})
+
+@app.route('/fleet/history')
+def fleet_history():
+    if fleet is None:
+        return jsonify({'success': False, 'error': 'Hub mode is off'}), 404
+    name = request.args.get('agent')
+    if name not in fleet.histories:
+        return jsonify({'success': False, 'error': f"Unknown agent: {name}"}), 400
+    metrics = request.args.get('metric')
+    metrics = metrics.split(',') if metrics else list(HISTORY_METRICS)
+    unknown = [metric for metric in metrics if metric not in HISTORY_METRICS]
+    if unknown:
+        return jsonify({'success': False, 'error': f"Unknown metric: {', '.join(unknown)}"}), 400
+    return jsonify(fleet.query(name, metrics, request.args.get('since', type=float)))
+
+@app.route('/hub/push', methods=['POST'])
+def hub_push():
+    if fleet is None:
+        return jsonify({'success': False, 'error': 'Hub mode is off'}), 404
+    token = hub_config['push_token']
+    # Compared as bytes: compare_digest() raises TypeError on non-ASCII strings.
+    # Header values arrive decoded as latin-1, which encode() reverses exactly.
+    pushed = request.headers.get('X-Push-Token', '').encode('latin-1')
+    if not token or not hmac.compare_digest(pushed, token.encode()):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('sample'), dict):
+        return jsonify({'success': False, 'error': 'Expected {"name": ..., "sample": {...}}'}), 400
+    if data.get('name') not in fleet.histories:
+        return jsonify({'success': False, 'error': f"Unknown agent: {data.get('name')}"}), 400
+    fleet.record([(data['name'], data['sample'], None, None)])
+    return jsonify({'success': True})
+
+process_usage = ProcessUsage()
+profiler = StackSampler()
+
+@app.route('/internal/stats')
+def internal_stats():
+    """This worker's own cost; collector timings only grow on the leader."""
+    return jsonify({
+        'pid': os.getpid(),
+        'leader': leader_lock.held,
+        'collector': collector.name,
+        'alerts': alerts.status(),
+        'process': process_usage.summary(),
+        'timings': timings.summary(),
+        'profiler': {'running': profiler.running, 'samples': profiler.samples},
+    })
+
+@app.route('/internal/profile', methods=['POST'])
+@admin_required
+def internal_profile():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Expected a JSON object'}), 400
+    top = data.get('top', 30)
+    if not isinstance(top, int) or isinstance(top, bool) or top < 1:
+        return jsonify({'success': False, 'error': 'top must be a positive integer'}), 400
+    action = data.get('action')
+    if action == 'start':
+        return jsonify({'success': profiler.start()})
+    if action == 'stop':
+        return jsonify({'success': True, **profiler.stop(top=top)})
+    return jsonify({'success': False, 'error': f"Unknown action: {action}"}), 400
+
+port_claims = {}
+
+def listen(host, port, backlog=128):
+    """A SO_REUSEPORT socket, so every pm2 worker can share the port.
+
+    Only workers of this installation (its working directory) may share it:
+    the port is claimed first, and a port claimed by another installation
+    fails like a port in use.
+    """
+    claim = port_claims.get(port) or PortClaim(port_claim_path(port), os.path.abspath(os.getcwd()))
+    if not claim.acquire():
+        raise OSError(errno.EADDRINUSE, f"Port {port} is used by the monitor installed in {claim.holder()}")
+    port_claims[port] = claim
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+def serve(host, port):
+    listener = listen(host, port)
+    make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+def prepare():
+    """Checks and setup shared by the Flask and the ASGI entry points."""
     if check_self_destruct():
         self_destruct()
     
     logging.basicConfig(level=logging.INFO)
+    # The sampler runs every second, do not log each run
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
     
     if not os.path.exists(SECURITY_FILE):
         logging.error(f"فایل امنیتی '{SECURITY_FILE}' یافت نشد!")
@@ -790,8 +2624,10 @@ if __name__ == '__main__':
     
     if not os.path.exists(LIMIT_FILE):
         save_limit(None)
-    
+
+if __name__ == '__main__':
+    prepare()
     try:
-        app.run(host='0.0.0.0', port=5000, debug=False)
+        serve('0.0.0.0', int(os.environ.get('PORT', 5000)))
     finally:
         save_traffic_data()
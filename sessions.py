@@ -0,0 +1,140 @@
+"""Signed, expiring admin sessions that every worker accepts.
+
+/login checks the password once and hands out a token
+'<session id>.<issued ms>.<expires>.<signature>'. Admin endpoints only
+recompute an HMAC-SHA256 to verify it, instead of a deliberately slow
+password hash per call. The signing key is derived from the secret key and
+the admin credentials, so every pm2 worker accepts the tokens of the others,
+tokens survive restarts, and changing the password invalidates all of them.
+
+Revocations are appended to a file as one line each: '<session id>
+<expires>' for a logout, '* <ms>' for every session issued before <ms>.
+Appends are atomic, so workers never overwrite each other's lines, and each
+worker reads only what was appended since its last look, which costs one
+stat() per verification when nothing changed.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+
+TOKEN_LIFETIME = 12 * 3600  # seconds
+
+
+def signing_key(secret, username, password):
+    return hmac.new(secret.encode(), f'session\0{username}\0{password}'.encode(), hashlib.sha256).digest()
+
+
+class Revocations:
+    """The revocation file, followed by its size."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.inode = None
+        self.offset = 0
+        self.revoked = {}  # session id -> expiry, dropped once expired
+        self.not_before = 0  # ms; sessions issued earlier are revoked
+
+    def refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino == self.inode and stat.st_size == self.offset:
+            return
+        with self.lock:
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                # Replaced or truncated: start over from its first line
+                self.inode, self.offset = stat.st_ino, 0
+                self.revoked, self.not_before = {}, 0
+            try:
+                with open(self.path, 'rb') as f:
+                    f.seek(self.offset)
+                    data = f.read()
+            except OSError as e:
+                logging.error(f"Could not read '{self.path}': {str(e)}")
+                return
+            end = data.rfind(b'\n') + 1  # a line still being appended is read next time
+            self.offset += end
+            now = time.time()
+            for line in data[:end].decode(errors='replace').splitlines():
+                session_id, _, value = line.partition(' ')
+                try:
+                    value = int(value)
+                except ValueError:
+                    continue
+                if session_id == '*':
+                    self.not_before = max(self.not_before, value)
+                elif value > now:
+                    self.revoked[session_id] = value
+            self.revoked = {session_id: expires for session_id, expires in self.revoked.items() if expires > now}
+
+    def append(self, line):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, f'{line}\n'.encode())
+        finally:
+            os.close(fd)
+        self.refresh()
+
+    def is_revoked(self, session_id, issued):
+        self.refresh()
+        return issued < self.not_before or session_id in self.revoked
+
+
+class Sessions:
+    def __init__(self, revocation_path, lifetime=TOKEN_LIFETIME):
+        self.lifetime = lifetime
+        self.key = None  # no session is valid until the credentials are loaded
+        self.revocations = Revocations(revocation_path)
+
+    def set_key(self, key):
+        self.key = key
+
+    def _sign(self, message):
+        digest = hmac.new(self.key, message.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def issue(self):
+        """A new token and its expiry as a unix time."""
+        issued = int(time.time() * 1000)
+        expires = issued // 1000 + self.lifetime
+        message = f'{secrets.token_urlsafe(12)}.{issued}.{expires}'
+        return f'{message}.{self._sign(message)}', expires
+
+    def _parse(self, token):
+        """(session id, issued ms, expires) of a token with a valid signature."""
+        # Tokens are ASCII; compare_digest() raises TypeError on other strings
+        if self.key is None or not isinstance(token, str) or not token.isascii():
+            return None
+        message, _, signature = token.rpartition('.')
+        if not hmac.compare_digest(self._sign(message), signature):
+            return None
+        session_id, issued, expires = message.split('.')
+        return session_id, int(issued), int(expires)
+
+    def verify(self, token):
+        """The session id of a valid, unexpired and unrevoked token, else None."""
+        parsed = self._parse(token)
+        if parsed is None:
+            return None
+        session_id, issued, expires = parsed
+        if time.time() >= expires or self.revocations.is_revoked(session_id, issued):
+            return None
+        return session_id
+
+    def revoke(self, token):
+        parsed = self._parse(token)
+        if parsed is None:
+            return False
+        session_id, _, expires = parsed
+        self.revocations.append(f'{session_id} {expires}')
+        return True
+
+    def revoke_all(self):
+        self.revocations.append(f'* {int(time.time() * 1000) + 1}')
@@ -0,0 +1,194 @@
+"""State shared between the worker processes started by `pm2 -i max`.
+
+One worker holds the leader lock and is the only one that samples psutil
+and writes the data files. It publishes every sample into a shared-memory
+segment that the other workers read, so adding workers adds readers, not
+collectors.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# seq, layout id, payload length; the payload and the ring buffer follow
+SEGMENT_HEADER = struct.Struct('<QQQ')
+
+
+def default_segment_path(name):
+    """A per-installation file in /dev/shm, so the segment never hits the disk."""
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    digest = hashlib.sha1(os.path.abspath(os.getcwd()).encode()).hexdigest()[:12]
+    return os.path.join(directory, f'{name}-{digest}')
+
+
+class LeaderLock:
+    """Non-blocking flock(); the kernel releases it when the holder dies."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self):
+        if self.fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self.fd = fd
+        return True
+
+    @property
+    def held(self):
+        return self.fd is not None
+
+
+def port_claim_path(port):
+    """The claim file of a TCP port, the same for every installation."""
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'aseman-monitor-port-{port}')
+
+
+class PortClaim:
+    """Which installation's workers share a port through SO_REUSEPORT.
+
+    The kernel lets any socket of the same user join a SO_REUSEPORT port, so
+    a second installation started on it would silently get half of the
+    connections. The claim file names the installation directory, and every
+    worker of that installation holds a shared flock() on it; a worker of
+    another installation finds it held by someone else and gives up. The
+    kernel drops the claim when the last worker exits.
+    """
+
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.fd = None
+
+    def _owner(self, fd):
+        return os.pread(fd, 4096, 0).decode(errors='replace')
+
+    def acquire(self):
+        """Claim the port for `owner`; False if another installation has it."""
+        if self.fd is not None:
+            return True
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except PermissionError:
+            return True  # another user's file: the kernel never shares a port across users anyway
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pass  # workers are alive, see whose they are below
+        else:
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, self.owner.encode(), 0)
+        # Not atomic after LOCK_EX: another installation may claim the file in
+        # between, which the owner check then sees
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        if self._owner(fd) != self.owner:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def holder(self):
+        """The installation directory named in the claim file."""
+        try:
+            with open(self.path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+class SharedSegment:
+    """mmap'ed file holding the latest payload plus an extra region.
+
+    Writers are serialised by the leader lock; readers use a sequence lock:
+    the leader makes `seq` odd while it writes, and a reader retries when it
+    saw an odd or changed `seq`. `layout` identifies the structure of the
+    extra region so workers running different code ignore each other.
+
+    A segment written by more than one process must wrap writing() in
+    exclusive(), which serialises writers across processes and threads.
+    """
+
+    def __init__(self, path, payload_size, extra_size, layout):
+        self.path = path
+        self.payload_size = payload_size
+        self.size = SEGMENT_HEADER.size + payload_size + extra_size
+        self.layout = int.from_bytes(hashlib.sha1(layout.encode()).digest()[:8], 'little')
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < self.size:
+            os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+        self.thread_lock = threading.Lock()
+        self.header = memoryview(self.map)[:SEGMENT_HEADER.size].cast('Q')
+        self.payload = memoryview(self.map)[SEGMENT_HEADER.size:SEGMENT_HEADER.size + payload_size]
+        self.extra = memoryview(self.map)[SEGMENT_HEADER.size + payload_size:]
+
+    @property
+    def seq(self):
+        return self.header[0]
+
+    @property
+    def valid(self):
+        return self.header[1] == self.layout
+
+    def claim(self):
+        """Called by a new leader; repairs a write the previous one left half done."""
+        if not self.valid:
+            self.map[:] = bytes(self.size)
+            self.header[1] = self.layout
+        if self.header[0] % 2:
+            self.header[0] += 1
+
+    @contextmanager
+    def exclusive(self):
+        # flock() is per open file, so threads of one process need their own lock
+        with self.thread_lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def writing(self):
+        self.header[0] += 1
+        try:
+            yield
+        finally:
+            self.header[0] += 1
+
+    def publish(self, payload):
+        """Store `payload`; must be called inside writing()."""
+        if len(payload) > self.payload_size:
+            raise ValueError(f"Payload of {len(payload)} bytes does not fit in {self.payload_size}")
+        self.payload[:len(payload)] = payload
+        self.header[2] = len(payload)
+
+    def read(self, reader, retries=200):
+        """Run `reader` until it saw a consistent segment and return its result."""
+        for _ in range(retries):
+            seq = self.header[0]
+            if seq % 2 == 0:
+                result = reader()
+                if self.header[0] == seq:
+                    return result
+            time.sleep(0.0005)
+        return reader()
+
+    def read_payload(self):
+        if not self.valid:
+            return None
+        return self.read(lambda: bytes(self.payload[:self.header[2]])) or None
@@ -0,0 +1,110 @@
+"""Traffic accounting: counter resets, reboots, billing-cycle rollover and stacked interfaces."""
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import namedtuple
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from accounting import TrafficAccount, cycle_start  # noqa: E402
+
+Counters = namedtuple('Counters', 'bytes_sent bytes_recv')
+EXCLUDE = re.compile(r'^(lo|veth.*)$')
+BOOT = 1_000_000.0
+
+
+def timestamp(*args):
+    return datetime(*args).timestamp()
+
+
+class TrafficAccountTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sysfs = os.path.join(self.directory, 'net')
+        self.account = self.make_account()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_account(self, cycle_day=1):
+        return TrafficAccount(os.path.join(self.directory, 'traffic_account.json'), EXCLUDE, cycle_day,
+                              sysfs=self.sysfs)
+
+    def add_interface(self, name, *links):
+        os.makedirs(os.path.join(self.sysfs, name))
+        for link in links:
+            open(os.path.join(self.sysfs, name, link), 'w').close()
+
+    def test_counts_deltas_and_restarts_after_a_counter_reset(self):
+        now = timestamp(2026, 3, 10, 12)
+        self.account.baseline({'eth0': Counters(100, 200), 'lo': Counters(5, 5)}, BOOT)
+        self.account.update({'eth0': Counters(150, 260), 'lo': Counters(900, 900)}, BOOT, now)
+        self.assertEqual(self.account.totals(), (50, 60))
+        # Lower than before: the counter was reset or wrapped, all of it is new
+        self.account.update({'eth0': Counters(30, 10), 'lo': Counters(1, 1)}, BOOT, now + 1)
+        self.assertEqual(self.account.totals(), (80, 70))
+        self.account.update({'eth0': Counters(40, 15)}, BOOT, now + 2)
+        self.assertEqual(self.account.totals(), (90, 75))
+
+    def test_counts_everything_after_a_reboot(self):
+        now = timestamp(2026, 3, 10, 12)
+        self.account.baseline({'eth0': Counters(100, 200)}, BOOT)
+        self.account.update({'eth0': Counters(150, 260)}, BOOT, now)
+        # Higher than before, but since a new boot: the old counters mean nothing
+        self.account.update({'eth0': Counters(500, 700)}, BOOT + 3600, now + 3600)
+        self.assertEqual(self.account.totals(), (550, 760))
+
+    def test_survives_a_monitor_restart(self):
+        now = timestamp(2026, 3, 10, 12)
+        self.account.baseline({'eth0': Counters(100, 200)}, BOOT)
+        self.account.update({'eth0': Counters(150, 260)}, BOOT, now)
+        self.account.save()
+        restarted = self.make_account()
+        self.assertTrue(restarted.load())
+        restarted.update({'eth0': Counters(170, 300)}, BOOT, now + 60)
+        self.assertEqual(restarted.totals(), (70, 100))
+
+    def test_starts_a_new_cycle_on_the_cycle_day(self):
+        account = self.make_account(cycle_day=15)
+        account.baseline({'eth0': Counters(0, 0)}, BOOT)
+        account.update({'eth0': Counters(100, 10)}, BOOT, timestamp(2026, 3, 14, 23, 59, 30))
+        self.assertEqual(account.cycle_usage(), ('2026-02-15', 100, 10))
+        account.update({'eth0': Counters(150, 20)}, BOOT, timestamp(2026, 3, 15, 0, 0, 30))
+        self.assertEqual(account.cycle_usage(), ('2026-03-15', 50, 10))
+        self.assertEqual(account.per_day(2), [{'date': '2026-03-14', 'sent': 100, 'recv': 10},
+                                              {'date': '2026-03-15', 'sent': 50, 'recv': 10}])
+        self.assertEqual(account.per_month(1), [{'month': '2026-03', 'sent': 150, 'recv': 20}])
+
+    def test_cycle_day_beyond_the_end_of_a_short_month(self):
+        self.assertEqual(cycle_start(date(2026, 2, 28), 31), date(2026, 2, 28))
+        self.assertEqual(cycle_start(date(2026, 2, 27), 31), date(2026, 1, 31))
+        self.assertEqual(cycle_start(date(2026, 3, 30), 31), date(2026, 2, 28))
+        self.assertEqual(cycle_start(date(2026, 3, 31), 31), date(2026, 3, 31))
+
+    def test_counts_bonds_and_vlans_once(self):
+        self.add_interface('eth0', 'master', 'upper_bond0')
+        self.add_interface('eth1', 'master', 'upper_bond0')
+        self.add_interface('bond0', 'lower_eth0', 'lower_eth1', 'upper_bond0.100')
+        self.add_interface('bond0.100', 'lower_bond0')
+        now = timestamp(2026, 3, 10, 12)
+        self.account.baseline({name: Counters(0, 0) for name in ('eth0', 'eth1', 'bond0', 'bond0.100')}, BOOT)
+        self.account.update({'eth0': Counters(10, 1), 'eth1': Counters(20, 2),
+                             'bond0': Counters(30, 3), 'bond0.100': Counters(7, 1)}, BOOT, now)
+        self.assertEqual(self.account.totals(), (30, 3))
+
+    def test_rechecks_interfaces_when_they_change(self):
+        self.add_interface('eth0')
+        now = timestamp(2026, 3, 10, 12)
+        self.account.baseline({'eth0': Counters(0, 0)}, BOOT)
+        self.account.update({'eth0': Counters(10, 1)}, BOOT, now)
+        self.add_interface('eth0.100', 'lower_eth0')
+        self.account.update({'eth0': Counters(30, 3), 'eth0.100': Counters(5, 1)}, BOOT, now + 1)
+        self.assertEqual(self.account.totals(), (30, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
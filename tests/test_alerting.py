@@ -0,0 +1,82 @@
+"""Rule firing, resolve dedup and webhook retries, against a local HTTP stand-in."""
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alerting import AlertEngine  # noqa: E402
+
+
+class FlakyWebhook(BaseHTTPRequestHandler):
+    """Answers 503 to the first `failures` POSTs, then 200; keeps every body."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        server.requests.append(body)
+        status = 503 if len(server.requests) <= server.failures else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookDeliveryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyWebhook)
+        self.server.requests = []
+        self.server.failures = 2
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.engine = AlertEngine()
+        self.engine.configure({
+            'rules': [{'name': 'cpu-hot', 'metric': 'cpu_usage', 'op': '>', 'value': 90, 'for': 2}],
+            'sinks': [{'type': 'webhook', 'url': f'http://127.0.0.1:{self.server.server_port}/hook'}],
+            'repeat': 0,
+        })
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def evaluate(self, timestamp, cpu_usage):
+        return self.engine.evaluate({'timestamp': timestamp, 'cpu_usage': cpu_usage})
+
+    def test_fires_resolves_once_and_retries_with_backoff(self):
+        self.assertEqual(self.evaluate(100, 95), [])  # 'for' not reached yet
+        self.assertEqual(self.evaluate(101, 96), [])
+        self.assertEqual(self.evaluate(102, 97), ['cpu-hot'])
+        self.assertEqual(self.evaluate(103, 98), ['cpu-hot'])  # still firing, no new event
+        self.assertEqual(self.evaluate(104, 50), [])
+        self.assertEqual(self.evaluate(105, 40), [])  # already resolved, no new event
+
+        queue = next(iter(self.engine.queues.values()))
+        self.assertEqual(queue.status()['pending'], 2)
+
+        self.engine.deliver(now=200)  # 503
+        self.assertEqual((len(self.server.requests), queue.failures, queue.retry_at), (1, 1, 205))
+        self.engine.deliver(now=204)  # backing off, nothing sent
+        self.assertEqual(len(self.server.requests), 1)
+        self.engine.deliver(now=205)  # 503 again, the backoff doubles
+        self.assertEqual((len(self.server.requests), queue.failures, queue.retry_at), (2, 2, 215))
+        self.engine.deliver(now=214)
+        self.assertEqual(len(self.server.requests), 2)
+        self.engine.deliver(now=215)  # accepted
+
+        self.assertEqual(len(self.server.requests), 3)
+        for body in self.server.requests:
+            # The failed batch was retried whole and in order
+            self.assertEqual([(event['rule'], event['state']) for event in body['alerts']],
+                             [('cpu-hot', 'firing'), ('cpu-hot', 'resolved')])
+        firing = self.server.requests[-1]['alerts'][0]
+        self.assertEqual((firing['observed'], firing['since'], firing['time']), (97, 100, 102))
+        self.assertEqual(queue.status(), {'pending': 0, 'delivered': 2, 'dropped': 0, 'failures': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
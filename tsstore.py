@@ -0,0 +1,238 @@
+"""Append-only binary time-series files.
+
+A store is a small header followed by fixed-width records of little-endian
+float64 values, the first one being the unix timestamp. Appends are a single
+write() of one record, fsync is batched, and reads go through mmap so a query
+only copies the records it returns.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'ASTS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')  # magic, version, field count, header size
+TIMESTAMP = struct.Struct('<d')
+
+
+class TimeSeriesStore:
+    """Fixed-width records of (timestamp, *fields) in an append-only file.
+
+    `capacity` bounds the disk usage: once the file holds half as many
+    records again, the oldest ones are dropped by rewriting the newest
+    `capacity` records, which keeps appends amortised O(1).
+
+    A `readonly` store follows a file written by another process: it never
+    modifies the file and picks up new records (or a compaction) before
+    every read.
+    """
+
+    def __init__(self, path, fields, capacity, fsync_every=32, fsync_interval=60.0, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.metrics = tuple(fields)
+        self.capacity = capacity
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.index = {field: position + 1 for position, field in enumerate(self.metrics)}
+        self.record = struct.Struct('<' + 'd' * (len(self.metrics) + 1))
+        self.header = self._build_header()
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.map_size = 0
+        self.count = 0
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self._open()
+
+    def _build_header(self):
+        names = ','.join(self.metrics).encode()
+        size = HEADER.size + len(names)
+        size += -size % 8  # keep records 8-byte aligned for memoryview.cast('d')
+        return HEADER.pack(MAGIC, VERSION, len(self.metrics), size) + names.ljust(size - HEADER.size, b'\0')
+
+    def _open(self):
+        if self.readonly:
+            self._open_readonly()
+            return
+        try:
+            self.file = open(self.path, 'r+b', buffering=0)
+            if self.file.read(len(self.header)) != self.header:
+                self.file.close()
+                os.replace(self.path, self.path + '.old')
+                logging.warning(f"'{self.path}' has a different layout, moved it to '{self.path}.old'")
+                raise FileNotFoundError(self.path)
+        except FileNotFoundError:
+            self.file = open(self.path, 'w+b', buffering=0)
+            self.file.write(self.header)
+            os.fsync(self.file.fileno())
+
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = (size - len(self.header)) // self.record.size
+        valid_size = len(self.header) + self.count * self.record.size
+        if valid_size != size:
+            # A crash in the middle of an append leaves a torn record at the end
+            logging.warning(f"Dropping {size - valid_size} bytes of incomplete record from '{self.path}'")
+            self.file.truncate(valid_size)
+        self.file.seek(valid_size)
+
+    def _open_readonly(self):
+        try:
+            self.file = open(self.path, 'rb', buffering=0)
+        except FileNotFoundError:
+            self.file = None
+            self.count = 0
+            return
+        if self.file.read(len(self.header)) != self.header:
+            self.file.close()
+            self.file = None
+            self.count = 0
+            return
+        self._follow()
+
+    def _follow(self):
+        # Another process appends to or compacts the file under our feet
+        if self.file is None:
+            self._open_readonly()
+            return
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != os.fstat(self.file.fileno()).st_ino:
+            self._close_map()
+            self.file.close()
+            self._open_readonly()
+            return
+        self.count = max(0, (stat.st_size - len(self.header)) // self.record.size)
+
+    def reopen(self, readonly):
+        """Switch between following and owning the file, e.g. on leader change."""
+        with self.lock:
+            self._close_map()
+            if self.file is not None:
+                self.file.close()
+            self.readonly = readonly
+            self.pending = 0
+            self._open()
+
+    def _close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.map_size = 0
+
+    def _mapped(self):
+        size = len(self.header) + self.count * self.record.size
+        if self.map_size != size:
+            self._close_map()
+            self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+            self.map_size = size
+        return self.map
+
+    def _timestamp(self, index):
+        return TIMESTAMP.unpack_from(self.map, len(self.header) + index * self.record.size)[0]
+
+    def _bisect(self, since):
+        # Index of the first record newer than `since`
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamp(middle) <= since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def append(self, timestamp, values):
+        """Append one record; `values` maps every field name to a float."""
+        with self.lock:
+            if self.readonly:
+                raise ValueError(f"'{self.path}' is opened read-only")
+            self.file.write(self.record.pack(timestamp, *(values[field] for field in self.metrics)))
+            self.count += 1
+            self.pending += 1
+            if self.count >= self.capacity + self.capacity // 2:
+                self._compact()
+            elif self.pending >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            if not self.readonly:
+                self._sync()
+
+    def _compact(self):
+        keep = min(self.count, self.capacity)
+        start = len(self.header) + (self.count - keep) * self.record.size
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f, memoryview(self._mapped())[start:] as tail:
+            f.write(self.header)
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        self._close_map()
+        self.file.close()
+        os.replace(temp_path, self.path)
+        self._open()
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def query(self, columns, since=None):
+        """Records newer than `since` as {'timestamps': [...], column: [...]}."""
+        with self.lock:
+            result = {'timestamps': [], **{column: [] for column in columns}}
+            if self.readonly:
+                self._follow()
+            if not self.count:
+                return result
+            mapped = self._mapped()
+            start = self._bisect(since) if since is not None else 0
+            if start >= self.count:
+                return result
+
+            width = len(self.metrics) + 1
+            with memoryview(mapped)[len(self.header) + start * self.record.size:] as raw, \
+                    raw.cast('d') as values:
+                result['timestamps'] = values[0::width].tolist()
+                for column in columns:
+                    result[column] = values[self.index[column]::width].tolist()
+            return result
+
+    def first(self):
+        """Timestamp of the oldest record, or None for an empty store."""
+        with self.lock:
+            if self.readonly:
+                self._follow()
+            if not self.count:
+                return None
+            self._mapped()
+            return self._timestamp(0)
+
+    def last(self):
+        """The newest record as a dict, or None for an empty store."""
+        with self.lock:
+            if self.readonly:
+                self._follow()
+            if not self.count:
+                return None
+            values = self.record.unpack_from(self._mapped(), len(self.header) + (self.count - 1) * self.record.size)
+            return {'timestamp': values[0], **dict(zip(self.metrics, values[1:]))}
+
+    def close(self):
+        with self.lock:
+            if not self.readonly:
+                self._sync()
+            self._close_map()
+            if self.file is not None:
+                self.file.close()
@@ -0,0 +1,81 @@
+"""Compact encodings of samples and history for slow links.
+
+The default JSON responses repeat every key in every sample. These encodings
+send a fixed field order once and plain arrays after that:
+
+- `compact`: JSON arrays, floats rounded to PRECISION decimals and
+  timestamps sent as the first one plus millisecond deltas.
+- `msgpack`: the same structure in msgpack, when the package is installed.
+- `f32`: binary history a browser reads straight into Float32Arrays:
+
+      'ASH1', uint32 count, uint16 column count, uint16 0, float64 first timestamp,
+      count - 1 unsigned LEB128 varints of millisecond deltas, zero padding to
+      a multiple of 4, then one float32 array of `count` values per column.
+
+  All numbers are little-endian; the column order is sent in X-Columns.
+"""
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PRECISION = 3
+BINARY_MAGIC = b'ASH1'
+BINARY_HEADER = struct.Struct('<4sIHHd')
+FORMATS = ('json', 'compact', 'msgpack', 'f32')
+
+
+def _round(value):
+    return round(value, PRECISION) if isinstance(value, float) else value
+
+
+def timestamp_deltas(timestamps):
+    """Milliseconds between consecutive timestamps, rounding errors not accumulating."""
+    milliseconds = [round(timestamp * 1000) for timestamp in timestamps]
+    return [current - previous for previous, current in zip(milliseconds, milliseconds[1:])]
+
+
+def encode_varints(values):
+    out = bytearray()
+    for value in values:
+        value = max(value, 0)  # clock steps backwards are clamped, the ring stays sorted
+        while value >= 0x80:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+        out.append(value)
+    return out
+
+
+def compact_sample(sample, fields):
+    """`sample` as a list of its values in `fields` order."""
+    return [_round(sample.get(field)) for field in fields]
+
+
+def compact_history(history, columns):
+    """A {'timestamps': [...], column: [...]} query result with delta timestamps."""
+    timestamps = history['timestamps']
+    return {
+        'columns': list(columns),
+        't0': timestamps[0] if timestamps else None,
+        'dt': timestamp_deltas(timestamps),
+        'values': [[_round(value) for value in history[column]] for column in columns],
+    }
+
+
+def binary_history(history, columns):
+    timestamps = history['timestamps']
+    count = len(timestamps)
+    out = bytearray(BINARY_HEADER.pack(BINARY_MAGIC, count, len(columns), 0, timestamps[0] if count else 0.0))
+    out += encode_varints(timestamp_deltas(timestamps))
+    out += bytes(-len(out) % 4)
+    for column in columns:
+        out += struct.pack(f'<{count}f', *history[column])
+    return bytes(out)
+
+
+def pack(data):
+    if msgpack is None:
+        raise ValueError("msgpack is not installed")
+    return msgpack.packb(data, use_bin_type=True)